@@ -35,23 +35,89 @@ data when necessary. Use __contains__() or 'in' to check before fetching.
 
 nodeWays: dictionary of node ids to the ids of the ways that contain them.
 
+Each of these keeps the objects it looked up most recently in memory. The
+number kept is set by the node-cache-size, way-cache-size,
+relation-cache-size and node-way-cache-size config options (0 turns the
+cache off).
+
+routingGraph: an osm.routing.RoutingGraph of the cached ways, giving the
+neighbours of each node (with the way and distance to them) for routing.
+
+Objects are kept compact: they have no per-instance __dict__, ways hold their
+node ids in an array, and tag strings are shared between objects. Setting the
+lazy-tags option to true makes objects looked up through the dictionaries
+load their tags only when they are first used.
+
+The sqlite database is tuned with the db-profile option ("default",
+"bulk-import" or "read-mostly") and the individual db-* pragma options, as
+described in osm.store.
+
 """
 
 import ConfigParser
 
-config = ConfigParser.SafeConfigParser({'debug':True, 'db-filename':'osm.db', 'db-use-memory':False})
+config = ConfigParser.SafeConfigParser({'debug':True, 'db-filename':'osm.db', 'db-use-memory':False,
+                                        'node-cache-size':'20000', 'way-cache-size':'5000',
+                                        'relation-cache-size':'500', 'node-way-cache-size':'20000',
+                                        'fetch-window':'0.01', 'http-pool-size':'4',
+                                        'http-timeout':'60', 'http-retries':'3',
+                                        'http-backoff':'0.5', 'db-profile':'default',
+                                        'db-journal-mode':'', 'db-synchronous':'',
+                                        'db-cache-size':'', 'db-mmap-size':'',
+                                        'db-temp-store':'', 'db-page-size':'',
+                                        'lazy-tags':'false', 'route-max-iter':'10000'})
 config.add_section('osm')
 config.read('osm.cfg')
+
+# The non-ASCII unicode strings shared by Node, Way and Relation objects
+# (other strings go through the builtin intern). The table is emptied when it
+# reaches _MAX_STRINGS, so long-running processes don't keep every string
+# they have ever seen.
+_strings = {}
+_MAX_STRINGS = 100000
+
+def intern_string(s):
+    """
+    Returns a shared copy of the string s, so each tag key, tag value and
+    user name is only held in memory once however many objects use it.
+    ASCII unicode strings come back as (equal) byte strings interned by the
+    builtin intern, which frees them once nothing else uses them.
+    """
+    if isinstance(s, unicode):
+        try:
+            s = s.encode('ascii')
+        except UnicodeError:
+            if len(_strings) >= _MAX_STRINGS:
+                _strings.clear()
+            return _strings.setdefault(s, s)
+    return intern(s)
+
+def intern_tags(tags):
+    """
+    Returns a copy of the dict tags with its keys and values shared through
+    intern_string (or None if tags is None).
+    """
+    if tags is None:
+        return None
+    # (Not dict(), which osm.dict hides once it is imported.)
+    shared = {}
+    for k, v in tags.iteritems():
+        shared[intern_string(k)] = intern_string(v)
+    return shared
     
 import osm.node
 import osm.way
 import osm.relation
+import osm.coverage
 import osm.fetch
 import osm.store
 import osm.dict
+import osm.prefetch
+import osm.routing
 
 nodes = osm.dict.NodeDict()
 ways = osm.dict.WayDict()
 relations = osm.dict.RelationDict()
 nodeWays = osm.dict.NodeWayDict()
+routingGraph = osm.routing.RoutingGraph()
 
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+
+## Copyright 2010 Michael Larsen <mike.gh.larsen@gmail.com>
+##
+## This program is free software: you can redistribute it and/or modify  ##
+## it under the terms of the GNU General Public License as published by  ##
+## the Free Software Foundation, either version 3 of the License, or     ##
+## (at your option) any later version.                                   ##
+##                                                                       ##
+## This program is distributed in the hope that it will be useful,       ##
+## but WITHOUT ANY WARRANTY; without even the implied warranty of        ##
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         ##
+## GNU General Public License for more details.                          ##
+##                                                                       ##
+## You should have received a copy of the GNU General Public License     ##
+## along with this program.  If not, see <http://www.gnu.org/licenses/>. ##
+"""
+This module provides a non-blocking interface to the same data as the osm
+module, for programs that handle many requests at once.
+
+Every call returns a Future straight away instead of blocking. All the sqlite
+work is done in order on one dedicated thread, and downloads are made by a
+pool of osm.fetch.HTTP_POOL_SIZE threads, so a cold lookup never holds up the
+caller. Concurrent requests for the same object, or for overlapping map
+areas, share a single download.
+
+Members:
+nodes, ways, relations: objects whose get(id) returns a Future of the
+osm.node.Node, osm.way.Way or osm.relation.Relation with that id (or None if
+the server doesn't have it).
+
+map_get(minlat, maxlat, minlon, maxlon): returns a Future that is resolved
+(to None) once everything in the box is cached.
+
+Importing this module starts its threads.
+"""
+
+from __future__ import with_statement
+import Queue
+import threading
+import osm
+import osm.coverage
+import osm.fetch
+import osm.store
+
+class Future:
+    """
+    The eventual result of an osm.aio call.
+    """
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = None
+        self._error = None
+
+    def set_result(self, result):
+        """
+        Resolve the future with result (ignored if it is already resolved).
+        """
+        self._finish(result, None)
+
+    def set_exception(self, error):
+        """
+        Fail the future with error (ignored if it is already resolved).
+        """
+        self._finish(None, error)
+
+    def _finish(self, result, error):
+        with self._lock:
+            if self._done.isSet():
+                return
+            self._result, self._error = result, error
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def done(self):
+        """
+        Returns true if the future has been resolved.
+        """
+        return self._done.isSet()
+
+    def result(self, timeout = None):
+        """
+        Wait (up to timeout seconds, if given) for the future to be resolved.
+        Returns the result, or raises the exception the future failed with.
+        """
+        if not self._done.wait(timeout):
+            raise RuntimeError('timed out waiting for the result')
+        if self._error:
+            raise self._error
+        return self._result
+
+    def exception(self):
+        """
+        Returns the exception the future failed with, if any.
+        """
+        return self._error
+
+    def add_done_callback(self, callback):
+        """
+        Call callback with the future once it is resolved (straight away if
+        it already is). Callbacks run on the thread that resolved the future.
+        """
+        with self._lock:
+            if not self._done.isSet():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+class _Executor:
+    """
+    Runs the functions put on it on a fixed set of daemon threads.
+    """
+    def __init__(self, threads):
+        self.jobs = Queue.Queue()
+        for i in xrange(threads):
+            thread = threading.Thread(target = self._run)
+            thread.setDaemon(True)
+            thread.start()
+
+    def put(self, future, fn, *args):
+        """
+        Run fn(*args) on one of the threads, failing future if it raises.
+        """
+        self.jobs.put((future, fn, args))
+
+    def _run(self):
+        while True:
+            future, fn, args = self.jobs.get()
+            try:
+                fn(*args)
+            except Exception, e:
+                future.set_exception(e)
+
+# The thread that does all the sqlite work, in order.
+_store = _Executor(1)
+
+# The threads that download from the server.
+_fetchers = _Executor(osm.fetch.HTTP_POOL_SIZE)
+
+# Futures of the lookups and map areas being fetched, keyed by (class, id) and
+# by box respectively.
+_inflight = dict()
+_map_inflight = dict()
+_inflight_lock = threading.Lock()
+
+def _forget(table, key):
+    """
+    Returns a callback removing key from table once its future is resolved.
+    """
+    def callback(future):
+        with _inflight_lock:
+            table.pop(key, None)
+    return callback
+
+def _gather(futures, future):
+    """
+    Resolve future once all of futures are, failing it if any of them fail.
+    """
+    remaining = [len(futures)]
+    lock = threading.Lock()
+    def callback(done):
+        if done.exception():
+            future.set_exception(done.exception())
+        with lock:
+            remaining[0] -= 1
+            finished = remaining[0] == 0
+        if finished:
+            future.set_result(None)
+    if not futures:
+        future.set_result(None)
+    for f in futures:
+        f.add_done_callback(callback)
+
+class _Lookup:
+    """
+    Non-blocking lookups of one kind of object (see nodes, ways and
+    relations).
+    """
+    def __init__(self, cls, retrieve_many, get_many):
+        """
+        cls: the class of the objects.
+        retrieve_many: gets a dict of the objects found locally for a list of
+        ids (e.g. osm.store.node_retrieve_many).
+        get_many: downloads a list of the data for a list of ids, without
+        caching it (e.g. osm.fetch.nodes_get).
+        """
+        self.cls = cls
+        self.retrieve_many = retrieve_many
+        self.get_many = get_many
+
+    def get(self, id, server = osm.fetch.DEFAULT_SERVER, api = osm.fetch.DEFAULT_API):
+        """
+        Returns a Future of the object with the given id (or None if the
+        server doesn't have it), fetching and caching it if it isn't local.
+        """
+        key = (self.cls, id)
+        with _inflight_lock:
+            if key in _inflight:
+                return _inflight[key]
+            future = _inflight[key] = Future()
+        future.add_done_callback(_forget(_inflight, key))
+        _store.put(future, self._retrieve, id, server, api, future)
+        return future
+
+    def _retrieve(self, id, server, api, future):
+        found = self.retrieve_many([id])
+        if id in found:
+            future.set_result(found[id])
+        else:
+            _fetchers.put(future, self._download, id, server, api, future)
+
+    def _download(self, id, server, api, future):
+        data = self.get_many([id], server, api)
+        _store.put(future, self._cache, id, data, future)
+
+    def _cache(self, id, data, future):
+        osm.store.data_store(data)
+        for d in data:
+            if isinstance(d, self.cls) and d.id == id:
+                future.set_result(d)
+                return
+        future.set_result(None)
+
+nodes = _Lookup(osm.node.Node, osm.store.node_retrieve_many, osm.fetch.nodes_get)
+ways = _Lookup(osm.way.Way, osm.store.way_retrieve_many, osm.fetch.ways_get)
+relations = _Lookup(osm.relation.Relation, osm.store.relation_retrieve_many,
+                    osm.fetch.relations_get)
+
+def map_get(minlat, maxlat, minlon, maxlon,
+            server = osm.fetch.DEFAULT_SERVER, api = osm.fetch.DEFAULT_API):
+    """
+    Returns a Future that is resolved once all map data inside the box defined
+    by the parameters is cached. Only the parts that haven't been fetched, and
+    aren't already being fetched, are downloaded.
+    """
+    future = Future()
+    _store.put(future, _map_plan, (minlat, maxlat, minlon, maxlon), server, api, future)
+    return future
+
+def _map_plan(box, server, api, future):
+    """
+    Start downloading the parts of box not covered or already in flight, and
+    resolve future once those and the in-flight parts are done.
+    """
+    pieces = osm.store.map_uncovered(*box)
+    waits = []
+    with _inflight_lock:
+        for other, f in _map_inflight.iteritems():
+            if [p for p in pieces if osm.coverage.intersects(p, other)]:
+                waits.append(f)
+                pieces = [q for p in pieces for q in osm.coverage.subtract(p, [other])]
+        downloads = [(piece, Future()) for piece in pieces]
+        for piece, f in downloads:
+            _map_inflight[piece] = f
+    for piece, f in downloads:
+        f.add_done_callback(_forget(_map_inflight, piece))
+        _fetchers.put(f, _map_download, piece, server, api, f)
+    _gather(waits + [f for piece, f in downloads], future)
+
+def _map_download(box, server, api, future):
+    data = osm.fetch.map_download(*box, server = server, api = api)
+    _store.put(future, _map_cache, box, data, future)
+
+def _map_cache(box, data, future):
+    osm.store.data_store(data)
+    osm.store.map_store(*box)
+    future.set_result(None)
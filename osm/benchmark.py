@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+## Copyright 2010 Michael Larsen <mike.gh.larsen@gmail.com>
+##
+## This program is free software: you can redistribute it and/or modify  ##
+## it under the terms of the GNU General Public License as published by  ##
+## the Free Software Foundation, either version 3 of the License, or     ##
+## (at your option) any later version.                                   ##
+##                                                                       ##
+## This program is distributed in the hope that it will be useful,       ##
+## but WITHOUT ANY WARRANTY; without even the implied warranty of        ##
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         ##
+## GNU General Public License for more details.                          ##
+##                                                                       ##
+## You should have received a copy of the GNU General Public License     ##
+## along with this program.  If not, see <http://www.gnu.org/licenses/>. ##
+"""
+This module measures the throughput of the store under each of the sqlite
+profiles in osm.store.PROFILES, using a synthetic street grid written to a
+scratch database file.
+
+Run it with:
+    python -m osm.benchmark [nodes]
+
+For each profile it reports the objects per second imported in batches (as
+osm.store.data_store does), the objects per second stored with a commit each,
+and the nodes per second looked up by id. Any db-* pragma options set in
+osm.cfg apply on top of every profile.
+"""
+
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import osm
+import osm.store
+
+# Number of objects stored with a commit each, and of nodes looked up.
+SINGLE_STORES = 200
+LOOKUPS = 20000
+
+def grid(count):
+    """
+    Returns a list of about count Nodes in a square grid, followed by a Way
+    along each row and each column of it.
+    """
+    side = max(2, int(count ** 0.5))
+    fields = (0, 0, 1, '2010-01-01T00:00:00Z', 1, 1, 'benchmark')
+    data = []
+    for i in xrange(side):
+        for j in xrange(side):
+            tags = {'highway':'traffic_signals'} if (i + j) % 7 == 0 else {}
+            data.append(osm.node.Node(i * side + j + 1,
+                                      (40.8 + i * 0.001, -73.9 + j * 0.001) + fields[2:],
+                                      tags))
+    for i in xrange(side):
+        data.append(osm.way.Way(i + 1, fields[2:], {'highway':'residential'},
+                                [i * side + j + 1 for j in xrange(side)]))
+        data.append(osm.way.Way(side + i + 1, fields[2:], {'highway':'residential'},
+                                [j * side + i + 1 for j in xrange(side)]))
+    return data
+
+def run(profile, data):
+    """
+    Benchmark profile with data (from grid) on a new database.
+    Returns (batched objects/s, single objects/s, lookups/s).
+    """
+    handle, filename = tempfile.mkstemp(suffix = '.db')
+    os.close(handle)
+    values = osm.store.settings(profile)
+    try:
+        conn = sqlite3.connect(filename)
+        osm.store.configure(conn, values, True)
+        osm.store._migrate(conn)
+        with osm.store._trans(conn) as c:
+            c.execute(osm.store._create_osm_tag_batch_sql)
+            c.execute(osm.store._create_osm_id_batch_sql)
+
+        start = time.time()
+        for batch in osm.store._batches(data, osm.store.BATCH_SIZE):
+            with osm.store._trans(conn) as c:
+                osm.store._batch_store(c, batch)
+        batched = len(data) / (time.time() - start)
+
+        start = time.time()
+        for item in data[:SINGLE_STORES]:
+            with osm.store._trans(conn) as c:
+                osm.store._batch_store(c, [item])
+        single = SINGLE_STORES / (time.time() - start)
+
+        reader = sqlite3.connect(filename)
+        osm.store.configure(reader, values)
+        ids = [d.id for d in data if isinstance(d, osm.node.Node)]
+        select_sql = osm.store._select_sql('osm_node', osm.node.node_fields, 'id = ?')
+        start = time.time()
+        for i in xrange(LOOKUPS):
+            reader.execute(select_sql, (random.choice(ids),)).fetchone()
+        lookups = LOOKUPS / (time.time() - start)
+        reader.close()
+        conn.close()
+        return batched, single, lookups
+    finally:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(filename + suffix):
+                os.remove(filename + suffix)
+
+def main(argv):
+    count = int(argv[0]) if argv else 100000
+    data = grid(count)
+    print '%d objects' % len(data)
+    print '%-12s %14s %14s %14s' % ('profile', 'batched/s', 'single/s', 'lookups/s')
+    for profile in sorted(osm.store.PROFILES):
+        print '%-12s %14.0f %14.0f %14.0f' % ((profile,) + run(profile, data))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+## Copyright 2010 Michael Larsen <mike.gh.larsen@gmail.com>
+##
+## This program is free software: you can redistribute it and/or modify  ##
+## it under the terms of the GNU General Public License as published by  ##
+## the Free Software Foundation, either version 3 of the License, or     ##
+## (at your option) any later version.                                   ##
+##                                                                       ##
+## This program is distributed in the hope that it will be useful,       ##
+## but WITHOUT ANY WARRANTY; without even the implied warranty of        ##
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         ##
+## GNU General Public License for more details.                          ##
+##                                                                       ##
+## You should have received a copy of the GNU General Public License     ##
+## along with this program.  If not, see <http://www.gnu.org/licenses/>. ##
+"""
+This module holds node positions in NumPy arrays, for geometric work over
+many nodes at once without building a Node object per row.
+
+This requires NumPy, which the rest of the osm package doesn't need.
+
+Members:
+NodeTable: a read-only table of node ids and positions.
+snapshot(): returns a NodeTable of every node in osm.store.
+distances(lat1, lon1, lat2, lon2): great circle distances between arrays of
+positions.
+"""
+
+import numpy
+import osm
+import osm.routing
+import osm.store
+
+# Rows read from the database at a time by snapshot.
+CHUNK_SIZE = 100000
+
+def _arcsin(x):
+    return numpy.arcsin(numpy.minimum(x, 1.0))
+
+def distances(lat1, lon1, lat2, lon2):
+    """
+    Returns an array of the great circle distances in km between the points
+    (lat1, lon1) and (lat2, lon2), in degrees, as osm.routing.distance. Any
+    of the arguments may be arrays (of matching shapes) or single values.
+    """
+    return osm.routing.distance(*[numpy.asarray(x, dtype = numpy.float64)
+                                  for x in (lat1, lon1, lat2, lon2)],
+                                sin = numpy.sin, cos = numpy.cos, asin = _arcsin,
+                                sqrt = numpy.sqrt)
+
+class NodeTable:
+    """
+    A read-only table of nodes: ids is a sorted array of node ids, and lat and
+    lon are arrays of their positions in the same order.
+    """
+    def __init__(self, ids, lat, lon):
+        """
+        Create a table from sequences of ids, lats and lons (in any order).
+        """
+        ids = numpy.asarray(ids, dtype = numpy.int64)
+        order = numpy.argsort(ids, kind = 'mergesort')
+        self.ids = ids[order]
+        self.lat = numpy.asarray(lat, dtype = numpy.float64)[order]
+        self.lon = numpy.asarray(lon, dtype = numpy.float64)[order]
+        for array in (self.ids, self.lat, self.lon):
+            array.flags.writeable = False
+
+    def __len__(self):
+        return len(self.ids)
+
+    def index(self, ids):
+        """
+        Returns an array of the positions in the table of the given ids (an
+        array or sequence), with -1 for those that aren't in it.
+        """
+        ids = numpy.asarray(ids, dtype = numpy.int64)
+        if not len(self.ids):
+            return numpy.zeros(ids.shape, dtype = numpy.intp) - 1
+        found = numpy.searchsorted(self.ids, ids)
+        found[found == len(self.ids)] = 0
+        return numpy.where(self.ids[found] == ids, found, -1)
+
+    def __contains__(self, id):
+        return self.index([id])[0] >= 0
+
+    def __getitem__(self, id):
+        """
+        Returns (lat, lon) of the node with the given id.
+        """
+        i = self.index([id])[0]
+        if i < 0:
+            raise KeyError(id)
+        return self.lat[i], self.lon[i]
+
+    def positions(self, ids):
+        """
+        Returns arrays (lat, lon) of the positions of the given ids, raising
+        KeyError if any of them aren't in the table.
+        """
+        found = self.index(ids)
+        if (found < 0).any():
+            raise KeyError(numpy.asarray(ids)[found < 0][0])
+        return self.lat[found], self.lon[found]
+
+    def bbox(self, minlat, maxlat, minlon, maxlon):
+        """
+        Returns a sorted array of the ids of the nodes inside the given
+        bounding box.
+        """
+        inside = ((self.lat >= minlat) & (self.lat <= maxlat) &
+                  (self.lon >= minlon) & (self.lon <= maxlon))
+        return self.ids[inside]
+
+    def distances(self, lat, lon, ids = None):
+        """
+        Returns an array of the distances in km from (lat, lon) to each node
+        in the table, or to each of ids if given.
+        """
+        if ids is None:
+            return distances(lat, lon, self.lat, self.lon)
+        lats, lons = self.positions(ids)
+        return distances(lat, lon, lats, lons)
+
+    def nearest(self, lat, lon):
+        """
+        Returns the id of the node nearest to (lat, lon), or None if the table
+        is empty.
+        """
+        if not len(self.ids):
+            return None
+        return int(self.ids[numpy.argmin(self.distances(lat, lon))])
+
+def snapshot():
+    """
+    Returns a NodeTable of the positions of all the nodes in osm.store, as
+    they are when it is called.
+    """
+    dtype = [('id', numpy.int64), ('lat', numpy.float64), ('lon', numpy.float64)]
+    cursor = osm.store.node_positions()
+    chunks = [numpy.zeros(0, dtype = dtype)]
+    while True:
+        rows = cursor.fetchmany(CHUNK_SIZE)
+        if not rows:
+            break
+        chunks.append(numpy.array(rows, dtype = dtype))
+    table = numpy.concatenate(chunks)
+    return NodeTable(table['id'], table['lat'], table['lon'])
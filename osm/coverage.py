@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+## Copyright 2010 Michael Larsen <mike.gh.larsen@gmail.com>
+##
+## This program is free software: you can redistribute it and/or modify  ##
+## it under the terms of the GNU General Public License as published by  ##
+## the Free Software Foundation, either version 3 of the License, or     ##
+## (at your option) any later version.                                   ##
+##                                                                       ##
+## This program is distributed in the hope that it will be useful,       ##
+## but WITHOUT ANY WARRANTY; without even the implied warranty of        ##
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         ##
+## GNU General Public License for more details.                          ##
+##                                                                       ##
+## You should have received a copy of the GNU General Public License     ##
+## along with this program.  If not, see <http://www.gnu.org/licenses/>. ##
+"""
+This module contains the rectangle arithmetic used to keep track of which
+parts of the map have been fetched.
+
+All boxes are tuples of (minlat, maxlat, minlon, maxlon), the same order used
+by osm.store and osm.fetch.map_get.
+"""
+
+# Pieces thinner than this (in degrees) are ignored, so that rounding in the
+# edges of neighbouring boxes doesn't produce slivers that need fetching.
+MIN_SIZE = 1e-7
+
+def intersects(a, b):
+    """
+    Returns true if boxes a and b overlap with a positive area.
+    """
+    return a[0] < b[1] and b[0] < a[1] and a[2] < b[3] and b[2] < a[3]
+
+def subtract(box, others):
+    """
+    Returns a list of non-overlapping boxes that together cover the parts of
+    box not covered by any of others.
+    """
+    pieces = [box]
+    for other in others:
+        remaining = []
+        for piece in pieces:
+            if not intersects(piece, other):
+                remaining.append(piece)
+                continue
+            minlat, maxlat, minlon, maxlon = piece
+            # Full-width strips below and above other, then the parts to its
+            # left and right between them.
+            if other[0] > minlat:
+                remaining.append((minlat, other[0], minlon, maxlon))
+                minlat = other[0]
+            if other[1] < maxlat:
+                remaining.append((other[1], maxlat, minlon, maxlon))
+                maxlat = other[1]
+            if other[2] > minlon:
+                remaining.append((minlat, maxlat, minlon, other[2]))
+            if other[3] < maxlon:
+                remaining.append((minlat, maxlat, other[3], maxlon))
+        pieces = [p for p in remaining
+                  if p[1] - p[0] > MIN_SIZE and p[3] - p[2] > MIN_SIZE]
+    return pieces
+
+def join(a, b):
+    """
+    Returns the box covering exactly a and b if they share a whole edge,
+    otherwise None.
+    """
+    if a[0] == b[0] and a[1] == b[1] and (a[3] == b[2] or b[3] == a[2]):
+        return (a[0], a[1], min(a[2], b[2]), max(a[3], b[3]))
+    if a[2] == b[2] and a[3] == b[3] and (a[1] == b[0] or b[1] == a[0]):
+        return (min(a[0], b[0]), max(a[1], b[1]), a[2], a[3])
+    return None
+
+def merge(boxes):
+    """
+    Returns a list of the given non-overlapping boxes with every pair that
+    shares a whole edge joined together, repeatedly.
+    """
+    merged = []
+    for box in boxes:
+        i = 0
+        while i < len(merged):
+            joined = join(box, merged[i])
+            if joined:
+                box = joined
+                del merged[i]
+                i = 0
+            else:
+                i += 1
+        merged.append(box)
+    return merged
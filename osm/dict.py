@@ -19,40 +19,160 @@ The osm.dict module provides the actual interface that is exposed in the osm
 module.
 """
 
+from __future__ import with_statement
 import collections
+import threading
+import osm
+import osm.node
+import osm.way
+import osm.relation
 import osm.store
 import osm.fetch
 
 MAP_SIZE = 0.0075
 MAP_THRESHOLD = 0.25 
 
+class LRUCache:
+    """
+    A mapping of at most size entries. When it is full, adding an entry
+    evicts the one that was used least recently.
+    hits and misses count the outcomes of get.
+    It is safe to use from several threads at once.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Returns the value cached for key, raising KeyError if there isn't one.
+        """
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                raise
+            self.entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """
+        Caches value for key.
+        """
+        if self.size <= 0:
+            return
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            if len(self.entries) > self.size:
+                self.entries.popitem(last = False)
+
+    def invalidate(self, key = None):
+        """
+        Drops the entry for key, or every entry if key is None.
+        """
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+
+    def __len__(self):
+        return len(self.entries)
+
 class OSMDict(collections.Mapping):
     """
     Generic dictionary based on pluggable functions.
+    Looked up values are kept in an LRUCache, cache, until osm.store writes
+    a replacement for them (see stored).
     """
-    def __init__(self, retrieve, fetch, count, contains, iter):
+    def __init__(self, retrieve, fetch, count, contains, iter, cache_size = 0,
+                 retrieve_many = None, fetch_many = None):
         """
         contains: should only return true if the data is locally stored.
         retrieve: should get the data from local sources.
         fetch: should go to the remote sources and cache.
         count: should return the number of local objects.
         iter: should return an iterator over all the
+        cache_size: the number of values to keep in memory.
+        retrieve_many: optional, like retrieve but takes a list of items and
+        returns a dict of the ones it found.
+        fetch_many: optional, like fetch but takes a list of items and returns
+        a dict of the ones it found.
         """
         self.retrieve = retrieve
         self.fetch = fetch
         self.count = count
         self.contains = contains
         self.iter = iter
+        self.retrieve_many = retrieve_many
+        self.fetch_many = fetch_many
+        self.cache = LRUCache(cache_size)
+        osm.store.add_store_listener(self.stored)
 
     def __getitem__(self, item):
         """
         get the value associated with item.
-        first tries retrieve, and then fetch.
+        first tries the cache, then retrieve, and then fetch.
         """
         try:
-            return self.retrieve(item)
+            return self.cache.get(item)
+        except KeyError:
+            pass
+        try:
+            value = self.retrieve(item)
         except:
-            return self.fetch(item)
+            value = self.fetch(item)
+        if value is not None:
+            self.cache.put(item, value)
+        return value
+
+    def get_many(self, items):
+        """
+        get the values associated with all of items at once.
+        first tries the cache, then a single retrieve_many for everything
+        missing from it, and then a single fetch_many for what is left (falling
+        back to one lookup per item where those aren't available).
+        Returns a dict of {item:value} for the items that were found.
+        """
+        found = dict()
+        missing = []
+        for item in items:
+            try:
+                found[item] = self.cache.get(item)
+            except KeyError:
+                missing.append(item)
+        if missing and self.retrieve_many and self.fetch_many:
+            values = self.retrieve_many(missing)
+            missing = [item for item in missing if item not in values]
+            if missing:
+                values.update(self.fetch_many(missing))
+        else:
+            values = dict()
+            for item in missing:
+                try:
+                    value = self[item]
+                except KeyError:
+                    continue
+                if value is not None:
+                    values[item] = value
+        for item, value in values.iteritems():
+            self.cache.put(item, value)
+        found.update(values)
+        return found
+
+    def stored(self, dataList):
+        """
+        Called by osm.store with the objects it has just written. Drops the
+        cache entries they replace.
+        Subclasses need to override this.
+        """
+        pass
 
     def __len__(self):
         """returns number of locally stored objects. uses count."""
@@ -72,19 +192,31 @@ class NodeDict(OSMDict):
 
     internally uses:
     retrieve: osm.store.node_retrieve
-    fetch: osm.fetch.node_fetch
+    fetch: osm.fetch.node_coalescer.get
     count: osm.store.node_count
     contain: osm.store.node_exists
     iter: osm.store.node_iter
+    retrieve_many: osm.store.node_retrieve_many
+    fetch_many: osm.fetch.nodes_fetch
 
     """
     def __init__(self):
         retr = osm.store.node_retrieve
-        fetch = osm.fetch.node_fetch
+        fetch = osm.fetch.node_coalescer.get
         count = osm.store.node_count
         contain = osm.store.node_exists
         iter = osm.store.node_iter
-        OSMDict.__init__(self, retr, fetch, count, contain, iter)
+        size = osm.config.getint('osm', 'node-cache-size')
+        OSMDict.__init__(self, retr, fetch, count, contain, iter, size,
+                         osm.store.node_retrieve_many, osm.fetch.nodes_fetch)
+
+    def stored(self, dataList):
+        """
+        Drops the cached Nodes that have been written again.
+        """
+        for item in dataList:
+            if isinstance(item, osm.node.Node):
+                self.cache.invalidate(item.id)
 
 class WayDict(OSMDict):
     """
@@ -92,19 +224,31 @@ class WayDict(OSMDict):
 
     internally uses:
     retrieve: osm.store.way_retrieve
-    fetch: osm.fetch.way_fetch
+    fetch: osm.fetch.way_coalescer.get
     count: osm.store.way_count
     contain: osm.store.way_exists
     iter: osm.store.way_iter
+    retrieve_many: osm.store.way_retrieve_many
+    fetch_many: osm.fetch.ways_fetch
 
     """
     def __init__(self):
         retr = osm.store.way_retrieve
-        fetch = osm.fetch.way_fetch
+        fetch = osm.fetch.way_coalescer.get
         count = osm.store.way_count
         contain = osm.store.way_exists
         iter = osm.store.way_iter
-        OSMDict.__init__(self, retr, fetch, count, contain, iter)
+        size = osm.config.getint('osm', 'way-cache-size')
+        OSMDict.__init__(self, retr, fetch, count, contain, iter, size,
+                         osm.store.way_retrieve_many, osm.fetch.ways_fetch)
+
+    def stored(self, dataList):
+        """
+        Drops the cached Ways that have been written again.
+        """
+        for item in dataList:
+            if isinstance(item, osm.way.Way):
+                self.cache.invalidate(item.id)
 
 def id_to_node(id):
     try:
@@ -116,9 +260,9 @@ def node_way_fetch(id):
     node = id_to_node(id)
     if osm.store.map_node_close(id, MAP_SIZE * MAP_THRESHOLD):
         return osm.fetch.node_way_fetch(id)
-    osm.fetch.map_get(node.lat - MAP_SIZE / 2, node.lat + MAP_SIZE / 2, node.lon - MAP_SIZE / 2, node.lon + MAP_SIZE / 2)
+    osm.fetch.map_fetch(node.lat - MAP_SIZE / 2, node.lat + MAP_SIZE / 2, node.lon - MAP_SIZE / 2, node.lon + MAP_SIZE / 2)
     try:
-        osm.store.node_way_retrieve(id)
+        return osm.store.node_way_retrieve(id)
     except:
         raise KeyError
 
@@ -140,7 +284,18 @@ class NodeWayDict(OSMDict):
         count = osm.store.map_node_count
         contain = osm.store.map_node_exists
         iter = osm.store.node_way_iter
-        OSMDict.__init__(self, retr, fetch, count, contain, iter)
+        size = osm.config.getint('osm', 'node-way-cache-size')
+        OSMDict.__init__(self, retr, fetch, count, contain, iter, size)
+
+    def stored(self, dataList):
+        """
+        Drops the whole cache when any Way is written, since it may have
+        gained or lost nodes.
+        """
+        for item in dataList:
+            if isinstance(item, osm.way.Way):
+                self.cache.invalidate()
+                return
 
 class RelationDict(OSMDict):
     """
@@ -148,17 +303,29 @@ class RelationDict(OSMDict):
 
     internally uses:
     retrieve: osm.store.relation_retrieve
-    fetch: osm.fetch.relation_fetch
+    fetch: osm.fetch.relation_coalescer.get
     count: osm.store.relation_count
     contain: osm.store.relation_exists
     iter: osm.store.relation_iter
+    retrieve_many: osm.store.relation_retrieve_many
+    fetch_many: osm.fetch.relations_fetch
 
     """
     def __init__(self):
         retr = osm.store.relation_retrieve
-        fetch = osm.fetch.relation_fetch
+        fetch = osm.fetch.relation_coalescer.get
         count = osm.store.relation_count
         contain = osm.store.relation_exists
         iter = osm.store.relation_iter
-        OSMDict.__init__(self, retr, fetch, count, contain, iter)
+        size = osm.config.getint('osm', 'relation-cache-size')
+        OSMDict.__init__(self, retr, fetch, count, contain, iter, size,
+                         osm.store.relation_retrieve_many, osm.fetch.relations_fetch)
+
+    def stored(self, dataList):
+        """
+        Drops the cached Relations that have been written again.
+        """
+        for item in dataList:
+            if isinstance(item, osm.relation.Relation):
+                self.cache.invalidate(item.id)
 
@@ -21,10 +21,33 @@ By default fetching is done from www.openstreetmap.org with api version 0.6.
 Currently, Debug is enabled by default (and configuration isn't really
 implemented very flexibly, so you'll have to edit it here or override on each
 call.
+
+Misses from osm.nodes, osm.ways and osm.relations go through Coalescers, which
+merge the single-id fetches made by concurrent threads within
+osm.config's fetch-window seconds of each other into one multi-fetch request.
+
+Requests are made over pooled keep-alive connections (at most http-pool-size
+per server), ask for gzip/deflate compressed responses, time out after
+http-timeout seconds and are retried up to http-retries times, with
+exponential backoff starting at http-backoff seconds, on connection errors and
+on transient server errors.
 """
 
-from urllib2 import urlopen
-from xml.dom.minidom import parse
+from __future__ import with_statement
+from urllib2 import HTTPError
+from urlparse import urljoin, urlsplit
+from StringIO import StringIO
+import atexit
+import httplib
+import socket
+import threading
+import time
+import zlib
+try:
+    from xml.etree.cElementTree import iterparse
+except ImportError:
+    from xml.etree.ElementTree import iterparse
+import osm
 import osm.node
 import osm.way
 import osm.relation
@@ -34,40 +57,91 @@ DEBUG = True
 DEFAULT_SERVER = "www.openstreetmap.org"
 DEFAULT_API = "0.6"
 
-def extract_data(document):
+# The most ids to ask for in a single multi-fetch request.
+MULTI_FETCH_SIZE = 200
+
+# Maps the top-level osm xml element names to the classes built from them.
+_element_types = {'node': osm.node.Node,
+                  'way': osm.way.Way,
+                  'relation': osm.relation.Relation}
+
+def iter_data(source, bounds = None):
     """
-    This function extracts the appropriate node, way, and relation objects from
-    the supplied xml.minidom document element. It returns a list consisting of
-    these objects.
+    This function incrementally parses the osm xml in source (a filename or
+    file-like object) and yields the appropriate node, way, and relation
+    objects one at a time, in document order. Each element is discarded as
+    soon as its object has been built, so memory use stays flat no matter how
+    large the document is.
+    If bounds is given, the (minlat, maxlat, minlon, maxlon) of each <bounds>
+    (or osmosis-style <bound>) element in the document is appended to it.
     """
-    osm_node = document.documentElement
-    assert osm_node.tagName == u'osm'
+    context = iterparse(source, events=('start', 'end'))
+    event, root = context.next()
+    assert root.tag == 'osm'
+    for event, element in context:
+        if event != 'end':
+            continue
+        if element.tag in _element_types:
+            if element.get('visible') != 'false':
+                yield _element_types[element.tag](element)
+            root.clear()
+        elif element.tag == 'bounds' and bounds is not None:
+            bounds.append(tuple(float(element.get(key))
+                                for key in ('minlat', 'maxlat', 'minlon', 'maxlon')))
+        elif element.tag == 'bound' and bounds is not None:
+            minlat, minlon, maxlat, maxlon = map(float, element.get('box').split(','))
+            bounds.append((minlat, maxlat, minlon, maxlon))
 
-    nodes = [osm.node.Node(e) for e in osm_node.getElementsByTagName("node")]
-    ways = [osm.way.Way(e) for e in osm_node.getElementsByTagName("way")]
-    relations = [osm.relation.Relation(e) for e in 
-                   osm_node.getElementsByTagName("relation")]
-    return nodes + ways + relations
+def extract_data(source):
+    """
+    This function extracts the appropriate node, way, and relation objects from
+    the osm xml in source (a filename or file-like object). It returns a list
+    consisting of these objects.
+    """
+    return list(iter_data(source))
 
 def map_get(minLat, maxLat, minLon, maxLon, server = DEFAULT_SERVER, api = DEFAULT_API):
     """
     Gets all map data inside the box defined by the parameters from the
     designated server and api.
     """
-    doc = fetch("map?bbox=%(minLon)s,%(minLat)s,%(maxLon)s,%(maxLat)s" % locals(),
-                server, api)
-    osm.store.map_store(minLat, maxLat, minLon, maxLon)
-    data = extract_data(doc)
+    data = map_download(minLat, maxLat, minLon, maxLon, server, api)
     osm.store.data_store(data)
+    osm.store.map_store(minLat, maxLat, minLon, maxLon)
     return data
 
+def map_download(minLat, maxLat, minLon, maxLon, server = DEFAULT_SERVER, api = DEFAULT_API):
+    """
+    Gets all map data inside the box defined by the parameters from the
+    designated server and api, without caching it. This doesn't touch the
+    database, so it is safe to call from any thread.
+    Returns a list containing all the data returned by the server.
+    """
+    doc = fetch("map?bbox=%(minLon)s,%(minLat)s,%(maxLon)s,%(maxLat)s" % locals(),
+                server, api)
+    return extract_data(doc)
+
+def map_fetch(minLat, maxLat, minLon, maxLon, server = DEFAULT_SERVER, api = DEFAULT_API):
+    """
+    Makes sure all map data inside the box defined by the parameters is cached,
+    getting the parts of it that haven't been fetched before from the
+    designated server and api.
+    Unlike map_get, the parsed objects are streamed straight into the cache
+    and are not kept, so this should be preferred when they aren't needed.
+    """
+    for minLat, maxLat, minLon, maxLon in osm.store.map_uncovered(minLat, maxLat, minLon, maxLon):
+        doc = fetch("map?bbox=%(minLon)s,%(minLat)s,%(maxLon)s,%(maxLat)s" % locals(),
+                    server, api)
+        osm.store.data_store(iter_data(doc))
+        osm.store.map_store(minLat, maxLat, minLon, maxLon)
+
 def relation_get(id, server = DEFAULT_SERVER, api = DEFAULT_API):
     """
     Executes a query for the specified relation.
     Returns a list containing all the data returned by the server (presumably
     just the relation).
     """
-    doc = fetch("relation/%(id)s" % locals(), DEFAULT_SERVER, DEFAULT_API)
+    doc = fetch("relation/%(id)s" % locals(), server, api)
     return extract_data(doc)
 
 def relation_fetch(id, server = DEFAULT_SERVER, api = DEFAULT_API):
@@ -82,13 +156,32 @@ def relation_fetch(id, server = DEFAULT_SERVER, api = DEFAULT_API):
         if isinstance(d, osm.relation.Relation) and d.id == id:
             return d
 
+def relation_full_get(id, server = DEFAULT_SERVER, api = DEFAULT_API):
+    """
+    Executes a query for the specified relation along with all of its members
+    (and the nodes of its member ways).
+    Returns a list containing all the data returned by the server.
+    """
+    doc = fetch("relation/%(id)s/full" % locals(), server, api)
+    return extract_data(doc)
+
+def relation_full_fetch(id, server = DEFAULT_SERVER, api = DEFAULT_API):
+    """
+    Executes a query for the specified relation and all of its members, and
+    caches all data from the response.
+    Returns the requested relation object.
+    """
+    data = relation_full_get(id, server, api)
+    osm.store.data_store(data)
+    return _requested(data, osm.relation.Relation, [id]).get(id)
+
 def way_get(id, server = DEFAULT_SERVER, api = DEFAULT_API):
     """
     Executes a query for the specified way.
     Returns a list containing all the data returned by the server (presumably
     just the way).
     """
-    doc = fetch("way/%(id)s" % locals(), DEFAULT_SERVER, DEFAULT_API)
+    doc = fetch("way/%(id)s" % locals(), server, api)
     return extract_data(doc)
 
 def way_fetch(id, server = DEFAULT_SERVER, api = DEFAULT_API):
@@ -103,13 +196,31 @@ def way_fetch(id, server = DEFAULT_SERVER, api = DEFAULT_API):
         if isinstance(d, osm.way.Way) and d.id == id:
             return d
 
+def way_full_get(id, server = DEFAULT_SERVER, api = DEFAULT_API):
+    """
+    Executes a query for the specified way along with all of its nodes.
+    Returns a list containing all the data returned by the server.
+    """
+    doc = fetch("way/%(id)s/full" % locals(), server, api)
+    return extract_data(doc)
+
+def way_full_fetch(id, server = DEFAULT_SERVER, api = DEFAULT_API):
+    """
+    Executes a query for the specified way and all of its nodes, and caches
+    all data from the response.
+    Returns the requested way object.
+    """
+    data = way_full_get(id, server, api)
+    osm.store.data_store(data)
+    return _requested(data, osm.way.Way, [id]).get(id)
+
 def node_get(id, server = DEFAULT_SERVER, api = DEFAULT_API):
     """
     Executes a query for the specified node.
     Returns a list containing all the data returned by the server (presumably
     just the node).
     """
-    doc = fetch("node/%(id)s" % locals(), DEFAULT_SERVER, DEFAULT_API)
+    doc = fetch("node/%(id)s" % locals(), server, api)
     return extract_data(doc)
 
 def node_fetch(id, server = DEFAULT_SERVER, api = DEFAULT_API):
@@ -130,27 +241,354 @@ def node_way_get(id, server = DEFAULT_SERVER, api = DEFAULT_API):
     Returns a list containing all the data returned by the server (presumably
     just the ways).
     """
-    doc = fetch("node/%(id)s/ways"% locals(), DEFAULT_SERVER, DEFAULT_API)
+    doc = fetch("node/%(id)s/ways"% locals(), server, api)
     return extract_data(doc)
 
 def node_way_fetch(id, server = DEFAULT_SERVER, api = DEFAULT_API):
     """
     Executes a query for all ways that include the specified node, and caches
     the response.
-    Returns the requested way objects.
+    Returns a list of the ids of the ways.
     """
     data = node_way_get(id, server, api)
     osm.store.data_store(data)
-    return (d.id for d in data if isinstance(d, osm.way.Way))
+    return [d.id for d in data if isinstance(d, osm.way.Way)]
+
+def _multi_get(kind, ids, server, api):
+    """
+    Executes multi-fetch queries ("nodes?nodes=1,2,...") of kind for the given
+    ids, MULTI_FETCH_SIZE ids at a time. The server refuses the whole request
+    if any of the ids is missing, so a refused request is split in two and
+    retried until the missing ids are isolated (and skipped).
+    Returns a list containing all the data returned by the server.
+    """
+    ids = sorted(set(ids))
+    pending = [ids[i:i + MULTI_FETCH_SIZE] for i in xrange(0, len(ids), MULTI_FETCH_SIZE)]
+    data = []
+    while pending:
+        chunk = pending.pop()
+        idStr = ','.join(str(id) for id in chunk)
+        try:
+            doc = fetch("%(kind)s?%(kind)s=%(idStr)s" % locals(), server, api)
+        except HTTPError, e:
+            if e.code not in (404, 410):
+                raise
+            if len(chunk) > 1:
+                pending += [chunk[:len(chunk) / 2], chunk[len(chunk) / 2:]]
+            continue
+        data.extend(iter_data(doc))
+    return data
+
+def _requested(data, cls, ids):
+    """
+    Returns a dict of {id:object} for the objects of class cls in data whose
+    ids are in ids.
+    """
+    ids = set(ids)
+    return dict((d.id, d) for d in data if isinstance(d, cls) and d.id in ids)
+
+def nodes_get(ids, server = DEFAULT_SERVER, api = DEFAULT_API):
+    """
+    Executes multi-fetch queries for the specified nodes.
+    Returns a list containing all the data returned by the server.
+    """
+    return _multi_get("nodes", ids, server, api)
+
+def nodes_fetch(ids, server = DEFAULT_SERVER, api = DEFAULT_API):
+    """
+    Executes multi-fetch queries for the specified nodes, and caches all data
+    from the responses.
+    Returns a dict of {id:Node} for the requested nodes that were found.
+    """
+    data = nodes_get(ids, server, api)
+    osm.store.data_store(data)
+    return _requested(data, osm.node.Node, ids)
+
+def ways_get(ids, server = DEFAULT_SERVER, api = DEFAULT_API):
+    """
+    Executes multi-fetch queries for the specified ways.
+    Returns a list containing all the data returned by the server.
+    """
+    return _multi_get("ways", ids, server, api)
+
+def ways_fetch(ids, server = DEFAULT_SERVER, api = DEFAULT_API):
+    """
+    Executes multi-fetch queries for the specified ways, and caches all data
+    from the responses.
+    Returns a dict of {id:Way} for the requested ways that were found.
+    """
+    data = ways_get(ids, server, api)
+    osm.store.data_store(data)
+    return _requested(data, osm.way.Way, ids)
+
+def relations_get(ids, server = DEFAULT_SERVER, api = DEFAULT_API):
+    """
+    Executes multi-fetch queries for the specified relations.
+    Returns a list containing all the data returned by the server.
+    """
+    return _multi_get("relations", ids, server, api)
+
+def relations_fetch(ids, server = DEFAULT_SERVER, api = DEFAULT_API):
+    """
+    Executes multi-fetch queries for the specified relations, and caches all
+    data from the responses.
+    Returns a dict of {id:Relation} for the requested relations that were found.
+    """
+    data = relations_get(ids, server, api)
+    osm.store.data_store(data)
+    return _requested(data, osm.relation.Relation, ids)
+
+class Coalescer:
+    """
+    Merges single-id fetches made by concurrent threads into multi-fetches.
+    A thread asking for an id while no fetch is in flight fetches it
+    straight away, so serial lookups aren't delayed. Otherwise the first
+    thread to ask waits window seconds for others to join its batch, then
+    fetches the whole batch with one call to fetch_many (e.g. nodes_fetch).
+    Threads asking for an id that is already being fetched just wait for
+    that fetch.
+    """
+    class Batch:
+        """
+        A set of ids being fetched together, and the outcome.
+        """
+        def __init__(self):
+            self.ids = set()
+            self.done = threading.Event()
+            self.results = dict()
+            self.error = None
+
+    def __init__(self, fetch_many, window):
+        self.fetch_many = fetch_many
+        self.window = window
+        self.lock = threading.Lock()
+        self.pending = None
+        self.inflight = dict()
+
+    def get(self, id):
+        """
+        Returns the object with the given id, or None if it wasn't found.
+        """
+        with self.lock:
+            batch = self.inflight.get(id) or self.pending
+            leader = batch is None
+            if leader:
+                batch = self.pending = Coalescer.Batch()
+                # Other threads are fetching, so more may be about to ask.
+                wait = len(self.inflight) > 0
+            batch.ids.add(id)
+        if leader:
+            self._run(batch, wait)
+        else:
+            batch.done.wait()
+        if batch.error:
+            raise batch.error
+        return batch.results.get(id)
+
+    def _run(self, batch, wait):
+        """
+        Collects ids into batch for window seconds if wait is true, and then
+        fetches them.
+        """
+        if wait and self.window > 0:
+            time.sleep(self.window)
+        with self.lock:
+            self.pending = None
+            for id in batch.ids:
+                self.inflight[id] = batch
+        try:
+            batch.results = self.fetch_many(batch.ids)
+        except Exception, e:
+            batch.error = e
+        with self.lock:
+            for id in batch.ids:
+                del self.inflight[id]
+        batch.done.set()
+
+FETCH_WINDOW = osm.config.getfloat('osm', 'fetch-window')
+
+node_coalescer = Coalescer(nodes_fetch, FETCH_WINDOW)
+way_coalescer = Coalescer(ways_fetch, FETCH_WINDOW)
+relation_coalescer = Coalescer(relations_fetch, FETCH_WINDOW)
+
+HTTP_POOL_SIZE = osm.config.getint('osm', 'http-pool-size')
+HTTP_TIMEOUT = osm.config.getfloat('osm', 'http-timeout')
+HTTP_RETRIES = osm.config.getint('osm', 'http-retries')
+HTTP_BACKOFF = osm.config.getfloat('osm', 'http-backoff')
+
+# Statuses worth retrying a request for.
+_TRANSIENT_STATUSES = (429, 500, 502, 503, 504)
+
+# The most redirects followed for one request.
+_MAX_REDIRECTS = 5
+
+class _ConnectionPool:
+    """
+    A pool of keep-alive connections to one server, holding at most size
+    connections (idle or in use) at once.
+    """
+    def __init__(self, scheme, host, size):
+        if scheme == 'https':
+            self.connection_class = httplib.HTTPSConnection
+        else:
+            self.connection_class = httplib.HTTPConnection
+        self.host = host
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def get(self):
+        """
+        Returns an idle connection, or a new one, waiting for one to be put
+        back if the pool is full.
+        """
+        self.slots.acquire()
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        return self.connection_class(self.host, timeout = HTTP_TIMEOUT)
+
+    def put(self, connection, reusable = True):
+        """
+        Returns connection to the pool, closing it first unless reusable.
+        """
+        if reusable:
+            with self.lock:
+                self.idle.append(connection)
+        else:
+            connection.close()
+        self.slots.release()
+
+    def close(self):
+        """
+        Closes the idle connections.
+        """
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection in idle:
+            connection.close()
+
+_pools = dict()
+_pools_lock = threading.Lock()
+
+def _pool(scheme, host):
+    """
+    Returns the connection pool for host.
+    """
+    with _pools_lock:
+        if (scheme, host) not in _pools:
+            _pools[(scheme, host)] = _ConnectionPool(scheme, host, HTTP_POOL_SIZE)
+        return _pools[(scheme, host)]
+
+def close_connections():
+    """
+    Closes all idle pooled connections (done automatically at exit).
+    """
+    with _pools_lock:
+        pools = _pools.values()
+    for pool in pools:
+        pool.close()
+
+atexit.register(close_connections)
+
+class _Response:
+    """
+    File-like body of a server response, decompressed according to its
+    Content-Encoding. The connection goes back to its pool once the body has
+    been read to the end (or the response is closed).
+    """
+    def __init__(self, response, connection, pool):
+        self.response = response
+        self.connection = connection
+        self.pool = pool
+        self.decoder = None
+        if response.getheader('content-encoding', '').lower() in ('gzip', 'deflate'):
+            # 32 + MAX_WBITS accepts both gzip and zlib headers.
+            self.decoder = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        self.buffer = ''
+        self.eof = False
+
+    def read(self, size = -1):
+        """
+        Read up to size bytes of the body (all of it if size is negative).
+        """
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            chunk = self.response.read(max(size, 16384))
+            if self.decoder:
+                self.buffer += self.decoder.decompress(chunk)
+            else:
+                self.buffer += chunk
+            if not chunk:
+                if self.decoder:
+                    self.buffer += self.decoder.flush()
+                self.eof = True
+                self.close()
+        if size < 0:
+            size = len(self.buffer)
+        data = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return data
+
+    def close(self):
+        """
+        Give the connection back to the pool. It is only kept open if the body
+        was read to the end and the server didn't ask to close it.
+        """
+        if self.connection:
+            self.pool.put(self.connection, self.eof and not self.response.will_close)
+            self.connection = None
+
+    def __del__(self):
+        self.close()
+
+def _request(url):
+    """
+    GET url once, following redirects.
+    Returns (response, connection, pool), where response is the
+    httplib.HTTPResponse whose body still has to be read.
+    """
+    for i in xrange(_MAX_REDIRECTS + 1):
+        scheme, host, path, query, fragment = urlsplit(url)
+        if query:
+            path += '?' + query
+        pool = _pool(scheme, host)
+        connection = pool.get()
+        try:
+            connection.request('GET', path, headers = {'Accept-Encoding':'gzip, deflate'})
+            response = connection.getresponse()
+        except:
+            pool.put(connection, False)
+            raise
+        if response.status not in (301, 302, 303, 307, 308):
+            return response, connection, pool
+        response.read()
+        pool.put(connection, not response.will_close)
+        url = urljoin(url, response.getheader('location'))
+    raise HTTPError(url, response.status, 'Too many redirects', response.msg, None)
 
 def fetch(methodStr, server = DEFAULT_SERVER, api = DEFAULT_API):
     """
     Execute a query to given server at the specified api version.
-    Returns the server response parsed by xml.minidom.
+    Returns the (unparsed) server response as a file-like object, ready to be
+    handed to iter_data or extract_data.
+    Raises urllib2.HTTPError if the server responds with an error.
     """
+    url = "http://%(server)s/api/%(api)s/%(methodStr)s" % locals()
     if DEBUG:
-        print "fetching http://%(server)s/api/%(api)s/%(methodStr)s" % locals()
-    results = urlopen("http://%(server)s/api/%(api)s/%(methodStr)s" % locals())
-
-    return parse(results)
-
+        print "fetching %(url)s" % locals()
+    for attempt in xrange(HTTP_RETRIES + 1):
+        retry = attempt < HTTP_RETRIES
+        try:
+            response, connection, pool = _request(url)
+        except (socket.error, httplib.HTTPException):
+            if not retry:
+                raise
+        else:
+            body = _Response(response, connection, pool)
+            if response.status == 200:
+                return body
+            data = body.read()
+            if not retry or response.status not in _TRANSIENT_STATUSES:
+                raise HTTPError(url, response.status, response.reason, response.msg,
+                                StringIO(data))
+        time.sleep(HTTP_BACKOFF * 2 ** attempt)
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+
+## Copyright 2010 Michael Larsen <mike.gh.larsen@gmail.com>
+##
+## This program is free software: you can redistribute it and/or modify  ##
+## it under the terms of the GNU General Public License as published by  ##
+## the Free Software Foundation, either version 3 of the License, or     ##
+## (at your option) any later version.                                   ##
+##                                                                       ##
+## This program is distributed in the hope that it will be useful,       ##
+## but WITHOUT ANY WARRANTY; without even the implied warranty of        ##
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         ##
+## GNU General Public License for more details.                          ##
+##                                                                       ##
+## You should have received a copy of the GNU General Public License     ##
+## along with this program.  If not, see <http://www.gnu.org/licenses/>. ##
+"""
+This module compiles the cached ways into a routing graph file, which
+routing processes map into memory instead of rebuilding the graph from the
+database. The pages of the file are shared by every process that maps it.
+
+The graph has a node for each node on a way, and an edge in each direction
+between consecutive nodes of a way. It is stored in compressed sparse row
+form: the edges leaving node i are those from offsets[i] up to
+offsets[i + 1], with the index of the node they lead to in targets, their
+length (in km) in lengths, and the way they follow in way_ids.
+
+The file starts with a HEADER_SIZE byte header, holding the format version,
+the node and edge counts, the osm.store generation the graph was built from
+and the time it was built, followed by the arrays (little-endian, each
+starting on an 8 byte boundary): ids, lat, lon, offsets, targets, lengths,
+way_ids.
+
+This requires NumPy. Build a graph with:
+    python -m osm.graph [filename]
+"""
+
+from array import array
+from heapq import heappush, heappop
+import mmap
+import os
+import struct
+import sys
+import time
+import numpy
+import osm
+import osm.columnar
+import osm.store
+import osm.way
+
+MAGIC = 'OSMG'
+FORMAT_VERSION = 1
+HEADER_SIZE = 64
+
+INFINITY = float('inf')
+
+# magic, format version, node count, edge count, generation, build time
+_header = struct.Struct('<4sIQQqd')
+
+# The arrays in the file, in order, as (name, dtype, length in nodes or edges
+# (or a tuple of both for their product) plus any extra entries).
+_arrays = (('ids', '<i8', 'nodes', 0), ('lat', '<f8', 'nodes', 0),
+           ('lon', '<f8', 'nodes', 0), ('offsets', '<i8', 'nodes', 1),
+           ('targets', '<i4', 'edges', 0), ('lengths', '<f8', 'edges', 0),
+           ('way_ids', '<i8', 'edges', 0))
+
+def default_filename():
+    """
+    Returns the name of the graph file kept next to the database (the
+    db-filename option with .graph appended).
+    """
+    return osm.config.get('osm', 'db-filename') + '.graph'
+
+def _count(counts, count):
+    """
+    Returns the length of an array given its count in an _arrays entry:
+    'nodes', 'edges', or a tuple of them for their product.
+    """
+    if isinstance(count, tuple):
+        return reduce(lambda x, y: x * y, [counts[c] for c in count])
+    return counts[count]
+
+def _map(filename, magic, version, arrays):
+    """
+    Map the file filename, checking that it starts with a header with the
+    given magic and version, and wrap the arrays it holds (given as
+    _arrays is) with NumPy arrays over its pages.
+    Returns (mmap, generation, build time, {name: array}).
+    """
+    f = open(filename, 'rb')
+    try:
+        data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    finally:
+        f.close()
+    header = _header.unpack_from(data[:_header.size])
+    if header[:2] != (magic, version):
+        data.close()
+        raise ValueError('%s is not a version %d %s file' % (filename, version, magic))
+    counts = {'nodes':header[2], 'edges':header[3]}
+    offset = HEADER_SIZE
+    mapped = {}
+    for name, dtype, count, extra in arrays:
+        count = _count(counts, count) + extra
+        mapped[name] = numpy.frombuffer(data, dtype, count, offset)
+        offset += -(-count * numpy.dtype(dtype).itemsize // 8) * 8
+    return data, header[4], header[5], mapped
+
+def _write(filename, magic, version, generation, arrays, data):
+    """
+    Write the arrays in data ({name: array}, laid out as given by arrays, in
+    the form of _arrays) to filename behind a header with the given magic,
+    version and generation. The file is written under a temporary name and
+    then moved into place, so processes mapping the old one are unaffected.
+    """
+    counts = {'nodes':len(data[arrays[0][0]]), 'edges':0}
+    for name, dtype, count, extra in arrays:
+        if count == 'edges':
+            counts['edges'] = len(data[name])
+    temporary = filename + '.tmp'
+    f = open(temporary, 'wb')
+    try:
+        f.write(_header.pack(magic, version, counts['nodes'], counts['edges'],
+                             generation, time.time()).ljust(HEADER_SIZE, '\0'))
+        for name, dtype, count, extra in arrays:
+            array = numpy.ascontiguousarray(data[name], dtype = dtype).tostring()
+            f.write(array + '\0' * (-len(array) % 8))
+    finally:
+        f.close()
+    # rename replaces filename atomically, so it is never missing.
+    os.rename(temporary, filename)
+
+class Graph:
+    """
+    A routing graph mapped from a file (see load).
+    ids, lat, lon, offsets, targets, lengths and way_ids are read-only NumPy
+    arrays over the file's pages, as described in the module. generation and
+    built are the osm.store generation and the time it was built from.
+    """
+    def __init__(self, filename):
+        self.map, self.generation, self.built, arrays = _map(filename, MAGIC,
+                                                             FORMAT_VERSION, _arrays)
+        for name, array in arrays.iteritems():
+            setattr(self, name, array)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def index(self, id):
+        """
+        Returns the index of the node with the given id, raising KeyError if
+        it isn't in the graph.
+        """
+        i = numpy.searchsorted(self.ids, id)
+        if i == len(self.ids) or self.ids[i] != id:
+            raise KeyError(id)
+        return int(i)
+
+    def __contains__(self, id):
+        try:
+            self.index(id)
+        except KeyError:
+            return False
+        return True
+
+    def indexes(self, ids):
+        """
+        Returns an array of the indexes of the nodes with the given ids (an
+        array or sequence), with -1 for those that aren't in the graph.
+        """
+        ids = numpy.asarray(ids, dtype = numpy.int64)
+        if not len(self.ids):
+            return numpy.zeros(ids.shape, dtype = numpy.intp) - 1
+        found = numpy.searchsorted(self.ids, ids)
+        found[found == len(self.ids)] = 0
+        return numpy.where(self.ids[found] == ids, found, -1)
+
+    def distances_from(self, source, targets):
+        """
+        Returns a list of the distances in km from the node with index source
+        to each of the node indexes targets (inf where there is no path), by
+        Dijkstra's algorithm. The search stops once every target is settled.
+        """
+        offsets, edges, lengths = self.offsets, self.targets, self.lengths
+        best = {source: 0.0}
+        settled = set()
+        remaining = set(targets)
+        frontier = [(0.0, source)]
+        while frontier and remaining:
+            dist, v = heappop(frontier)
+            if v in settled:
+                continue
+            settled.add(v)
+            remaining.discard(v)
+            start, end = offsets[v], offsets[v + 1]
+            for u, length in zip(edges[start:end].tolist(), lengths[start:end].tolist()):
+                next = dist + length
+                if next < best.get(u, INFINITY) and u not in settled:
+                    best[u] = next
+                    heappush(frontier, (next, u))
+        return [best.get(t, INFINITY) for t in targets]
+
+    def neighbours(self, id):
+        """
+        Returns a list of (neighbour id, way id, length) for the edges leaving
+        the node with the given id.
+        """
+        i = self.index(id)
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return zip(self.ids[self.targets[start:end]].tolist(),
+                   self.way_ids[start:end].tolist(), self.lengths[start:end].tolist())
+
+    def stale(self):
+        """
+        Returns true if osm.store has been written to since the graph was
+        built from it.
+        """
+        return self.generation != osm.store.generation()
+
+    def close(self):
+        """
+        Unmap the file. The arrays can't be used afterwards.
+        """
+        for name, dtype, count, extra in _arrays:
+            setattr(self, name, None)
+        self.map.close()
+
+def load(filename = None):
+    """
+    Map the graph file filename (by default default_filename()).
+    Returns a Graph.
+    """
+    return Graph(filename or default_filename())
+
+def _edges():
+    """
+    Returns arrays (from ids, to ids, way ids) of each pair of consecutive
+    nodes along the ways in osm.store.
+    """
+    sources, targets, ways = [array(osm.way.ID_TYPECODE) for i in xrange(3)]
+    previous_way = previous_node = None
+    for way, node in osm.store.way_nodes():
+        if way == previous_way and node != previous_node:
+            sources.append(previous_node)
+            targets.append(node)
+            ways.append(way)
+        previous_way, previous_node = way, node
+    return [numpy.array(a, dtype = numpy.int64) for a in (sources, targets, ways)]
+
+def build(filename = None):
+    """
+    Compile the ways in osm.store into a graph file at filename (by default
+    default_filename()), replacing any that is there.
+    Returns the name of the file.
+    """
+    filename = filename or default_filename()
+    generation = osm.store.generation()
+    table = osm.columnar.snapshot()
+    sources, targets, ways = _edges()
+    # Only keep edges between nodes whose positions are known.
+    known = (table.index(sources) >= 0) & (table.index(targets) >= 0)
+    sources, targets, ways = sources[known], targets[known], ways[known]
+    ids = numpy.unique(numpy.concatenate((sources, targets)))
+    lat, lon = table.positions(ids)
+    # Both directions of every edge, ordered by the node they leave.
+    sources, targets = (numpy.concatenate((sources, targets)),
+                        numpy.concatenate((targets, sources)))
+    ways = numpy.concatenate((ways, ways))
+    order = numpy.argsort(sources, kind = 'mergesort')
+    sources = numpy.searchsorted(ids, sources[order])
+    targets = numpy.searchsorted(ids, targets[order])
+    ways = ways[order]
+    lengths = osm.columnar.distances(lat[sources], lon[sources], lat[targets], lon[targets])
+    offsets = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(sources, minlength = len(ids)))))
+    _write(filename, MAGIC, FORMAT_VERSION, generation, _arrays,
+           {'ids':ids, 'lat':lat, 'lon':lon, 'offsets':offsets, 'targets':targets,
+            'lengths':lengths, 'way_ids':ways})
+    return filename
+
+if __name__ == '__main__':
+    start = time.time()
+    graph = load(build(sys.argv[1] if len(sys.argv) > 1 else None))
+    print '%d nodes, %d edges in %.1fs' % (len(graph), len(graph.targets), time.time() - start)
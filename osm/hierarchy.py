@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+
+## Copyright 2010 Michael Larsen <mike.gh.larsen@gmail.com>
+##
+## This program is free software: you can redistribute it and/or modify  ##
+## it under the terms of the GNU General Public License as published by  ##
+## the Free Software Foundation, either version 3 of the License, or     ##
+## (at your option) any later version.                                   ##
+##                                                                       ##
+## This program is distributed in the hope that it will be useful,       ##
+## but WITHOUT ANY WARRANTY; without even the implied warranty of        ##
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         ##
+## GNU General Public License for more details.                          ##
+##                                                                       ##
+## You should have received a copy of the GNU General Public License     ##
+## along with this program.  If not, see <http://www.gnu.org/licenses/>. ##
+"""
+This module answers shortest path queries with a contraction hierarchy of
+the cached ways, which is built once offline and then makes each query
+touch only a few hundred nodes.
+
+Building the hierarchy contracts the nodes of osm.routingGraph one at a
+time, least important first: when a node is taken out, a shortcut edge is
+added between each pair of its remaining neighbours unless a path between
+them that avoids it is no longer (a witness). The order in which nodes are
+contracted is their rank. A query then searches from both ends using only
+edges that lead to higher ranks, and expands the shortcuts on the shortest
+path it finds back into the nodes they stand for.
+
+The hierarchy is stored in the same form of file as osm.graph (so this
+requires NumPy), with these arrays: ids, rank, and, for the edges from each
+node to higher ranked ones, offsets, targets, lengths (km) and middles (the
+node a shortcut passes through, or -1 for an edge of a way).
+
+Build a hierarchy with:
+    python -m osm.hierarchy [filename]
+"""
+
+from heapq import heapify, heappush, heappop
+import sys
+import time
+import osm
+import osm.graph
+import osm.store
+
+MAGIC = 'OSMC'
+FORMAT_VERSION = 1
+
+# Nodes a witness search may settle before giving up (and adding the shortcut
+# anyway, which is never wrong, only wasteful).
+WITNESS_LIMIT = 200
+
+_arrays = (('ids', '<i8', 'nodes', 0), ('rank', '<i4', 'nodes', 0),
+           ('offsets', '<i8', 'nodes', 1), ('targets', '<i4', 'edges', 0),
+           ('lengths', '<f8', 'edges', 0), ('middles', '<i4', 'edges', 0))
+
+INFINITY = float('inf')
+
+def default_filename():
+    """
+    Returns the name of the hierarchy file kept next to the database (the
+    db-filename option with .ch appended).
+    """
+    return osm.config.get('osm', 'db-filename') + '.ch'
+
+class _Contraction:
+    """
+    The state of the graph while it is being contracted: adjacency[v] maps
+    each remaining neighbour of node index v to (length, middle).
+    """
+    def __init__(self, adjacency, witness_limit):
+        self.adjacency = adjacency
+        self.witness_limit = witness_limit
+        self.removed = [0] * len(adjacency)
+
+    def _witnesses(self, source, avoid, limit, targets):
+        """
+        Returns the distances from source found by a Dijkstra search of the
+        remaining graph without avoid, up to limit km or until targets have
+        all been settled.
+        """
+        adjacency = self.adjacency
+        best = {source: 0.0}
+        frontier = [(0.0, source)]
+        remaining = set(targets)
+        settled = 0
+        while frontier and remaining and settled < self.witness_limit:
+            dist, v = heappop(frontier)
+            if dist > best[v]:
+                continue
+            if dist > limit:
+                break
+            remaining.discard(v)
+            settled += 1
+            for u, (length, middle) in adjacency[v].iteritems():
+                if u == avoid:
+                    continue
+                next = dist + length
+                if next < best.get(u, INFINITY):
+                    best[u] = next
+                    heappush(frontier, (next, u))
+        return best
+
+    def shortcuts(self, v):
+        """
+        Returns a list of (u, w, length) of the shortcuts needed to take v out
+        of the graph.
+        """
+        neighbours = self.adjacency[v].items()
+        needed = []
+        for i, (u, (first, middle)) in enumerate(neighbours):
+            via = dict((w, first + second) for w, (second, middle) in neighbours[i + 1:])
+            if not via:
+                continue
+            found = self._witnesses(u, v, max(via.itervalues()), via)
+            for w, length in via.iteritems():
+                if found.get(w, INFINITY) > length:
+                    needed.append((u, w, length))
+        return needed
+
+    def priority(self, v, shortcuts):
+        """
+        The edge difference of contracting v, plus the number of its
+        neighbours already contracted, which spreads contraction evenly.
+        """
+        return len(shortcuts) - len(self.adjacency[v]) + self.removed[v]
+
+    def contract(self, v, shortcuts):
+        """
+        Take v out of the graph, adding shortcuts.
+        Returns v's edges to the remaining nodes, as {u: (length, middle)}.
+        """
+        adjacency = self.adjacency
+        edges = adjacency[v]
+        for u in edges:
+            del adjacency[u][v]
+            self.removed[u] += 1
+        for u, w, length in shortcuts:
+            if length < adjacency[u].get(w, (INFINITY,))[0]:
+                adjacency[u][w] = adjacency[w][u] = (length, v)
+        adjacency[v] = None
+        return edges
+
+def build(filename = None, graph = None, witness_limit = WITNESS_LIMIT):
+    """
+    Build a contraction hierarchy of graph (by default osm.routingGraph) and
+    write it to filename (by default default_filename()), replacing any that
+    is there. graph only needs iterating over its node ids and neighbours().
+    Returns the name of the file.
+    """
+    filename = filename or default_filename()
+    if graph is None:
+        graph = osm.routingGraph
+    generation = osm.store.generation()
+    ids = sorted(graph)
+    index = dict((id, i) for i, id in enumerate(ids))
+    adjacency = [{} for id in ids]
+    for i, id in enumerate(ids):
+        for n, wid, length in graph.neighbours(id):
+            j = index.get(n)
+            if length is None or j is None or j == i:
+                continue
+            if length < adjacency[i].get(j, (INFINITY,))[0]:
+                adjacency[i][j] = adjacency[j][i] = (length, -1)
+
+    contraction = _Contraction(adjacency, witness_limit)
+    queue = [(contraction.priority(v, contraction.shortcuts(v)), v) for v in xrange(len(ids))]
+    heapify(queue)
+    rank = [0] * len(ids)
+    upward = [None] * len(ids)
+    order = 0
+    while queue:
+        priority, v = heappop(queue)
+        # Priorities go stale as neighbours are contracted: only contract v
+        # if it is still the least important.
+        shortcuts = contraction.shortcuts(v)
+        priority = contraction.priority(v, shortcuts)
+        if queue and priority > queue[0][0]:
+            heappush(queue, (priority, v))
+            continue
+        rank[v] = order
+        order += 1
+        upward[v] = contraction.contract(v, shortcuts)
+
+    offsets = [0]
+    targets, lengths, middles = [], [], []
+    for edges in upward:
+        for u, (length, middle) in sorted(edges.iteritems()):
+            targets.append(u)
+            lengths.append(length)
+            middles.append(middle)
+        offsets.append(len(targets))
+    osm.graph._write(filename, MAGIC, FORMAT_VERSION, generation, _arrays,
+                     {'ids':ids, 'rank':rank, 'offsets':offsets, 'targets':targets,
+                      'lengths':lengths, 'middles':middles})
+    return filename
+
+class Hierarchy:
+    """
+    A contraction hierarchy read from a file (see load). The edges are copied
+    into lists, which are quicker to walk one at a time than the arrays.
+    generation and built are the osm.store generation and the time it was
+    built from.
+    """
+    def __init__(self, filename):
+        data, self.generation, self.built, arrays = osm.graph._map(filename, MAGIC,
+                                                                   FORMAT_VERSION, _arrays)
+        try:
+            self.ids = arrays['ids'].tolist()
+            self.rank = arrays['rank'].tolist()
+            self.offsets = arrays['offsets'].tolist()
+            self.targets = arrays['targets'].tolist()
+            self.lengths = arrays['lengths'].tolist()
+            self.middles = arrays['middles'].tolist()
+        finally:
+            data.close()
+        self.index = dict((id, i) for i, id in enumerate(self.ids))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, id):
+        return id in self.index
+
+    def stale(self):
+        """
+        Returns true if osm.store has been written to since the hierarchy was
+        built from it.
+        """
+        return self.generation != osm.store.generation()
+
+    def _middle(self, a, b):
+        """
+        Returns the middle of the edge between node indexes a and b, one of
+        which was contracted before the other.
+        """
+        if self.rank[a] > self.rank[b]:
+            a, b = b, a
+        for k in xrange(self.offsets[a], self.offsets[a + 1]):
+            if self.targets[k] == b:
+                return self.middles[k]
+        raise KeyError((a, b))
+
+    def _unpack(self, a, b, middle, path):
+        """
+        Append the node indexes after a up to b along the edge between them
+        (with the given middle) to path.
+        """
+        stack = [(a, b, middle)]
+        while stack:
+            a, b, middle = stack.pop()
+            if middle < 0:
+                path.append(b)
+            else:
+                stack.append((middle, b, self._middle(middle, b)))
+                stack.append((a, middle, self._middle(a, middle)))
+
+    def search(self, src, dst, stats = None):
+        """
+        Find the shortest path from node id src to node id dst. stats, if
+        given, is filled in as by route.search.
+        Returns (list of node ids from src to dst, distance in km), or
+        (None, -1) if no path was found.
+        """
+        if src not in self.index or dst not in self.index:
+            return None, -1
+        if src == dst:
+            return [src], 0.0
+        offsets, targets, lengths = self.offsets, self.targets, self.lengths
+        s, t = self.index[src], self.index[dst]
+        best = ({s: 0.0}, {t: 0.0})
+        parents = ({s: None}, {t: None})
+        frontiers = ([(0.0, s)], [(0.0, t)])
+        shortest, meeting = INFINITY, None
+        iterations = expansions = peak = 0
+        side = 1
+        while frontiers[0] or frontiers[1]:
+            # Alternate sides, dropping one once it can't improve on shortest.
+            if frontiers[1 - side]:
+                side = 1 - side
+            frontier = frontiers[side]
+            if frontier[0][0] >= shortest:
+                del frontier[:]
+                continue
+            iterations += 1
+            dist, v = heappop(frontier)
+            if dist > best[side][v]:
+                continue
+            expansions += 1
+            other = best[1 - side]
+            if v in other and dist + other[v] < shortest:
+                shortest, meeting = dist + other[v], v
+            for k in xrange(offsets[v], offsets[v + 1]):
+                u = targets[k]
+                next = dist + lengths[k]
+                if next < best[side].get(u, INFINITY):
+                    best[side][u] = next
+                    parents[side][u] = (v, k)
+                    heappush(frontier, (next, u))
+            peak = max(peak, len(frontiers[0]) + len(frontiers[1]))
+        if stats is not None:
+            stats.iterations += iterations
+            stats.expansions += expansions
+            stats.peak_frontier = max(stats.peak_frontier, peak)
+        if meeting is None:
+            return None, -1
+
+        # The upward edges from s to the meeting node, and then down to t.
+        edges = []
+        v = meeting
+        while parents[0][v] is not None:
+            u, k = parents[0][v]
+            edges.append((u, v, k))
+            v = u
+        edges.reverse()
+        v = meeting
+        while parents[1][v] is not None:
+            u, k = parents[1][v]
+            edges.append((v, u, k))
+            v = u
+        path = [s]
+        for a, b, k in edges:
+            self._unpack(a, b, self.middles[k], path)
+        return [self.ids[i] for i in path], shortest
+
+    def routeFind(self, src, dst, stats = None):
+        """
+        Find the shortest path between the Nodes src and dst, as
+        route.routeFind does.
+        Returns (list of the Nodes after src up to dst, distance in km), or
+        ([], -1) if no path was found.
+        """
+        ids, dist = self.search(src.id, dst.id, stats)
+        if ids is None:
+            return ([], -1)
+        nodes = osm.nodes.get_many(ids[1:])
+        return ([nodes[id] for id in ids[1:]], dist)
+
+def load(filename = None):
+    """
+    Read the hierarchy file filename (by default default_filename()).
+    Returns a Hierarchy.
+    """
+    return Hierarchy(filename or default_filename())
+
+if __name__ == '__main__':
+    start = time.time()
+    hierarchy = load(build(sys.argv[1] if len(sys.argv) > 1 else None))
+    print '%d nodes, %d upward edges in %.1fs' % (len(hierarchy), len(hierarchy.targets),
+                                                  time.time() - start)
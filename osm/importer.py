@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+## Copyright 2010 Michael Larsen <mike.gh.larsen@gmail.com>
+##
+## This program is free software: you can redistribute it and/or modify  ##
+## it under the terms of the GNU General Public License as published by  ##
+## the Free Software Foundation, either version 3 of the License, or     ##
+## (at your option) any later version.                                   ##
+##                                                                       ##
+## This program is distributed in the hope that it will be useful,       ##
+## but WITHOUT ANY WARRANTY; without even the implied warranty of        ##
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         ##
+## GNU General Public License for more details.                          ##
+##                                                                       ##
+## You should have received a copy of the GNU General Public License     ##
+## along with this program.  If not, see <http://www.gnu.org/licenses/>. ##
+"""
+This module loads OpenStreetMap extracts (.osm files, optionally compressed
+as .osm.bz2 or .osm.gz, or .osm.pbf files) into the cache without using the
+network.
+
+Run it with:
+    python -m osm.importer [--batch-size N] [--processes N] file ...
+
+The file is streamed into osm.store.bulk_load, and the area given by its
+bounds is recorded as fetched, so lookups there are answered from the cache.
+Setting db-profile to bulk-import in osm.cfg makes the load faster still.
+"""
+
+from optparse import OptionParser
+import bz2
+import gzip
+import sys
+import time
+import osm
+import osm.fetch
+import osm.pbf
+import osm.store
+
+# Bytes of compressed data read from a .bz2 file at a time.
+BZ2_READ_SIZE = 1 << 16
+
+class BZ2Streams:
+    """
+    A read-only file over a .bz2 file holding one or more bzip2 streams one
+    after another, as pbzip2 writes them (planet.osm.bz2 and most extracts
+    are made that way). bz2.BZ2File stops at the end of the first stream;
+    this starts a new decompressor for each one and reads them all.
+    """
+    def __init__(self, filename):
+        self.f = open(filename, 'rb')
+        self.decompressor = bz2.BZ2Decompressor()
+        self.buffer = ''
+
+    def _fill(self, size):
+        """
+        Decompress until the buffer holds at least size bytes (or all that is
+        left if size is negative) or the file is used up.
+        """
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        while size < 0 or length < size:
+            data = self.f.read(BZ2_READ_SIZE)
+            if not data:
+                break
+            while data:
+                try:
+                    chunk = self.decompressor.decompress(data)
+                except EOFError:
+                    # The last stream ended exactly where the previous read
+                    # did, so data starts the next one.
+                    self.decompressor = bz2.BZ2Decompressor()
+                    continue
+                chunks.append(chunk)
+                length += len(chunk)
+                data = self.decompressor.unused_data
+                if data:
+                    self.decompressor = bz2.BZ2Decompressor()
+        self.buffer = ''.join(chunks)
+
+    def read(self, size = -1):
+        self._fill(size)
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        self.f.close()
+
+def open_extract(filename):
+    """
+    Open the extract in filename for reading, decompressing it if its name
+    ends in .bz2 (which may hold several bzip2 streams, see BZ2Streams) or
+    .gz.
+    """
+    if filename.endswith('.bz2'):
+        return BZ2Streams(filename)
+    if filename.endswith('.gz'):
+        return gzip.open(filename)
+    return open(filename, 'rb')
+
+def load(filename, batch_size = osm.store.BULK_BATCH_SIZE, progress = None,
+         processes = None):
+    """
+    Load the extract in filename into the store (see osm.store.bulk_load for
+    batch_size and progress), then record its bounds as fetched. PBF files
+    are decoded with processes processes (see osm.pbf.iter_blocks).
+    Returns (number of objects stored, list of the bounds recorded).
+    """
+    bounds = []
+    if filename.endswith('.pbf'):
+        f = open(filename, 'rb')
+        data = osm.pbf.iter_data(f, bounds, processes)
+    else:
+        f = open_extract(filename)
+        data = osm.fetch.iter_data(f, bounds)
+    try:
+        count = osm.store.bulk_load(data, batch_size, progress)
+    finally:
+        f.close()
+    for box in bounds:
+        osm.store.map_store(*box)
+    return count, bounds
+
+def main(argv):
+    parser = OptionParser(usage = 'python -m osm.importer [options] '
+                                  'file.osm[.bz2|.gz]|file.osm.pbf ...')
+    parser.add_option('--batch-size', type = 'int', default = osm.store.BULK_BATCH_SIZE,
+                      help = 'objects to commit at a time (default %default)')
+    parser.add_option('--processes', type = 'int', default = None,
+                      help = 'processes decoding PBF files (default one per CPU)')
+    options, filenames = parser.parse_args(argv)
+    if not filenames:
+        parser.error('no files given')
+    for filename in filenames:
+        start = time.time()
+        def progress(count):
+            sys.stderr.write('\r%s: %d objects, %.0f/s'
+                             % (filename, count, count / (time.time() - start)))
+        count, bounds = load(filename, options.batch_size, progress,
+                             options.processes)
+        elapsed = time.time() - start
+        sys.stderr.write('\n')
+        print '%s: %d objects in %.1fs (%.0f/s)' % (filename, count, elapsed,
+                                                    count / max(elapsed, 1e-6))
+        if not bounds:
+            print '%s: no bounds given, so the area was not marked as fetched' % filename
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
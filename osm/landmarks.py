@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+
+## Copyright 2010 Michael Larsen <mike.gh.larsen@gmail.com>
+##
+## This program is free software: you can redistribute it and/or modify  ##
+## it under the terms of the GNU General Public License as published by  ##
+## the Free Software Foundation, either version 3 of the License, or     ##
+## (at your option) any later version.                                   ##
+##                                                                       ##
+## This program is distributed in the hope that it will be useful,       ##
+## but WITHOUT ANY WARRANTY; without even the implied warranty of        ##
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         ##
+## GNU General Public License for more details.                          ##
+##                                                                       ##
+## You should have received a copy of the GNU General Public License     ##
+## along with this program.  If not, see <http://www.gnu.org/licenses/>. ##
+"""
+This module gives A* search (route.search) a tighter heuristic from
+landmarks: a few nodes chosen far apart, with the distance along the ways
+from each of them to every node worked out in advance. By the triangle
+inequality, the distance from v to t is at least the difference of their
+distances from any landmark.
+
+The ways are the same in both directions, so one table serves for the
+distances to the landmarks as well as from them.
+
+The tables are stored in the same form of file as osm.graph (so this
+requires NumPy), with these arrays: ids, landmarks (the index of each
+landmark) and distances (km, for each node a row with its distance from
+each landmark, or -1 where it can't be reached).
+
+Build the tables with:
+    python -m osm.landmarks [count] [filename]
+"""
+
+from heapq import heappush, heappop
+import sys
+import time
+import osm
+import osm.graph
+import osm.store
+
+MAGIC = 'OSML'
+FORMAT_VERSION = 1
+
+# The number of landmarks chosen by default.
+COUNT = 8
+
+_arrays = (('ids', '<i8', 'nodes', 0), ('landmarks', '<i4', 'edges', 0),
+           ('distances', '<f8', ('nodes', 'edges'), 0))
+
+INFINITY = float('inf')
+
+def default_filename():
+    """
+    Returns the name of the landmark file kept next to the database (the
+    db-filename option with .alt appended).
+    """
+    return osm.config.get('osm', 'db-filename') + '.alt'
+
+def _distances(adjacency, source):
+    """
+    Returns a list of the distances from node index source to every node
+    index (INFINITY where there is no path), by Dijkstra's algorithm.
+    """
+    best = [INFINITY] * len(adjacency)
+    best[source] = 0.0
+    frontier = [(0.0, source)]
+    while frontier:
+        dist, v = heappop(frontier)
+        if dist > best[v]:
+            continue
+        for u, length in adjacency[v]:
+            next = dist + length
+            if next < best[u]:
+                best[u] = next
+                heappush(frontier, (next, u))
+    return best
+
+def _largest_component(adjacency):
+    """
+    Returns a node index in the largest connected component of the graph.
+    """
+    component = [None] * len(adjacency)
+    largest, size = None, 0
+    for start in xrange(len(adjacency)):
+        if component[start] is not None:
+            continue
+        component[start] = start
+        stack, count = [start], 0
+        while stack:
+            v = stack.pop()
+            count += 1
+            for u, length in adjacency[v]:
+                if component[u] is None:
+                    component[u] = start
+                    stack.append(u)
+        if count > size:
+            largest, size = start, count
+    return largest
+
+def build(filename = None, graph = None, count = COUNT):
+    """
+    Choose count landmarks in graph (by default osm.routingGraph), work out
+    the distances from them to every node and write them to filename (by
+    default default_filename()), replacing any file that is there. graph only
+    needs iterating over its node ids and neighbours().
+
+    The landmarks are chosen in the largest connected part of the graph,
+    where most routes are. Each is the node furthest along the ways from
+    those already chosen (the first is the one furthest from an arbitrary
+    node), which spreads them around the edges of the map, where they give
+    the best bounds.
+    Returns the name of the file.
+    """
+    filename = filename or default_filename()
+    if graph is None:
+        graph = osm.routingGraph
+    generation = osm.store.generation()
+    ids = sorted(graph)
+    index = dict((id, i) for i, id in enumerate(ids))
+    adjacency = [[(index[n], length) for n, wid, length in graph.neighbours(id)
+                  if length is not None and n in index] for id in ids]
+
+    landmarks, tables = [], []
+    nearest = []
+    if ids:
+        nearest = _distances(adjacency, _largest_component(adjacency))
+    while len(landmarks) < min(count, len(ids)):
+        # The reachable node furthest from the landmarks so far.
+        reachable = [(d, i) for i, d in enumerate(nearest) if d < INFINITY and i not in landmarks]
+        if not reachable:
+            break
+        landmark = max(reachable)[1]
+        table = _distances(adjacency, landmark)
+        if landmarks:
+            nearest = [min(a, b) for a, b in zip(nearest, table)]
+        else:
+            nearest = table
+        landmarks.append(landmark)
+        tables.append(table)
+
+    distances = [d if d < INFINITY else -1.0 for row in zip(*tables) for d in row]
+    osm.graph._write(filename, MAGIC, FORMAT_VERSION, generation, _arrays,
+                     {'ids':ids, 'landmarks':landmarks, 'distances':distances})
+    return filename
+
+class Landmarks:
+    """
+    Landmark distance tables read from a file (see load). ids are the node
+    ids, landmarks the ids of the landmarks, and rows maps each node id to
+    its distances from the landmarks. generation and built are the osm.store
+    generation and the time they were built from.
+    """
+    def __init__(self, filename):
+        data, self.generation, self.built, arrays = osm.graph._map(filename, MAGIC,
+                                                                   FORMAT_VERSION, _arrays)
+        try:
+            self.ids = arrays['ids'].tolist()
+            self.landmarks = [self.ids[i] for i in arrays['landmarks'].tolist()]
+            distances = arrays['distances'].reshape((len(self.ids), len(self.landmarks)))
+            self.rows = dict(zip(self.ids, [tuple(row) for row in distances.tolist()]))
+        finally:
+            data.close()
+        # The last graph checked by covers, and the answer.
+        self.covered = (None, False)
+
+    def __len__(self):
+        return len(self.landmarks)
+
+    def stale(self):
+        """
+        Returns true if osm.store has been written to since the tables were
+        built from it.
+        """
+        return self.generation != osm.store.generation()
+
+    def covers(self, graph):
+        """
+        Returns true if the tables are up to date and hold every node of graph
+        (which only needs iterating over its node ids), so that the bounds
+        from heuristic are consistent over it. A search using bounds that
+        aren't can return a longer path than the shortest.
+        """
+        if self.stale():
+            return False
+        if self.covered[0] is not graph:
+            rows = self.rows
+            self.covered = (graph, all(id in rows for id in graph))
+        return self.covered[1]
+
+    def bound(self, a, b):
+        """
+        Returns a lower bound on the distance in km between the nodes with
+        ids a and b (0 if either isn't in the tables).
+        """
+        return self.heuristic(b)(a)
+
+    def heuristic(self, target):
+        """
+        Returns a function giving a lower bound on the distance in km from a
+        node id to target (0 for nodes that aren't in the tables). The bound
+        is only consistent, as an A* heuristic needs, over a graph the tables
+        cover (see covers).
+        """
+        to = self.rows.get(target)
+        rows = self.rows
+        if to is None:
+            return lambda id: 0.0
+        def estimate(id):
+            best = 0.0
+            row = rows.get(id)
+            if row is None:
+                return best
+            for a, b in zip(row, to):
+                if a >= 0 and b >= 0:
+                    if a - b > best:
+                        best = a - b
+                    elif b - a > best:
+                        best = b - a
+            return best
+        return estimate
+
+def load(filename = None):
+    """
+    Read the landmark file filename (by default default_filename()).
+    Returns a Landmarks.
+    """
+    return Landmarks(filename or default_filename())
+
+if __name__ == '__main__':
+    start = time.time()
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else COUNT
+    landmarks = load(build(sys.argv[2] if len(sys.argv) > 2 else None, count = count))
+    print '%d landmarks for %d nodes in %.1fs' % (len(landmarks), len(landmarks.ids),
+                                                  time.time() - start)
@@ -19,11 +19,16 @@ This module contains the node class an associated functions and data.
 """
 import osm
 
-class Node:
+class Node(object):
     """
     This class represents a node object in the openstreetmap.org data.
     A Node represents some point on the map and is used to define ways.
+    If a Node is created with tags of None, they are loaded from osm.store
+    when first used.
     """
+    __slots__ = ('id', 'lat', 'lon', 'version', 'timestamp', 'changeset', 'uid',
+                 'user', '_tags')
+
     def __init__(self, *args):
         """
         Create a Node object. If called with one argument, it will call __from_element.
@@ -36,21 +41,20 @@ class Node:
 
     def __from_element(self, element):
         """
-        Constructs a Node from a xml.minidom element object.
+        Constructs a Node from an ElementTree element object.
         """
-        attr = element.attributes
-        self.id = int(attr['id'].nodeValue)
-        self.lat = float(attr['lat'].nodeValue)
-        self.lon = float(attr['lon'].nodeValue)
-        self.version = int(attr['version'].nodeValue)
-        self.timestamp = attr['timestamp'].nodeValue
-        self.changeset = int(attr['changeset'].nodeValue)
-        self.uid = int(attr['uid'].nodeValue)
-        self.user = attr['user'].nodeValue
-        tagElements = element.getElementsByTagName("tag")
+        attr = element.attrib
+        self.id = int(attr['id'])
+        self.lat = float(attr['lat'])
+        self.lon = float(attr['lon'])
+        self.version = int(attr['version'])
+        self.timestamp = attr['timestamp']
+        self.changeset = int(attr['changeset'])
+        self.uid = int(attr['uid'])
+        self.user = osm.intern_string(attr['user'])
         self.tags = dict()
-        for e in tagElements:
-            self.tags[e.attributes['k'].nodeValue] = e.attributes['v'].nodeValue
+        for e in element.findall("tag"):
+            self.tags[osm.intern_string(e.get('k'))] = osm.intern_string(e.get('v'))
 
     def __from_data(self, id, fields, tags):
         """
@@ -60,34 +64,37 @@ class Node:
         """
         self.id = id
         self.lat, self.lon, self.version, self.timestamp, self.changeset, self.uid, self.user = fields
-        self.tags = tags
+        if self.user is not None:
+            self.user = osm.intern_string(self.user)
+        self.tags = osm.intern_tags(tags)
+
+    def _get_tags(self):
+        if self._tags is None:
+            self._tags = osm.intern_tags(osm.store.node_tags(self.id))
+        return self._tags
+
+    def _set_tags(self, tags):
+        self._tags = tags
+
+    tags = property(_get_tags, _set_tags, doc = "The Node's tags, as {k1:v1, k2:v2, ...}.")
    
     def __getattr__(self, name):
         if name == 'ways':
-            ways = osm.nodeWays[self.id]
-            if not ways:
-                ways = osm.nodeWays[self.id]
-            return [osm.ways[wid] for wid in ways]
+            ids = osm.nodeWays[self.id]
+            ways = osm.ways.get_many(ids)
+            return [ways[wid] for wid in ids if wid in ways]
         raise AttributeError
 
     def adjacent(self, filters=[]):
-        pre_filtering = []
-        for way in self.ways:
-            idx = way.nodes.index(self.id)
-            if way.nodes.count(self.id) > 1:
-                oidx = len(way.nodes) - 1
-                if idx != 0 or way.nodes.count(self.id) > 2 or way.nodes[oidx] != way.nodes[idx]:
-                    continue
-                pre_filtering.append((osm.nodes[way.nodes[1]], way, 0, 1))
-                pre_filtering.append((osm.nodes[way.nodes[oidx - 1]], way, len(way.nodes), oidx, oidx - 1))
-            else:
-                if idx + 1 < len(way.nodes):
-                    pre_filtering.append((osm.nodes[way.nodes[idx + 1]], way, idx, idx + 1))
-                if idx > 0:
-                    pre_filtering.append((osm.nodes[way.nodes[idx - 1]], way, idx, idx - 1)) 
-        def all_filters(i):
-            return reduce(lambda x,y: x and y, map(lambda x: x(i), filters), True)
-        return map(lambda x: x[0], filter(all_filters, pre_filtering))
+        """
+        Returns a list of the Nodes next to this one along any way, from
+        osm.routingGraph. Each filter is called with (node, way id, length)
+        and the node is dropped if any of them returns false.
+        """
+        edges = osm.routingGraph.neighbours(self.id, fetch = True)
+        nodes = osm.nodes.get_many(list(set(e[0] for e in edges)))
+        return [nodes[n] for n, wid, length in edges
+                if n in nodes and all(f((nodes[n], wid, length)) for f in filters)]
 
     def __hash__(self):
         return hash(self.id)
@@ -0,0 +1,421 @@
+# -*- coding: utf-8 -*-
+
+## Copyright 2010 Michael Larsen <mike.gh.larsen@gmail.com>
+##
+## This program is free software: you can redistribute it and/or modify  ##
+## it under the terms of the GNU General Public License as published by  ##
+## the Free Software Foundation, either version 3 of the License, or     ##
+## (at your option) any later version.                                   ##
+##                                                                       ##
+## This program is distributed in the hope that it will be useful,       ##
+## but WITHOUT ANY WARRANTY; without even the implied warranty of        ##
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         ##
+## GNU General Public License for more details.                          ##
+##                                                                       ##
+## You should have received a copy of the GNU General Public License     ##
+## along with this program.  If not, see <http://www.gnu.org/licenses/>. ##
+"""
+This module reads OpenStreetMap PBF files (.osm.pbf), the compact binary
+format extracts are usually distributed in.
+
+The file is a sequence of zlib-compressed blobs, each holding a block of
+objects. Blobs are decompressed and decoded by a multiprocessing pool, in
+parallel, and come back in file order. The protocol buffer decoding needs no
+libraries beyond the standard ones.
+
+Members:
+iter_data(source, bounds=None, processes=None): yields the Node, Way and
+Relation objects in the file, like osm.fetch.iter_data.
+
+iter_blocks(source, bounds=None, processes=None): yields a Block per block in
+the file, with the nodes in columns, for loaders that don't need objects.
+"""
+
+from array import array
+from struct import unpack
+import collections
+import multiprocessing
+import time
+import zlib
+import osm
+import osm.node
+import osm.way
+import osm.relation
+
+# The features a file may require that this reader understands.
+_FEATURES = frozenset(['OsmSchema-V0.6', 'DenseNodes'])
+
+# Relation member types, by their number in the file.
+_MEMBER_TYPES = ('node', 'way', 'relation')
+
+# Blocks decoded ahead of the one being consumed, per process.
+READ_AHEAD = 4
+
+def _varints(data):
+    """
+    Returns a list of the (unsigned) varints packed in data.
+    """
+    values = []
+    append = values.append
+    value = shift = 0
+    for byte in bytearray(data):
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            append(value)
+            value = shift = 0
+    return values
+
+def _signed(value):
+    """
+    Returns the two's complement value of a 64 bit varint (int32 and int64
+    fields).
+    """
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+def _zigzag(value):
+    """
+    Returns the value of a zigzag encoded varint (sint32 and sint64 fields).
+    """
+    return (value >> 1) ^ -(value & 1)
+
+def _deltas(values):
+    """
+    Returns the running sums of values (for delta coded fields).
+    """
+    total = 0
+    sums = []
+    for value in values:
+        total += value
+        sums.append(total)
+    return sums
+
+def _message(data):
+    """
+    Split the protocol buffer message in data into its fields.
+    Returns a dict of {field number:[value, ...]}, where each value is an int
+    (for varint and fixed fields) or a string (for length delimited ones).
+    """
+    fields = dict()
+    data = buffer(data)
+    position, end = 0, len(data)
+    while position < end:
+        key = value = shift = 0
+        while True:
+            byte = ord(data[position])
+            position += 1
+            key |= (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        wire = key & 7
+        if wire == 0:
+            shift = 0
+            while True:
+                byte = ord(data[position])
+                position += 1
+                value |= (byte & 0x7f) << shift
+                shift += 7
+                if not byte & 0x80:
+                    break
+        elif wire == 2:
+            length = shift = 0
+            while True:
+                byte = ord(data[position])
+                position += 1
+                length |= (byte & 0x7f) << shift
+                shift += 7
+                if not byte & 0x80:
+                    break
+            value = data[position:position + length]
+            position += length
+        elif wire == 1:
+            value = unpack('<Q', data[position:position + 8])[0]
+            position += 8
+        elif wire == 5:
+            value = unpack('<I', data[position:position + 4])[0]
+            position += 4
+        else:
+            raise ValueError('Unsupported protocol buffer wire type %d' % wire)
+        fields.setdefault(key >> 3, []).append(value)
+    return fields
+
+def _repeated(fields, number):
+    """
+    Returns a list of the unsigned varints in the repeated field number of
+    fields (from _message), whether they were packed or not.
+    """
+    values = []
+    for value in fields.get(number, ()):
+        if isinstance(value, (int, long)):
+            values.append(value)
+        else:
+            values.extend(_varints(value))
+    return values
+
+def _one(fields, number, default = None):
+    """
+    Returns the last value of field number of fields, or default.
+    """
+    values = fields.get(number)
+    return values[-1] if values else default
+
+class Block:
+    """
+    The objects from one block of a PBF file.
+    The nodes are held in columns: node_id, node_lat and node_lon are arrays,
+    node_info is a list of (version, timestamp, changeset, uid, user) tuples
+    and node_tags is a dict of {id:tags} for the nodes that have tags. ways is
+    a list of (id, info, tags, node ids) and relations one of (id, info, tags,
+    [(role, type, ref), ...]), where info is as in node_info.
+    Blocks hold only plain data, so they are cheap to send between processes.
+    """
+    def __init__(self):
+        self.node_id = array(osm.way.ID_TYPECODE)
+        self.node_lat = array('d')
+        self.node_lon = array('d')
+        self.node_info = []
+        self.node_tags = dict()
+        self.ways = []
+        self.relations = []
+
+    def objects(self):
+        """
+        Returns a list of the objects in the block, nodes first, as
+        osm.node.Node, osm.way.Way and osm.relation.Relation objects.
+        """
+        tags = self.node_tags
+        nodes = [osm.node.Node(int(id), (lat, lon) + info, tags.get(id, dict()))
+                 for id, lat, lon, info in zip(self.node_id, self.node_lat,
+                                               self.node_lon, self.node_info)]
+        return (nodes + [osm.way.Way(*way) for way in self.ways] +
+                [osm.relation.Relation(*relation) for relation in self.relations])
+
+    def __len__(self):
+        return len(self.node_id) + len(self.ways) + len(self.relations)
+
+class _Decoder:
+    """
+    Decodes the objects in a PrimitiveBlock into a Block.
+    """
+    def __init__(self, data):
+        block = _message(data)
+        self.strings = [s.decode('utf-8') for s in
+                        _message(_one(block, 1, '')).get(1, ())]
+        self.granularity = _signed(_one(block, 17, 100))
+        self.lat_offset = _signed(_one(block, 19, 0))
+        self.lon_offset = _signed(_one(block, 20, 0))
+        self.date_granularity = _signed(_one(block, 18, 1000))
+        self.block = Block()
+        for group in block.get(2, ()):
+            group = _message(group)
+            for node in group.get(1, ()):
+                self.node(_message(node))
+            for dense in group.get(2, ()):
+                self.dense(_message(dense))
+            for way in group.get(3, ()):
+                self.way(_message(way))
+            for relation in group.get(4, ()):
+                self.relation(_message(relation))
+
+    def timestamp(self, value):
+        """
+        Returns the xml form of a timestamp from the file.
+        """
+        if value is None:
+            return None
+        seconds = value * self.date_granularity // 1000
+        return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(seconds))
+
+    def info(self, fields):
+        """
+        Returns (visible, (version, timestamp, changeset, uid, user)) from the
+        fields of an Info message (or None, for objects without one).
+        """
+        if fields is None:
+            return True, (None, None, None, None, None)
+        fields = _message(fields)
+        timestamp = _one(fields, 2)
+        return (_one(fields, 6, 1) != 0,
+                (_signed(_one(fields, 1, -1)),
+                 self.timestamp(timestamp and _signed(timestamp)),
+                 _signed(_one(fields, 3, 0)), _signed(_one(fields, 4, 0)),
+                 self.strings[_one(fields, 5, 0)]))
+
+    def tags(self, fields):
+        """
+        Returns the tags of an object from its keys and vals fields.
+        """
+        strings = self.strings
+        return dict((strings[k], strings[v]) for k, v in
+                    zip(_repeated(fields, 2), _repeated(fields, 3)))
+
+    def position(self, lat, lon):
+        """
+        Returns the (lat, lon) in degrees of a position from the file.
+        """
+        return (1e-9 * (self.lat_offset + self.granularity * lat),
+                1e-9 * (self.lon_offset + self.granularity * lon))
+
+    def node(self, fields):
+        visible, info = self.info(_one(fields, 4))
+        if not visible:
+            return
+        id = _zigzag(_one(fields, 1))
+        lat, lon = self.position(_zigzag(_one(fields, 8)), _zigzag(_one(fields, 9)))
+        block = self.block
+        block.node_id.append(id)
+        block.node_lat.append(lat)
+        block.node_lon.append(lon)
+        block.node_info.append(info)
+        tags = self.tags(fields)
+        if tags:
+            block.node_tags[id] = tags
+
+    def dense(self, fields):
+        ids = _deltas(_zigzag(v) for v in _repeated(fields, 1))
+        lats = _deltas(_zigzag(v) for v in _repeated(fields, 8))
+        lons = _deltas(_zigzag(v) for v in _repeated(fields, 9))
+        count = len(ids)
+        infos = [(None, None, None, None, None)] * count
+        visible = [True] * count
+        dense_info = _one(fields, 5)
+        if dense_info is not None:
+            dense_info = _message(dense_info)
+            versions = [_signed(v) for v in _repeated(dense_info, 1)]
+            timestamps = _deltas(_zigzag(v) for v in _repeated(dense_info, 2))
+            changesets = _deltas(_zigzag(v) for v in _repeated(dense_info, 3))
+            uids = _deltas(_zigzag(v) for v in _repeated(dense_info, 4))
+            users = _deltas(_zigzag(v) for v in _repeated(dense_info, 5))
+            strings = self.strings
+            infos = [(version, self.timestamp(timestamp), changeset, uid, strings[user])
+                     for version, timestamp, changeset, uid, user
+                     in zip(versions, timestamps, changesets, uids, users)]
+            if dense_info.get(6):
+                visible = [v != 0 for v in _repeated(dense_info, 6)]
+        # Tags are (key, value) string indexes for each node in turn, each
+        # node's ended by a 0.
+        keys_vals = _repeated(fields, 10)
+        strings = self.strings
+        position = 0
+        block = self.block
+        granularity = 1e-9 * self.granularity
+        lat_offset = 1e-9 * self.lat_offset
+        lon_offset = 1e-9 * self.lon_offset
+        for i in xrange(count):
+            tags = None
+            if keys_vals:
+                while keys_vals[position]:
+                    if tags is None:
+                        tags = dict()
+                    tags[strings[keys_vals[position]]] = strings[keys_vals[position + 1]]
+                    position += 2
+                position += 1
+            if not visible[i]:
+                continue
+            block.node_id.append(ids[i])
+            block.node_lat.append(lat_offset + granularity * lats[i])
+            block.node_lon.append(lon_offset + granularity * lons[i])
+            block.node_info.append(infos[i])
+            if tags:
+                block.node_tags[ids[i]] = tags
+
+    def way(self, fields):
+        visible, info = self.info(_one(fields, 4))
+        if not visible:
+            return
+        refs = _deltas(_zigzag(v) for v in _repeated(fields, 8))
+        self.block.ways.append((_signed(_one(fields, 1)), info, self.tags(fields), refs))
+
+    def relation(self, fields):
+        visible, info = self.info(_one(fields, 4))
+        if not visible:
+            return
+        roles = [self.strings[_signed(r)] for r in _repeated(fields, 8)]
+        refs = _deltas(_zigzag(v) for v in _repeated(fields, 9))
+        types = [_MEMBER_TYPES[t] for t in _repeated(fields, 10)]
+        self.block.relations.append((_signed(_one(fields, 1)), info, self.tags(fields),
+                                     zip(roles, types, refs)))
+
+def _blob_data(blob):
+    """
+    Returns the decompressed contents of a Blob message.
+    """
+    fields = _message(blob)
+    if 1 in fields:
+        return str(_one(fields, 1))
+    if 3 in fields:
+        return zlib.decompress(_one(fields, 3))
+    raise ValueError('Unsupported PBF blob compression')
+
+def _decode(blob):
+    """
+    Returns the Block decoded from an OSMData blob. Run in the pool.
+    """
+    return _Decoder(_blob_data(blob)).block
+
+def _blobs(f, bounds):
+    """
+    Yields the OSMData blobs in the PBF file f, checking each OSMHeader on the
+    way and appending its bounding box, if any, to bounds (if given) as
+    (minlat, maxlat, minlon, maxlon).
+    """
+    while True:
+        size = f.read(4)
+        if not size:
+            return
+        header = _message(f.read(unpack('>I', size)[0]))
+        blob = f.read(_one(header, 3))
+        kind = str(_one(header, 1))
+        if kind == 'OSMHeader':
+            header = _message(_blob_data(blob))
+            missing = set(str(s) for s in header.get(4, ())) - _FEATURES
+            if missing:
+                raise ValueError('Unsupported PBF features: %s' % ', '.join(sorted(missing)))
+            bbox = _one(header, 1)
+            if bbox is not None and bounds is not None:
+                bbox = _message(bbox)
+                left, right, top, bottom = [1e-9 * _zigzag(_one(bbox, i)) for i in (1, 2, 3, 4)]
+                bounds.append((bottom, top, left, right))
+        elif kind == 'OSMData':
+            yield blob
+
+def iter_blocks(source, bounds = None, processes = None):
+    """
+    Yields a Block for each block of the PBF file source (a filename or file
+    object opened in binary mode), in file order. The blocks are decoded by a
+    pool of processes processes (by default one per CPU), or in this process
+    if processes is 0. If bounds is given, the file's bounding box is appended
+    to it, as in osm.fetch.iter_data.
+    """
+    f = open(source, 'rb') if isinstance(source, basestring) else source
+    pool = None
+    try:
+        if processes == 0:
+            for blob in _blobs(f, bounds):
+                yield _decode(blob)
+            return
+        pool = multiprocessing.Pool(processes)
+        window = READ_AHEAD * (processes or multiprocessing.cpu_count())
+        pending = collections.deque()
+        for blob in _blobs(f, bounds):
+            pending.append(pool.apply_async(_decode, (blob,)))
+            if len(pending) >= window:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        if pool:
+            pool.terminate()
+        if f is not source:
+            f.close()
+
+def iter_data(source, bounds = None, processes = None):
+    """
+    Yields the node, way and relation objects in the PBF file source one at a
+    time, in file order. See iter_blocks for the parameters.
+    """
+    for block in iter_blocks(source, bounds, processes):
+        for item in block.objects():
+            yield item
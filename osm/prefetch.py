@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+## Copyright 2010 Michael Larsen <mike.gh.larsen@gmail.com>
+##
+## This program is free software: you can redistribute it and/or modify  ##
+## it under the terms of the GNU General Public License as published by  ##
+## the Free Software Foundation, either version 3 of the License, or     ##
+## (at your option) any later version.                                   ##
+##                                                                       ##
+## This program is distributed in the hope that it will be useful,       ##
+## but WITHOUT ANY WARRANTY; without even the implied warranty of        ##
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         ##
+## GNU General Public License for more details.                          ##
+##                                                                       ##
+## You should have received a copy of the GNU General Public License     ##
+## along with this program.  If not, see <http://www.gnu.org/licenses/>. ##
+"""
+This module fetches whole regions of the map ahead of time, so that lookups
+there don't have to wait on the network.
+
+A region is split into tiles aligned to a grid of osm.dict.MAP_SIZE degrees.
+The tiles that haven't been fetched yet are downloaded by a pool of worker
+threads, while the calling thread stores the results, so only one thread
+ever writes to osm.store.
+
+Boxes are tuples of (minlat, maxlat, minlon, maxlon), as in osm.coverage.
+"""
+
+from math import ceil, cos, floor, hypot, radians
+import Queue
+import threading
+import osm
+import osm.dict
+import osm.fetch
+import osm.store
+
+def tiles(minlat, maxlat, minlon, maxlon, size = osm.dict.MAP_SIZE):
+    """
+    Returns a list of the grid-aligned tiles of size degrees that cover the
+    given bounding box.
+    """
+    rows = xrange(int(floor(minlat / size)), int(ceil(maxlat / size)))
+    columns = xrange(int(floor(minlon / size)), int(ceil(maxlon / size)))
+    return [(i * size, (i + 1) * size, j * size, (j + 1) * size)
+            for i in rows for j in columns]
+
+def ellipse_tiles(src, dst, slack = 0.25, margin = osm.dict.MAP_SIZE,
+                  size = osm.dict.MAP_SIZE):
+    """
+    Returns a list of the tiles that a route from src to dst (anything with
+    lat and lon) is likely to pass through: those within margin degrees of
+    the straight line between them, or of the ellipse with src and dst as
+    foci whose points are at most (1 + slack) times as far from src and dst
+    combined as src is from dst. A slack of 0 gives just the corridor around
+    the straight line.
+    """
+    # Work in degrees of latitude, shrinking longitudes to match.
+    scale = cos(radians((src.lat + dst.lat) / 2))
+    def dist(lat1, lon1, lat2, lon2):
+        return hypot(lat1 - lat2, (lon1 - lon2) * scale)
+    length = dist(src.lat, src.lon, dst.lat, dst.lon)
+    limit = length * (1 + slack)
+    def line_dist(lat, lon):
+        if length == 0:
+            return dist(lat, lon, src.lat, src.lon)
+        t = ((lat - src.lat) * (dst.lat - src.lat) +
+             (lon - src.lon) * (dst.lon - src.lon) * scale * scale) / (length * length)
+        t = min(1.0, max(0.0, t))
+        return dist(lat, lon, src.lat + t * (dst.lat - src.lat),
+                    src.lon + t * (dst.lon - src.lon))
+    reach = (limit - length) / 2 + margin
+    bbox = (min(src.lat, dst.lat) - reach, max(src.lat, dst.lat) + reach,
+            min(src.lon, dst.lon) - reach / scale, max(src.lon, dst.lon) + reach / scale)
+    selected = []
+    for tile in tiles(*bbox, size = size):
+        lat = (tile[0] + tile[1]) / 2
+        lon = (tile[2] + tile[3]) / 2
+        radius = dist(tile[0], tile[2], lat, lon)
+        foci = dist(lat, lon, src.lat, src.lon) + dist(lat, lon, dst.lat, dst.lon)
+        if line_dist(lat, lon) <= margin + radius or foci <= limit + 2 * radius:
+            selected.append(tile)
+    return selected
+
+def _download(jobs, results, server, api):
+    """
+    Worker thread body: downloads the boxes in the jobs queue until it is
+    empty, putting (box, data, error) on the results queue for each.
+    """
+    while True:
+        try:
+            box = jobs.get_nowait()
+        except Queue.Empty:
+            return
+        try:
+            results.put((box, osm.fetch.map_download(*box, server = server, api = api), None))
+        except Exception, e:
+            results.put((box, None, e))
+
+def prefetch(boxes, workers = osm.fetch.HTTP_POOL_SIZE, progress = None,
+             server = osm.fetch.DEFAULT_SERVER, api = osm.fetch.DEFAULT_API):
+    """
+    Makes sure everything in boxes (e.g. from tiles or ellipse_tiles) is
+    cached, downloading the parts that haven't been fetched before with up to
+    workers threads at once (at least one, even if workers is less). The
+    results are stored from the calling thread as they arrive.
+    progress, if given, is called with (done, total, box, error) after each
+    download is stored (or has failed, with the exception as error).
+    Returns a list of the boxes whose download failed.
+    """
+    jobs = Queue.Queue()
+    total = 0
+    for box in boxes:
+        for piece in osm.store.map_uncovered(*box):
+            jobs.put(piece)
+            total += 1
+    results = Queue.Queue()
+    threads = [threading.Thread(target = _download, args = (jobs, results, server, api))
+               for i in xrange(min(max(workers, 1), total))]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    failed = []
+    for done in xrange(1, total + 1):
+        box, data, error = results.get()
+        if error:
+            failed.append(box)
+        else:
+            osm.store.data_store(data)
+            osm.store.map_store(*box)
+        if progress:
+            progress(done, total, box, error)
+    return failed
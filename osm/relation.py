@@ -17,16 +17,25 @@
 """
 This module contains the Relation class and associated functions and data.
 """
-class Relation:
+import osm
+
+class Relation(object):
     """
     This class represents a relation object in the openstreetmap.org data.
     A Relation represents a relation between some group of nodes, ways, and
     other relations.
+    If a Relation is created with tags of None, they are loaded from osm.store
+    when first used.
     """
-    class Member:
+    __slots__ = ('id', 'version', 'timestamp', 'changeset', 'uid', 'user',
+                 '_tags', 'members')
+
+    class Member(object):
         """
         Represents a member of the Relation.
         """
+        __slots__ = ('role', 'type', 'ref')
+
         def __init__(self, *args):
             """
 If called with one argument, calls __from_element.
@@ -39,12 +48,12 @@ If called with three arguments, calls __from_data.
 
         def __from_element(self, element):
             """
-Constructs a Relation.Member from a xml.minidom element object.
+Constructs a Relation.Member from an ElementTree element object.
             """
-            attr = element.attributes
-            self.type = attr["type"].nodeValue
-            self.ref = int(attr["ref"].nodeValue)
-            self.role = attr["role"].nodeValue
+            attr = element.attrib
+            self.type = osm.intern_string(attr["type"])
+            self.ref = int(attr["ref"])
+            self.role = osm.intern_string(attr["role"])
 
         def __from_data(self, role, type, ref):
             """
@@ -53,8 +62,8 @@ role -- the role of this particular member.
 type -- the type of object this Member is.
 ref -- the id # of the object this Member refers to.
             """
-            self.role = role
-            self.type = type
+            self.role = osm.intern_string(role)
+            self.type = osm.intern_string(type)
             self.ref = ref
 
         def __cmp__(self, other):
@@ -76,20 +85,19 @@ If called with three arguments, calls __from_data.
 
     def __from_element(self, element):
         """
-Constructs a Relation from a xml.minidom element object.
+Constructs a Relation from an ElementTree element object.
         """
-        attr = element.attributes
-        self.id = int(attr['id'].nodeValue)
-        self.version = int(attr['version'].nodeValue)
-        self.timestamp = attr['timestamp'].nodeValue
-        self.changeset = int(attr['changeset'].nodeValue)
-        self.uid = int(attr['uid'].nodeValue)
-        self.user = attr['user'].nodeValue
-        tagElements = element.getElementsByTagName("tag")
+        attr = element.attrib
+        self.id = int(attr['id'])
+        self.version = int(attr['version'])
+        self.timestamp = attr['timestamp']
+        self.changeset = int(attr['changeset'])
+        self.uid = int(attr['uid'])
+        self.user = osm.intern_string(attr['user'])
         self.tags = dict()
-        for e in tagElements:
-            self.tags[e.attributes['k'].nodeValue] = e.attributes['v'].nodeValue
-        self.members = [Relation.Member(e) for e in element.getElementsByTagName("member")]
+        for e in element.findall("tag"):
+            self.tags[osm.intern_string(e.get('k'))] = osm.intern_string(e.get('v'))
+        self.members = [Relation.Member(e) for e in element.findall("member")]
 
     def __from_data(self, id, fields, tags, members):
         """
@@ -99,9 +107,21 @@ Constructs a Relation from a xml.minidom element object.
         """
         self.id = id
         self.version, self.timestamp, self.changeset, self.uid, self.user = fields
-        self.tags = tags
+        if self.user is not None:
+            self.user = osm.intern_string(self.user)
+        self.tags = osm.intern_tags(tags)
         self.members = [Relation.Member(m[0], m[1], m[2]) for m in members]
 
+    def _get_tags(self):
+        if self._tags is None:
+            self._tags = osm.intern_tags(osm.store.relation_tags(self.id))
+        return self._tags
+
+    def _set_tags(self, tags):
+        self._tags = tags
+
+    tags = property(_get_tags, _set_tags, doc = "The Relation's tags, as {k1:v1, k2:v2, ...}.")
+
     def insert_tuple(self):
         """
         Return the database insert tuple for this relation.
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+
+## Copyright 2010 Michael Larsen <mike.gh.larsen@gmail.com>
+##
+## This program is free software: you can redistribute it and/or modify  ##
+## it under the terms of the GNU General Public License as published by  ##
+## the Free Software Foundation, either version 3 of the License, or     ##
+## (at your option) any later version.                                   ##
+##                                                                       ##
+## This program is distributed in the hope that it will be useful,       ##
+## but WITHOUT ANY WARRANTY; without even the implied warranty of        ##
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         ##
+## GNU General Public License for more details.                          ##
+##                                                                       ##
+## You should have received a copy of the GNU General Public License     ##
+## along with this program.  If not, see <http://www.gnu.org/licenses/>. ##
+"""
+This module holds the road network in memory for routing, so finding the
+neighbours of a node doesn't need any queries or Node and Way objects.
+
+Members:
+RoutingGraph: the edges between consecutive nodes of the cached ways.
+distance(lat1, lon1, lat2, lon2): the great circle distance between two
+positions.
+"""
+
+from __future__ import with_statement
+import math
+import threading
+import osm
+import osm.store
+
+# Mean radius of the Earth in km.
+EARTH_RADIUS = 6371.0
+
+def _asin(x):
+    # Rounding can take x just over 1 for points on opposite sides of the Earth.
+    return math.asin(min(x, 1.0))
+
+def distance(lat1, lon1, lat2, lon2, sin = math.sin, cos = math.cos, asin = _asin,
+             sqrt = math.sqrt):
+    """
+    Returns the great circle distance in km between (lat1, lon1) and
+    (lat2, lon2), in degrees, by the haversine formula. The trigonometric
+    functions used can be replaced (osm.columnar passes NumPy's, so the
+    positions may be arrays); asin must accept values just over 1.
+    """
+    degree = math.pi / 180
+    lat1, lat2 = lat1 * degree, lat2 * degree
+    a = (sin((lat2 - lat1) / 2) ** 2 +
+         cos(lat1) * cos(lat2) * sin((lon2 - lon1) * degree / 2) ** 2)
+    return 2 * EARTH_RADIUS * asin(sqrt(a))
+
+class RoutingGraph:
+    """
+    The graph of the ways in osm.store: each pair of consecutive nodes along a
+    way is joined by an edge in each direction. For each node on a way it
+    keeps a list of (neighbour id, way id, length in km), where length is None
+    while either node's position is unknown.
+
+    The graph is read from the database the first time it is used, and then
+    kept up to date as Nodes and Ways are stored. Lookups take time in
+    proportion to the node's degree. The edge lists are replaced rather than
+    changed when the graph is updated, so they can be read without locking.
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.edges = None
+        self.ways = None
+        self.positions = None
+        # The nodes neighbours(id, fetch = True) has completed.
+        self.fetched = set()
+        osm.store.add_store_listener(self.stored)
+
+    def _load(self):
+        """
+        Build the graph from osm.store, if that hasn't been done yet.
+        """
+        if self.edges is not None:
+            return
+        with self.lock:
+            if self.edges is not None:
+                return
+            edges, ways, positions = {}, {}, {}
+            previous = None
+            for wid, nid, lat, lon in osm.store.way_node_positions():
+                if lat is not None:
+                    positions[nid] = (lat, lon)
+                if wid != previous:
+                    ways[wid] = []
+                    previous = wid
+                ways[wid].append(nid)
+            self.ways, self.positions = ways, positions
+            for wid, nids in ways.iteritems():
+                for a, b, length in self._segments(wid, nids):
+                    edges.setdefault(a, []).append((b, wid, length))
+                    edges.setdefault(b, []).append((a, wid, length))
+            self.edges = edges
+
+    def _length(self, a, b):
+        if a in self.positions and b in self.positions:
+            return distance(*(self.positions[a] + self.positions[b]))
+        return None
+
+    def _segments(self, wid, nids):
+        """
+        Returns a list of (node id, next node id, length) along the way wid.
+        """
+        return [(a, b, self._length(a, b)) for a, b in zip(nids, nids[1:]) if a != b]
+
+    def __contains__(self, id):
+        self._load()
+        return id in self.edges
+
+    def __len__(self):
+        self._load()
+        return len(self.edges)
+
+    def __iter__(self):
+        """
+        Returns an iterator over the ids of the nodes in the graph.
+        """
+        self._load()
+        return iter(list(self.edges))
+
+    def neighbours(self, id, fetch = False):
+        """
+        Returns a list of (neighbour id, way id, length) for the edges leaving
+        the node with the given id. If fetch is true, the first time a node is
+        asked for its neighbourhood is made complete (see _fetch), which may
+        download it.
+        """
+        self._load()
+        if fetch and id not in self.fetched:
+            self._fetch(id)
+        return self.edges.get(id, [])
+
+    def _fetch(self, id):
+        """
+        Make sure all the edges of the node with the given id are in the
+        graph, with their lengths. Unless the node is inside a fetched
+        bounding box, some of its ways may be missing (it may lie just outside
+        the area around the nodes already reached), so they are looked up
+        through osm.nodeWays. The positions of neighbours that aren't known
+        are then looked up through osm.nodes; the store listener fills in the
+        lengths of their edges.
+        """
+        self.fetched.add(id)
+        if id not in self.edges or not osm.store.map_node_exists(id):
+            try:
+                osm.nodeWays[id]
+            except KeyError:
+                pass
+        missing = [n for n, wid, length in self.edges.get(id, ()) if length is None]
+        if missing:
+            osm.nodes.get_many(missing)
+
+    def position(self, id):
+        """
+        Returns (lat, lon) of the node with the given id, or None if it isn't
+        known.
+        """
+        self._load()
+        return self.positions.get(id)
+
+    def _remove_way(self, wid):
+        for nid in set(self.ways.pop(wid, ())):
+            edges = [e for e in self.edges.get(nid, ()) if e[1] != wid]
+            if edges:
+                self.edges[nid] = edges
+            else:
+                self.edges.pop(nid, None)
+                self.positions.pop(nid, None)
+
+    def _add_way(self, wid, nids):
+        self.ways[wid] = nids
+        added = {}
+        for a, b, length in self._segments(wid, nids):
+            added.setdefault(a, []).append((b, wid, length))
+            added.setdefault(b, []).append((a, wid, length))
+        for nid, edges in added.iteritems():
+            self.edges[nid] = self.edges.get(nid, []) + edges
+
+    def _move_node(self, nid, position):
+        self.positions[nid] = position
+        self.edges[nid] = [(n, w, self._length(nid, n)) for n, w, l in self.edges[nid]]
+        for n in set(e[0] for e in self.edges[nid]):
+            self.edges[n] = [(m, w, self._length(n, m)) if m == nid else (m, w, l)
+                             for m, w, l in self.edges[n]]
+
+    def stored(self, dataList):
+        """
+        Store listener: brings the graph up to date with the Nodes and Ways
+        in dataList. Does nothing until the graph has been loaded.
+        """
+        if self.edges is None:
+            return
+        with self.lock:
+            positions, ways = {}, []
+            for item in dataList:
+                if isinstance(item, osm.node.Node):
+                    position = (item.lat, item.lon)
+                    if item.id not in self.edges:
+                        positions[item.id] = position
+                    elif self.positions.get(item.id) != position:
+                        self._move_node(item.id, position)
+                elif isinstance(item, osm.way.Way):
+                    ways.append(item)
+            if not ways:
+                return
+            for way in ways:
+                self._remove_way(way.id)
+            nids = set(nid for way in ways for nid in way.nodes)
+            missing = [nid for nid in nids if nid not in self.positions and nid not in positions]
+            for node in osm.store.node_retrieve_many(missing).itervalues():
+                positions[node.id] = (node.lat, node.lon)
+            for nid in nids:
+                if nid in positions:
+                    self.positions[nid] = positions[nid]
+            for way in ways:
+                self._add_way(way.id, list(way.nodes))
@@ -18,31 +18,55 @@
 This module is responsible for caching the OpenStreetMap.org data in a sqlite
 database.
 
-This registers an atexit hook to close the sqlite database connection.
+This registers an atexit hook to close the sqlite database connections.
 Setting osm.DATABASE_FILE_NAME will change the database filename used.
 Setting osm.DATABASE_USE_MEMORY will make the database be in-memory.
 
+The store is safe to use from several threads at once. Each thread reads
+through a connection of its own, and the database is in WAL mode (unless
+configured otherwise), so reads never wait for writes. All writes are made
+by a single writer thread, which commits whatever writes are queued up at
+the time (up to GROUP_SIZE of them) in one transaction; the call making a
+write returns once it is committed.
+
+The sqlite settings come from the named profile in the db-profile config
+option (see PROFILES), and the db-journal-mode, db-synchronous,
+db-cache-size, db-mmap-size, db-temp-store and db-page-size options, which
+take the values of the pragmas of the same names.
+
 This requires with_statement to be available (at least in __future__ i.e.
 Python 2.5 or later), as well as contextlib and sqlite3.
 """
 
 from __future__ import with_statement
 from contextlib import contextmanager
+from itertools import islice
+from math import floor
 import atexit
+import os
+import Queue
 import sqlite3
+import sys
+import threading
 import osm
 import osm.node
 import osm.way
 import osm.relation
+import osm.coverage
 
 
-_connection = None
-if osm.config.get('osm','db-use-memory').lower() in ["true", "on"]:
-    _connection = sqlite3.connect(":memory:")
-else:
-    _connection = sqlite3.connect(osm.config.get('osm', 'db-filename'))
+# Number of objects data_store writes at a time.
+BATCH_SIZE = 5000
+
+# Number of objects bulk_load writes (and commits) at a time.
+BULK_BATCH_SIZE = 100000
 
-atexit.register(_connection.close)
+# The most write operations the writer thread commits together.
+GROUP_SIZE = 64
+
+# If true, the objects *_retrieve_many returns are made without their tags,
+# which are then loaded when first used (from the lazy-tags config option).
+LAZY_TAGS = osm.config.getboolean('osm', 'lazy-tags')
 
 @contextmanager
 def _trans(conn):
@@ -59,6 +83,232 @@ def _trans(conn):
     else:
         conn.commit()
 
+# Named sets of sqlite pragma settings, chosen with the db-profile config
+# option. Each pragma can also be set on its own with the option given for it
+# in _pragmas, which takes precedence over the profile.
+# bulk-import trades durability for write speed: a crash (of the machine, not
+# just the program) can lose the latest commits. read-mostly suits route
+# finding over an already populated database.
+PROFILES = {'default': {'journal_mode':'WAL'},
+            'bulk-import': {'journal_mode':'WAL', 'synchronous':'OFF',
+                            'cache_size':'-262144', 'temp_store':'MEMORY',
+                            'mmap_size':'268435456', 'page_size':'8192'},
+            'read-mostly': {'journal_mode':'WAL', 'synchronous':'NORMAL',
+                            'cache_size':'-65536', 'temp_store':'MEMORY',
+                            'mmap_size':'1073741824'}}
+
+# The pragmas that can be configured, as (pragma, config option), in the order
+# they are applied. page_size only has an effect on a new database, and
+# journal_mode belongs to the database rather than the connection, so both are
+# only set on the writer's connection.
+_pragmas = (('page_size', 'db-page-size'), ('journal_mode', 'db-journal-mode'),
+            ('synchronous', 'db-synchronous'), ('cache_size', 'db-cache-size'),
+            ('mmap_size', 'db-mmap-size'), ('temp_store', 'db-temp-store'))
+_database_pragmas = ('page_size', 'journal_mode')
+
+def settings(profile = None):
+    """
+    Returns a dict of {pragma:value} of the sqlite settings in use: those of
+    profile (by default the db-profile config option), overridden by any
+    pragma options that are set in the config.
+    """
+    if profile is None:
+        profile = osm.config.get('osm', 'db-profile')
+    if profile not in PROFILES:
+        raise ValueError('Unknown db-profile %r (expected one of %s)'
+                         % (profile, ', '.join(sorted(PROFILES))))
+    values = dict(PROFILES[profile])
+    for pragma, option in _pragmas:
+        value = osm.config.get('osm', option)
+        if value:
+            values[pragma] = value
+    return values
+
+def configure(conn, values, database = False):
+    """
+    Apply the pragma settings in values (as returned by settings) to conn.
+    The database-wide ones are only applied if database is true.
+    """
+    for pragma, option in _pragmas:
+        if pragma not in values or (pragma in _database_pragmas and not database):
+            continue
+        value = str(values[pragma])
+        if not value.lstrip('-').isalnum():
+            raise ValueError('Bad value %r for %s' % (value, option))
+        conn.execute('PRAGMA %s = %s;' % (pragma, value)).fetchall()
+
+def _connect(database = False):
+    """
+    Open a new connection to the database, with the configured settings (the
+    database-wide ones too if database is true).
+    """
+    conn = sqlite3.connect(_database, check_same_thread = False)
+    values = _settings
+    if _memory:
+        # In a shared-cache database, readers would otherwise fail while the
+        # writer has a transaction open, rather than waiting for it.
+        conn.execute('PRAGMA read_uncommitted = 1;')
+        # In-memory databases can't use a write-ahead log.
+        values = dict(values)
+        values.pop('journal_mode', None)
+    configure(conn, values, database)
+    return conn
+
+_settings = settings()
+
+_memory = osm.config.get('osm','db-use-memory').lower() in ["true", "on"]
+if _memory:
+    # A named in-memory database with a shared cache, so that every thread's
+    # connection sees the same data.
+    _database = 'file:osm-%d?mode=memory&cache=shared' % os.getpid()
+else:
+    _database = osm.config.get('osm', 'db-filename')
+
+# The connection used by the writer thread.
+_writer = _connect(True)
+
+# True if every thread has to share _writer, because sqlite3 doesn't support
+# shared-cache in-memory databases here (it took _database as a filename).
+# Other threads then read through _SharedCursor.
+_shared = False
+if _memory and _writer.execute('PRAGMA database_list;').fetchone()[2]:
+    _writer.close()
+    os.remove(_database)
+    _database, _shared = ':memory:', True
+    _writer = _connect(True)
+
+# Held by the writer thread for each group of writes, from its first write
+# to the commit or rollback, and by other threads' reads when _shared.
+_writer_lock = threading.RLock()
+
+class _SharedCursor:
+    """
+    Stands in for the connection and cursor of a thread reading through
+    _writer when _shared. Each query holds _writer_lock, so it never runs in
+    the middle of a group of writes (where it would see uncommitted rows,
+    which a rollback could then take away), and fetches all its rows before
+    letting the lock go.
+    """
+    def __init__(self):
+        self.rows = iter(())
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql, args = ()):
+        with _writer_lock:
+            self.rows = iter(_writer.execute(sql, args).fetchall())
+        return self
+
+    def fetchone(self):
+        return next(self.rows, None)
+
+    def fetchall(self):
+        return list(self.rows)
+
+    def __iter__(self):
+        return self.rows
+
+_local = threading.local()
+
+def _reader():
+    """
+    Returns the calling thread's connection to the database, opening it if
+    need be. The writer thread uses its own connection, so its reads see its
+    uncommitted writes. When _shared, other threads get a _SharedCursor.
+    """
+    if threading.currentThread() is _writer_thread:
+        return _writer
+    if _shared:
+        return _SharedCursor()
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = _local.conn = _connect()
+    return conn
+
+class _Write:
+    """
+    A write operation waiting for the writer thread.
+    """
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+# The queue of _Writes for the writer thread (None tells it to stop).
+_writes = Queue.Queue()
+
+def _write(fn, *args):
+    """
+    Have the writer thread call fn(cursor, *args), in a transaction that is
+    committed before this returns.
+    Returns the result of fn, or raises the exception it raised.
+    """
+    if threading.currentThread() is _writer_thread:
+        return fn(_writer.cursor(), *args)
+    job = _Write(fn, args)
+    _writes.put(job)
+    job.done.wait()
+    if job.error:
+        raise job.error[0], job.error[1], job.error[2]
+    return job.result
+
+def _write_group(group):
+    """
+    Run the _Writes in group in one transaction.
+    Returns true if it was committed.
+    """
+    try:
+        with _writer_lock:
+            with _trans(_writer) as cursor:
+                for job in group:
+                    job.error = None
+                    job.result = job.fn(cursor, *job.args)
+                cursor.execute("UPDATE osm_meta SET value = value + 1 WHERE key = 'generation';")
+    except Exception:
+        job.error = sys.exc_info()
+        if _map_grid:
+            _map_grid_load()
+        return False
+    return True
+
+def _write_loop():
+    """
+    Writer thread body: commits the queued writes in groups, until it finds
+    None on the queue. If a group fails, its writes are retried one by one so
+    that only the failing one sees the error.
+    """
+    stop = False
+    while not stop:
+        group = [_writes.get()]
+        while group[-1] is not None and len(group) < GROUP_SIZE:
+            try:
+                group.append(_writes.get_nowait())
+            except Queue.Empty:
+                break
+        if group[-1] is None:
+            stop = True
+            group.pop()
+        if group and not _write_group(group) and len(group) > 1:
+            for job in group:
+                _write_group([job])
+        for job in group:
+            job.done.set()
+
+def _close():
+    """
+    Stop the writer thread once the queued writes are done, and close the
+    connections.
+    """
+    _writes.put(None)
+    _writer_thread.join()
+    conn = getattr(_local, 'conn', None)
+    if conn:
+        conn.close()
+    _writer.close()
+
 # Basic SQL CREATE TABLE syntax template
 _create_sql = 'CREATE TABLE IF NOT EXISTS %s (%s);'
 
@@ -131,8 +381,59 @@ _create_osm_map_sql = _create_sql % ('osm_map',
  'id INTEGER PRIMARY KEY, minlat REAL, maxlat REAL, minlon REAL, maxlon REAL\
   CHECK (minlat <= maxlat), CHECK (minlon <= maxlon)')
 
-# Initialize all tables
-with _trans(_connection) as cursor:
+# SQL to create osm_map_rtree
+# This is an R*Tree index over the bounding boxes in osm_map (with the same ids).
+# The R*Tree stores its coordinates as 32-bit floats rounded outwards, so any
+# match still has to be checked against the exact values in osm_map.
+_create_osm_map_rtree_sql = 'CREATE VIRTUAL TABLE IF NOT EXISTS osm_map_rtree \
+ USING rtree(id, minlat, maxlat, minlon, maxlon);'
+
+# SQL to create osm_tag_batch
+# Scratch table holding the key:value pairs of the batch being stored, so their
+# tag ids can be resolved with a single join.
+_create_osm_tag_batch_sql = 'CREATE TEMP TABLE IF NOT EXISTS osm_tag_batch \
+ (key TEXT, value TEXT);'
+
+# SQL to create osm_id_batch
+# Scratch table holding the ids of the objects in the batch being stored.
+_create_osm_id_batch_sql = 'CREATE TEMP TABLE IF NOT EXISTS osm_id_batch \
+ (id INTEGER PRIMARY KEY);'
+
+# Secondary indexes, as (index name, table, columns).
+# osm_way_node and osm_relation_member are already indexed on wid and rid by
+# their UNIQUE constraints.
+_indexes = (('osm_way_node_nid_idx', 'osm_way_node', 'nid'),
+            ('osm_node_tag_nid_idx', 'osm_node_tag', 'nid'),
+            ('osm_way_tag_wid_idx', 'osm_way_tag', 'wid'),
+            ('osm_relation_tag_rid_idx', 'osm_relation_tag', 'rid'),
+            ('osm_node_lat_lon_idx', 'osm_node', 'lat, lon'))
+
+def create_indexes(cursor):
+    """
+    Create the secondary indexes, if they don't already exist.
+    """
+    for name, table, columns in _indexes:
+        cursor.execute('CREATE INDEX IF NOT EXISTS %s ON %s (%s);'
+                       % (name, table, columns))
+
+# The secondary indexes that storing objects doesn't use, which drop_indexes
+# drops. The tag indexes are kept, as they are what lets the old tags of
+# replaced objects be found and cleared.
+_read_indexes = ('osm_way_node_nid_idx', 'osm_node_lat_lon_idx')
+
+def drop_indexes(cursor):
+    """
+    Drop the secondary indexes that are only used for reading (see
+    _read_indexes). Large imports are faster without them, so bulk_load
+    drops them while it runs; call create_indexes afterwards.
+    """
+    for name in _read_indexes:
+        cursor.execute('DROP INDEX IF EXISTS %s;' % name)
+
+def _migrate_v1(cursor):
+    """
+    Create the original tables.
+    """
     cursor.execute(_create_osm_tag_sql)
     cursor.execute(_create_osm_node_sql)
     cursor.execute(_create_osm_node_tag_sql)
@@ -144,6 +445,159 @@ with _trans(_connection) as cursor:
     cursor.execute(_create_osm_relation_member_sql)
     cursor.execute(_create_osm_map_sql)
 
+def _migrate_v2(cursor):
+    """
+    Add the secondary indexes used by the lookups.
+    """
+    create_indexes(cursor)
+
+def _migrate_v3(cursor):
+    """
+    Add the osm_map_rtree spatial index over osm_map, if sqlite3 was built
+    with the R*Tree module (otherwise _MapGrid is used instead).
+    """
+    try:
+        cursor.execute(_create_osm_map_rtree_sql)
+    except sqlite3.OperationalError:
+        return
+    cursor.execute('INSERT OR REPLACE INTO osm_map_rtree \
+                    SELECT id, minlat, maxlat, minlon, maxlon FROM osm_map;')
+
+def _migrate_v4(cursor):
+    """
+    Coalesce the boxes in osm_map into a set that doesn't overlap.
+    """
+    boxes = []
+    cursor.execute('SELECT minlat, maxlat, minlon, maxlon FROM osm_map;')
+    for box in cursor.fetchall():
+        boxes = osm.coverage.merge(boxes + osm.coverage.subtract(box, boxes))
+    tables = ['osm_map']
+    cursor.execute("SELECT name FROM sqlite_master WHERE name = 'osm_map_rtree';")
+    if cursor.fetchone():
+        tables.append('osm_map_rtree')
+    for table in tables:
+        cursor.execute('DELETE FROM %s;' % table)
+    for id, box in enumerate(boxes):
+        for table in tables:
+            cursor.execute('INSERT INTO %s (id, minlat, maxlat, minlon, maxlon) \
+                            VALUES (?, ?, ?, ?, ?);' % table, (id + 1,) + box)
+
+def _migrate_v5(cursor):
+    """
+    Add osm_meta, holding the generation: a count of the writes committed,
+    used to tell whether data derived from the database is out of date.
+    """
+    cursor.execute(_create_sql % ('osm_meta', 'key TEXT PRIMARY KEY, value INTEGER'))
+    cursor.execute("INSERT OR IGNORE INTO osm_meta (key, value) VALUES ('generation', 0);")
+
+# Schema migrations, in order. A database's PRAGMA user_version is the number
+# of them that have been applied to it. Each step must be safe to re-run, as
+# sqlite3 commits implicitly before DDL statements.
+_migrations = [_migrate_v1, _migrate_v2, _migrate_v3, _migrate_v4, _migrate_v5]
+
+def _migrate(conn):
+    """
+    Bring the schema of the database on conn up to date, in place.
+    """
+    version = conn.execute('PRAGMA user_version;').fetchone()[0]
+    for i in xrange(version, len(_migrations)):
+        with _trans(conn) as cursor:
+            _migrations[i](cursor)
+            cursor.execute('PRAGMA user_version = %d;' % (i + 1))
+
+class _MapGrid:
+    """
+    Pure-Python stand-in for osm_map_rtree, for when sqlite3 lacks the R*Tree
+    module. Boxes are filed in a hierarchy of grids, each level 4 times coarser
+    than the one below, at the finest level where they cover at most 2x2 cells.
+    A search then only looks at the cells around the query on each level.
+    """
+    CELL_SIZE = 0.01
+    LEVELS = 10
+
+    def __init__(self):
+        self.levels = [dict() for i in xrange(self.LEVELS)]
+
+    def _cells(self, level, minlat, maxlat, minlon, maxlon):
+        """
+        Returns the (row, column) ranges of the cells on level that the box
+        touches.
+        """
+        size = self.CELL_SIZE * 4 ** level
+        return (xrange(int(floor(minlat / size)), int(floor(maxlat / size)) + 1),
+                xrange(int(floor(minlon / size)), int(floor(maxlon / size)) + 1))
+
+    def add(self, box):
+        """
+        Adds box, a tuple of (id, minlat, maxlat, minlon, maxlon).
+        """
+        for level in xrange(self.LEVELS):
+            rows, columns = self._cells(level, *box[1:])
+            if (len(rows) <= 2 and len(columns) <= 2) or level == self.LEVELS - 1:
+                break
+        for i in rows:
+            for j in columns:
+                self.levels[level].setdefault((i, j), []).append(box)
+
+    def remove(self, box):
+        """
+        Removes box, which must have been added before.
+        """
+        for cells in self.levels:
+            for key, boxes in cells.items():
+                if box in boxes:
+                    boxes.remove(box)
+                    if not boxes:
+                        del cells[key]
+
+    def search(self, minlat, maxlat, minlon, maxlon):
+        """
+        Returns a list of the boxes that intersect the given one.
+        """
+        found = dict()
+        for level, cells in enumerate(self.levels):
+            rows, columns = self._cells(level, minlat, maxlat, minlon, maxlon)
+            if len(rows) * len(columns) > len(cells):
+                keys = [k for k in cells if k[0] in rows and k[1] in columns]
+            else:
+                keys = [(i, j) for i in rows for j in columns]
+            for key in keys:
+                for box in cells.get(key, ()):
+                    if (box[1] <= maxlat and box[2] >= minlat and
+                        box[3] <= maxlon and box[4] >= minlon):
+                        found[box[0]] = box
+        return found.values()
+
+# Initialize all tables
+_migrate(_writer)
+with _trans(_writer) as cursor:
+    cursor.execute(_create_osm_tag_batch_sql)
+    cursor.execute(_create_osm_id_batch_sql)
+
+_writer_thread = threading.Thread(target = _write_loop)
+_writer_thread.setDaemon(True)
+_writer_thread.start()
+atexit.register(_close)
+
+def _map_grid_load():
+    """
+    (Re)build _map_grid from the boxes in osm_map.
+    """
+    global _map_grid
+    with _map_grid_lock:
+        _map_grid = _MapGrid()
+        for box in _reader().execute('SELECT id, minlat, maxlat, minlon, maxlon \
+                                      FROM osm_map;'):
+            _map_grid.add(box)
+
+# The in-memory osm_map index, if there is no osm_map_rtree, and the lock
+# guarding it.
+_map_grid = None
+_map_grid_lock = threading.RLock()
+if not _reader().execute("SELECT name FROM sqlite_master WHERE \
+                         name = 'osm_map_rtree';").fetchone():
+    _map_grid_load()
+
 def _insert_sql(table, fields):
     """
     Generate the insert SQL to put data into a row in table in fields.
@@ -178,36 +632,167 @@ def _select_sql(tables, results, conditions = None):
         conditionsTxt = ' AND '.join(conditions)
     return sql % locals()
 
-def _getTagID(cursor, key, value):
+# The most ids to look up with a single IN (...) clause. SQLite allows at most
+# 999 ? parameters per statement by default.
+_MAX_IDS = 500
+
+def _select_many(tables, results, column, ids, order = None):
     """
-    Gets the id of the tag with the given key:value pair.
-    If it doesn't exist, this creates it.
+    Select results from tables for the rows whose column is one of ids (a
+    sequence of at most _MAX_IDS ids), optionally ordered by order.
+    Returns a cursor over the results.
     """
-    select_sql = _select_sql('osm_tag', 'id', ('key = ?', 'value = ?'))
-    insert_sql = _insert_sql('osm_tag', ('key', 'value'))
-    cursor.execute(select_sql, (key, value))
-    idTuple = cursor.fetchone()
-    if idTuple == None:
-        cursor.execute(insert_sql, (key, value))
-        cursor.execute(select_sql, (key, value))
-        idTuple = cursor.fetchone()
-    return idTuple[0]
+    conditions = '%s IN (%s)' % (column, ','.join('?' * len(ids)))
+    if order:
+        conditions += ' ORDER BY ' + order
+    return _reader().execute(_select_sql(tables, results, conditions), tuple(ids))
+
+def _tags_many(table, column, ids):
+    """
+    Get the tags of all the objects in ids from table (one of the osm_*_tag
+    tables), whose id column is column.
+    Returns a dict of {id:{k1:v1, k2:v2, ...}, ...}.
+    """
+    tags = dict()
+    for id, key, value in _select_many('%s INNER JOIN osm_tag ON tid = id' % table,
+                                       (column, 'key', 'value'), column, ids):
+        tags.setdefault(id, dict())[key] = value
+    return tags
+
+class _LazyTags:
+    """
+    Stands in for the result of _tags_many when LAZY_TAGS is set, giving every
+    object tags of None so that they are loaded on first use.
+    """
+    def get(self, id, default = None):
+        return None
+
+_lazy_tags = _LazyTags()
+
+def _getTagIDs(cursor, pairs):
+    """
+    Gets the ids of all the given key:value pairs in one pass, creating the
+    ones that don't exist yet.
+    Returns a dict of {(key, value):id, ...}.
+    """
+    pairs = set(pairs)
+    if not pairs:
+        return dict()
+    cursor.execute('DELETE FROM osm_tag_batch;')
+    cursor.executemany(_insert_sql('osm_tag_batch', ('key', 'value')), pairs)
+    cursor.execute('INSERT OR IGNORE INTO osm_tag (key, value) \
+                    SELECT key, value FROM osm_tag_batch;')
+    cursor.execute(_select_sql('osm_tag_batch INNER JOIN osm_tag ON \
+                                osm_tag.key = osm_tag_batch.key AND \
+                                osm_tag.value = osm_tag_batch.value',
+                               ('osm_tag.id', 'osm_tag.key', 'osm_tag.value')))
+    return dict(((key, value), id) for id, key, value in cursor)
+
+def _clear_rows(cursor, ids, tables):
+    """
+    Delete the rows belonging to the objects with the given ids from each of
+    tables, a sequence of (table, id column) pairs. Used before rewriting the
+    tags, way nodes and relation members of objects that are being replaced.
+    """
+    cursor.execute('DELETE FROM osm_id_batch;')
+    cursor.executemany(_insert_sql('osm_id_batch', ('id',)), ((id,) for id in ids))
+    for table, column in tables:
+        cursor.execute('DELETE FROM %s WHERE %s IN (SELECT id FROM osm_id_batch);'
+                       % (table, column))
+
+def _batch_store(cursor, batch):
+    """
+    Store a list of Node, Way and Relation objects using cursor.
+    Rows are grouped per table and written with one executemany each, and all
+    the tag ids the batch needs are resolved at once.
+    """
+    nodes, ways, relations = dict(), dict(), dict()
+    for item in batch:
+        if isinstance(item, osm.node.Node):
+            nodes[item.id] = item
+        elif isinstance(item, osm.way.Way):
+            ways[item.id] = item
+        elif isinstance(item, osm.relation.Relation):
+            relations[item.id] = item
+    tagIDs = _getTagIDs(cursor, (tag for group in (nodes, ways, relations)
+                                 for item in group.itervalues()
+                                 for tag in item.tags.iteritems()))
+    if nodes:
+        _clear_rows(cursor, nodes, (('osm_node_tag', 'nid'),))
+        cursor.executemany(_insert_sql('osm_node', osm.node.node_fields),
+                           (n.insert_tuple() for n in nodes.itervalues()))
+        cursor.executemany(_insert_sql('osm_node_tag', ('nid', 'tid')),
+                           ((n.id, tagIDs[t]) for n in nodes.itervalues()
+                            for t in n.tags.iteritems()))
+    if ways:
+        _clear_rows(cursor, ways, (('osm_way_tag', 'wid'), ('osm_way_node', 'wid')))
+        cursor.executemany(_insert_sql('osm_way', osm.way.way_fields),
+                           (w.insert_tuple() for w in ways.itervalues()))
+        cursor.executemany(_insert_sql('osm_way_tag', ('wid', 'tid')),
+                           ((w.id, tagIDs[t]) for w in ways.itervalues()
+                            for t in w.tags.iteritems()))
+        cursor.executemany(_insert_sql('osm_way_node', ('wid', 'seq', 'nid')),
+                           ((w.id, i, nid) for w in ways.itervalues()
+                            for i, nid in enumerate(w.nodes)))
+    if relations:
+        _clear_rows(cursor, relations, (('osm_relation_tag', 'rid'),
+                                        ('osm_relation_member', 'rid')))
+        cursor.executemany(_insert_sql('osm_relation', osm.relation.relation_fields),
+                           (r.insert_tuple() for r in relations.itervalues()))
+        cursor.executemany(_insert_sql('osm_relation_tag', ('rid', 'tid')),
+                           ((r.id, tagIDs[t]) for r in relations.itervalues()
+                            for t in r.tags.iteritems()))
+        cursor.executemany(_insert_sql('osm_relation_member',
+                                       ('rid', 'seq', 'role', 'type', 'ref')),
+                           ((r.id, i, m.role, m.type, m.ref) for r in relations.itervalues()
+                            for i, m in enumerate(r.members)))
+
+def _batches(iterable, size):
+    """
+    Split iterable into lists of (at most) size items.
+    """
+    iterator = iter(iterable)
+    batch = list(islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(islice(iterator, size))
+
+# Functions to call with the objects written by each store operation.
+_store_listeners = []
+
+def add_store_listener(listener):
+    """
+    Register listener to be called with a list of the objects written each
+    time Nodes, Ways or Relations are stored (after they are committed, unless
+    the caller supplied the cursor). Used to keep caches of stored objects
+    from going stale.
+    """
+    _store_listeners.append(listener)
+
+def _stored(items):
+    """
+    Tell the store listeners that items were written.
+    """
+    for listener in _store_listeners:
+        listener(items)
+
+def _object_store(item, cursor):
+    """
+    Store a single Node, Way or Relation. If cursor is given the writes go
+    through it, as part of the caller's transaction; otherwise they are made
+    by the writer thread and committed before this returns.
+    """
+    if cursor:
+        _batch_store(cursor, [item])
+    else:
+        _write(_batch_store, [item])
+    _stored([item])
 
 def node_store(node, cursor = None):
     """
-    Store the given Node in the database.
+    Store the given Node in the database, using cursor if given.
     """
-    insert_sql = _insert_sql('osm_node', osm.node.node_fields)
-    tag_insert_sql = _insert_sql('osm_node_tag', ('nid', 'tid'))
-    c = cursor
-    if c:
-        c.execute(insert_sql, node.insert_tuple())
-        for i in node.tags.items():
-            c.execute(tag_insert_sql, (node.id, _getTagID(c, *i))) 
-    with _trans(_connection) as c:
-        c.execute(insert_sql, node.insert_tuple())
-        for i in node.tags.items():
-            c.execute(tag_insert_sql, (node.id, _getTagID(c, *i)))
+    _object_store(node, cursor)
 
 def node_marshall(id, fields):
     """
@@ -215,12 +800,12 @@ def node_marshall(id, fields):
     Fetches the required tag data from the database.
     """
     select_tag_sql = _select_sql('osm_node_tag INNER JOIN osm_tag ON tid = id', ('key', 'value'), 'nid = ?')
-    with _trans(_connection) as c:
-        tagDict = dict()
-        c.execute(select_tag_sql, (id,))
-        for key, value in c:
-            tagDict[key] = value
-        return osm.node.Node(id, fields, tagDict)
+    c = _reader().cursor()
+    tagDict = dict()
+    c.execute(select_tag_sql, (id,))
+    for key, value in c:
+        tagDict[key] = value
+    return osm.node.Node(id, fields, tagDict)
 
 def node_retrieve(id):
     """
@@ -228,16 +813,35 @@ def node_retrieve(id):
     Returns the specified Node.
     """
     select_sql = _select_sql('osm_node', osm.node.node_fields[1:], 'id = ?')
-    with _trans(_connection) as c:
-        c.execute(select_sql, (id,))
-        fields = c.fetchone()
-        return node_marshall(id, fields)
+    c = _reader().cursor()
+    c.execute(select_sql, (id,))
+    fields = c.fetchone()
+    return node_marshall(id, fields)
+
+def node_retrieve_many(ids):
+    """
+    Retrieve all the Nodes with the given ids that are in the database, with
+    a few queries per _MAX_IDS ids.
+    Returns a dict of {id:Node}.
+    """
+    nodes = dict()
+    for chunk in _batches(set(ids), _MAX_IDS):
+        tags = _lazy_tags if LAZY_TAGS else _tags_many('osm_node_tag', 'nid', chunk)
+        for row in _select_many('osm_node', osm.node.node_fields, 'id', chunk):
+            nodes[row[0]] = osm.node.Node(row[0], row[1:], tags.get(row[0], dict()))
+    return nodes
+
+def node_tags(id):
+    """
+    Returns the tags of the Node with the given id, as {k1:v1, k2:v2, ...}.
+    """
+    return _tags_many('osm_node_tag', 'nid', [id]).get(id, dict())
 
 def node_count():
     """
     Returns the number of nodes stored in the table.
     """
-    cursor = _connection.execute(_select_sql('osm_node', 'COUNT(id)'))
+    cursor = _reader().execute(_select_sql('osm_node', 'COUNT(id)'))
     res = cursor.fetchone()
     return res[0]
 
@@ -245,7 +849,7 @@ def node_exists(id):
     """
     Returns true if a node with the given id exists in the database.
     """
-    cursor = _connection.execute(_select_sql('osm_node', 'COUNT(id)', 'id = ?'), (id,))
+    cursor = _reader().execute(_select_sql('osm_node', 'COUNT(id)', 'id = ?'), (id,))
     res = cursor.fetchone()
     return res[0] > 0
 
@@ -253,30 +857,28 @@ def node_iter():
     """
     Return an iterator over all nodes in the database as Node objects.
     """
-    cursor = _connection.execute(_select_sql('osm_node', osm.node.node_fields[0]))
+    cursor = _reader().execute(_select_sql('osm_node', osm.node.node_fields[0]))
     return (fields[0] for fields in cursor)
 
+def generation():
+    """
+    Returns the number of writes committed to the database so far (by this
+    version of the store). It changes whenever the data does.
+    """
+    return _reader().execute("SELECT value FROM osm_meta WHERE key = 'generation';").fetchone()[0]
+
+def node_positions():
+    """
+    Returns an iterator of (id, lat, lon) for every node in the database, in
+    order of id.
+    """
+    return _reader().execute('SELECT id, lat, lon FROM osm_node ORDER BY id;')
+
 def way_store(way, cursor = None):
     """
-    Stores the given Way object in the database.
-    """
-    insert_sql = _insert_sql('osm_way', osm.way.way_fields)
-    tag_insert_sql = _insert_sql('osm_way_tag', ('wid', 'tid'))
-    node_insert_sql = _insert_sql('osm_way_node', ('wid', 'seq', 'nid'))
-    c = cursor
-    if c:
-        c.execute(insert_sql, way.insert_tuple())
-        for i in way.tags.items():
-            c.execute(tag_insert_sql, (way.id, _getTagID(c, *i)))
-        for i in xrange(len(way.nodes)):
-            c.execute(node_insert_sql, (way.id, i, way.nodes[i]))
-
-    with _trans(_connection) as c:
-        c.execute(insert_sql, way.insert_tuple())
-        for i in way.tags.items():
-            c.execute(tag_insert_sql, (way.id, _getTagID(c, *i)))
-        for i in xrange(len(way.nodes)):
-            c.execute(node_insert_sql, (way.id, i, way.nodes[i]))
+    Stores the given Way object in the database, using cursor if given.
+    """
+    _object_store(way, cursor)
 
 def way_marshall(id, fields):
     """
@@ -285,30 +887,53 @@ def way_marshall(id, fields):
     """
     select_tag_sql = _select_sql('osm_way_tag INNER JOIN osm_tag ON tid = id', ('key', 'value'), 'wid = ?')
     select_node_sql = _select_sql('osm_way_node', 'nid', 'wid = ? ORDER BY seq ASC')
-    with _trans(_connection) as c:
-        tagDict = dict()
-        c.execute(select_tag_sql, (id,))
-        for key, value in c:
-            tagDict[key] = value
-        c.execute(select_node_sql, (id,))
-        nodeList = [row[0] for row in c]
-        return osm.way.Way(id, fields, tagDict, nodeList)
+    c = _reader().cursor()
+    tagDict = dict()
+    c.execute(select_tag_sql, (id,))
+    for key, value in c:
+        tagDict[key] = value
+    c.execute(select_node_sql, (id,))
+    nodeList = [row[0] for row in c]
+    return osm.way.Way(id, fields, tagDict, nodeList)
 
 def way_retrieve(id):
     """
     Retrieve a Way object with the given id from the database.
     """
     select_sql = _select_sql('osm_way', osm.way.way_fields[1:], 'id = ?')
-    with _trans(_connection) as c:
-        c.execute(select_sql, (id,))
-        fields = c.fetchone()
-        return way_marshall(id, fields)
+    c = _reader().cursor()
+    c.execute(select_sql, (id,))
+    fields = c.fetchone()
+    return way_marshall(id, fields)
+
+def way_retrieve_many(ids):
+    """
+    Retrieve all the Ways with the given ids that are in the database, with
+    a few queries per _MAX_IDS ids.
+    Returns a dict of {id:Way}.
+    """
+    ways = dict()
+    for chunk in _batches(set(ids), _MAX_IDS):
+        tags = _lazy_tags if LAZY_TAGS else _tags_many('osm_way_tag', 'wid', chunk)
+        nodes = dict()
+        for wid, nid in _select_many('osm_way_node', ('wid', 'nid'), 'wid', chunk, 'wid, seq'):
+            nodes.setdefault(wid, []).append(nid)
+        for row in _select_many('osm_way', osm.way.way_fields, 'id', chunk):
+            ways[row[0]] = osm.way.Way(row[0], row[1:], tags.get(row[0], dict()),
+                                       nodes.get(row[0], []))
+    return ways
+
+def way_tags(id):
+    """
+    Returns the tags of the Way with the given id, as {k1:v1, k2:v2, ...}.
+    """
+    return _tags_many('osm_way_tag', 'wid', [id]).get(id, dict())
 
 def way_count():
     """
     Returns the number of ways stored in the database.
     """
-    cursor = _connection.execute(_select_sql('osm_way', 'COUNT(id)'))
+    cursor = _reader().execute(_select_sql('osm_way', 'COUNT(id)'))
     res = cursor.fetchone()
     return res[0]
 
@@ -316,7 +941,7 @@ def way_exists(id):
     """
     Returns true if a way with the given id is in the database.
     """
-    cursor = _connection.execute(_select_sql('osm_way', 'COUNT(id)', 'id = ?'), (id,))
+    cursor = _reader().execute(_select_sql('osm_way', 'COUNT(id)', 'id = ?'), (id,))
     res = cursor.fetchone()
     return res[0] > 0
 
@@ -324,31 +949,30 @@ def way_iter():
     """
     Returns an iterator over all the ways in the database of Way objects.
     """
-    cursor = _connection.execute(_select_sql('osm_way', osm.way.way_fields[0]))
+    cursor = _reader().execute(_select_sql('osm_way', osm.way.way_fields[0]))
     return (fields[0] for fields in cursor)
 
+def way_nodes():
+    """
+    Returns an iterator of (way id, node id) for the nodes of every way in the
+    database, in order of way and then of position along it.
+    """
+    return _reader().execute('SELECT wid, nid FROM osm_way_node ORDER BY wid, seq;')
+
+def way_node_positions():
+    """
+    Returns an iterator of (way id, node id, lat, lon) for the nodes of every
+    way in the database, in order of way and then of position along it. lat
+    and lon are None for nodes that aren't stored.
+    """
+    return _reader().execute('SELECT wid, nid, lat, lon FROM osm_way_node \
+                              LEFT JOIN osm_node ON osm_node.id = nid ORDER BY wid, seq;')
+
 def relation_store(relation, cursor = None):
     """
-    Stores the given relation in the database.
-    """
-    insert_sql = _insert_sql('osm_relation', osm.relation.relation_fields)
-    tag_insert_sql = _insert_sql('osm_relation_tag', ('rid', 'tid'))
-    member_insert_sql = _insert_sql('osm_relation_member', ('rid', 'seq', 'role', 'type', 'ref'))
-    c = cursor
-    if c:
-        c.execute(insert_sql, relation.insert_tuple())
-        for i in relation.tags.items():
-            c.execute(tag_insert_sql, (relation.id, _getTagID(c, *i)))
-        for i in xrange(len(relation.members)):
-            mem = relation.members[i]
-            c.execute(member_insert_sql, (relation.id, i, mem.role, mem.type, mem.ref))
-    with _trans(_connection) as c:
-        c.execute(insert_sql, relation.insert_tuple())
-        for i in relation.tags.items():
-            c.execute(tag_insert_sql, (relation.id, _getTagID(c, *i)))
-        for i in xrange(len(relation.members)):
-            mem = relation.members[i]
-            c.execute(member_insert_sql, (relation.id, i, mem.role, mem.type, mem.ref))
+    Stores the given relation in the database, using cursor if given.
+    """
+    _object_store(relation, cursor)
 
 def relation_marshall(id, fields):
     """
@@ -357,14 +981,14 @@ def relation_marshall(id, fields):
     """
     select_tag_sql = _select_sql('osm_relation_tag INNER JOIN osm_tag ON tid = id', ('key', 'value'), 'rid = ?')
     select_member_sql = _select_sql('osm_relation_member', ('role', 'type', 'ref'), 'rid = ? ORDER BY seq ASC')
-    with _trans(_connection) as c:
-        tagDict = dict()
-        c.execute(select_tag_sql, (id,))
-        for key, value in c:
-            tagDict[key] = value
-        c.execute(select_member_sql, (id,))
-        m = [row for row in c]
-        return osm.relation.Relation(id, fields, tagDict, m)
+    c = _reader().cursor()
+    tagDict = dict()
+    c.execute(select_tag_sql, (id,))
+    for key, value in c:
+        tagDict[key] = value
+    c.execute(select_member_sql, (id,))
+    m = [row for row in c]
+    return osm.relation.Relation(id, fields, tagDict, m)
 
 
 def relation_retrieve(id):
@@ -372,16 +996,40 @@ def relation_retrieve(id):
     Retrieve the relation with the given id from the database.
     """
     select_sql = _select_sql('osm_relation', osm.relation.relation_fields[1:], 'id = ?')
-    with _trans(_connection) as c:
-        c.execute(select_sql, (id,))
-        fields = c.fetchone()
-        return relation_marshall(id, fields)
+    c = _reader().cursor()
+    c.execute(select_sql, (id,))
+    fields = c.fetchone()
+    return relation_marshall(id, fields)
+
+def relation_retrieve_many(ids):
+    """
+    Retrieve all the Relations with the given ids that are in the database,
+    with a few queries per _MAX_IDS ids.
+    Returns a dict of {id:Relation}.
+    """
+    relations = dict()
+    for chunk in _batches(set(ids), _MAX_IDS):
+        tags = _lazy_tags if LAZY_TAGS else _tags_many('osm_relation_tag', 'rid', chunk)
+        members = dict()
+        for row in _select_many('osm_relation_member', ('rid', 'role', 'type', 'ref'),
+                                'rid', chunk, 'rid, seq'):
+            members.setdefault(row[0], []).append(row[1:])
+        for row in _select_many('osm_relation', osm.relation.relation_fields, 'id', chunk):
+            relations[row[0]] = osm.relation.Relation(row[0], row[1:], tags.get(row[0], dict()),
+                                                      members.get(row[0], []))
+    return relations
+
+def relation_tags(id):
+    """
+    Returns the tags of the Relation with the given id, as {k1:v1, k2:v2, ...}.
+    """
+    return _tags_many('osm_relation_tag', 'rid', [id]).get(id, dict())
 
 def relation_count():
     """
     Returns the number of relations stored in the database.
     """
-    cursor = _connection.execute(_select_sql('osm_relation', 'COUNT(id)'))
+    cursor = _reader().execute(_select_sql('osm_relation', 'COUNT(id)'))
     res = cursor.fetchone()
     return res[0]
 
@@ -389,7 +1037,7 @@ def relation_exists(id):
     """
     Returns true if a relation with the given id exists in the database.
     """
-    cursor = _connection.execute(_select_sql('osm_relation', 'COUNT(id)', 'id = ?'), (id,))
+    cursor = _reader().execute(_select_sql('osm_relation', 'COUNT(id)', 'id = ?'), (id,))
     res = cursor.fetchone()
     return res[0] > 0
 
@@ -397,91 +1045,200 @@ def relation_iter():
     """
     Returns an iterator over all relations in the database as Relations.
     """
-    cursor = _connection.execute(_select_sql('osm_relation', osm.relation.relation_fields[0]))
+    cursor = _reader().execute(_select_sql('osm_relation', osm.relation.relation_fields[0]))
     return (fields[0] for fields in cursor)
 
+def _map_insert(cursor, box):
+    """
+    Add box (which must not overlap any stored box) to osm_map, first joining
+    it with each stored box it shares a whole edge with.
+    """
+    joined = True
+    while joined:
+        joined = False
+        for other in map_search(*box):
+            merged = osm.coverage.join(box, other[1:])
+            if merged:
+                cursor.execute('DELETE FROM osm_map WHERE id = ?;', other[:1])
+                if _map_grid:
+                    with _map_grid_lock:
+                        _map_grid.remove(other)
+                else:
+                    cursor.execute('DELETE FROM osm_map_rtree WHERE id = ?;', other[:1])
+                box, joined = merged, True
+                break
+    insert_sql = _insert_sql('osm_map', ('minlat', 'maxlat', 'minlon', 'maxlon'))
+    rtree_insert_sql = _insert_sql('osm_map_rtree', ('id', 'minlat', 'maxlat', 'minlon', 'maxlon'))
+    cursor.execute(insert_sql, box)
+    if _map_grid:
+        with _map_grid_lock:
+            _map_grid.add((cursor.lastrowid,) + box)
+    else:
+        cursor.execute(rtree_insert_sql, (cursor.lastrowid,) + box)
+
 def map_store(minlat, maxlat, minlon, maxlon):
     """
     Stores a record that the given bounding box has been fetched.
+    Only the parts of it that weren't already covered are added, so the boxes
+    in osm_map never overlap, and they are joined with their neighbours where
+    possible to keep the number of boxes down.
     """
-    insert_sql = _insert_sql('osm_map', ('minlat', 'maxlat', 'minlon', 'maxlon'))
-    _connection.execute(insert_sql, (minlat, maxlat, minlon, maxlon))
+    _write(_map_store, (minlat, maxlat, minlon, maxlon))
+
+def _map_store(cursor, box):
+    """
+    Writer thread part of map_store.
+    """
+    for piece in map_uncovered(*box):
+        _map_insert(cursor, piece)
+
+def map_search(minlat, maxlat, minlon, maxlon):
+    """
+    Returns a list of (id, minlat, maxlat, minlon, maxlon) for each fetched
+    bounding box that intersects the given one.
+    """
+    if _map_grid:
+        with _map_grid_lock:
+            return _map_grid.search(minlat, maxlat, minlon, maxlon)
+    select_sql = _select_sql('osm_map_rtree INNER JOIN osm_map ON \
+                              osm_map.id = osm_map_rtree.id',
+                             ('osm_map.id', 'osm_map.minlat', 'osm_map.maxlat',
+                              'osm_map.minlon', 'osm_map.maxlon'),
+                             ('osm_map_rtree.minlat <= ?', 'osm_map_rtree.maxlat >= ?',
+                              'osm_map_rtree.minlon <= ?', 'osm_map_rtree.maxlon >= ?'))
+    cursor = _reader().execute(select_sql, (maxlat, minlat, maxlon, minlon))
+    return [box for box in cursor if box[1] <= maxlat and box[2] >= minlat and
+                                     box[3] <= maxlon and box[4] >= minlon]
+
+def map_uncovered(minlat, maxlat, minlon, maxlon):
+    """
+    Returns a list of non-overlapping (minlat, maxlat, minlon, maxlon) boxes
+    covering the parts of the given bounding box that haven't been fetched.
+    """
+    box = (minlat, maxlat, minlon, maxlon)
+    covered = [other[1:] for other in map_search(*box)]
+    return osm.coverage.merge(osm.coverage.subtract(box, covered))
+
+def map_covered(minlat, maxlat, minlon, maxlon):
+    """
+    Returns true if the whole of the given bounding box has been fetched,
+    possibly over several boxes.
+    """
+    return not map_uncovered(minlat, maxlat, minlon, maxlon)
 
 def check_in_map(lat, lon):
     """
     Returns true if the given (lat, lon) has been fetched.
     """
-    select_sql = _select_sql('osm_map', ('id'), ('minlat <= ?', 'minlon <= ?', 'maxlat >= ?', 'maxlon >= ?'))
-    cursor = _connection.execute(select_sql, (lat, lon, lat, lon))
-    res = cursor.fetchone()
-    return res != None
+    return len(map_search(lat, lat, lon, lon)) > 0
+
+def _node_position(id):
+    """
+    Returns (lat, lon) of the node with the given id, or None if it isn't stored.
+    """
+    cursor = _reader().execute(_select_sql('osm_node', ('lat', 'lon'), 'id = ?'), (id,))
+    return cursor.fetchone()
 
 def node_way_retrieve(id):
     """
     Return a list of the id of all ways which include the given node.
     """
     select_sql = _select_sql('osm_way_node', ('wid'), 'nid = ?')
-    with _trans(_connection) as c:
-        c.execute(select_sql, (id,))
-        res = [r[0] for r in c]
-        if len(res) == 0 or not map_node_exists(id):
-            raise KeyError
-        return res
+    c = _reader().cursor()
+    c.execute(select_sql, (id,))
+    res = [r[0] for r in c]
+    if len(res) == 0 or not map_node_exists(id):
+        raise KeyError
+    return res
+
+def _map_box_cursors(tables, results, conditions = ()):
+    """
+    Yields a cursor over results for the nodes inside each fetched bounding
+    box in turn, found through the osm_node(lat, lon) index rather than by
+    joining osm_node against every box. A node on an edge shared with an
+    earlier box (by id) is left to that box, so each node is found once.
+    """
+    reader = _reader()
+    boxes = reader.execute(_select_sql('osm_map', ('id', 'minlat', 'maxlat',
+                                                   'minlon', 'maxlon'))).fetchall()
+    for box in boxes:
+        where = ['lat >= ?', 'lat <= ?', 'lon >= ?', 'lon <= ?'] + list(conditions)
+        args = list(box[1:])
+        for other in map_search(*box[1:]):
+            if other[0] < box[0]:
+                where.append('NOT (lat >= ? AND lat <= ? AND lon >= ? AND lon <= ?)')
+                args.extend(other[1:])
+        yield reader.execute(_select_sql(tables, results, where), args)
 
 def node_way_iter():
     """
     Return an iterator of (n, [w]) where n is a node, and [w] is a list of the ways
     that include n. 
     """
-    select_sql= _select_sql(('osm_node', 'osm_map', 'osm_way_node'), 
-                            ('DISTINCT nid',), 
-                            ('lat >= minlat', 'lat <= maxlat',
-                             'lon >= minlon', 'lon <= maxlon', 
-                             'osm_node.id = osm_way_node.nid ORDER BY nid ASC'))
-    with _trans(_connection) as c:
-        c.execute(select_sql)
-        return (r[0] for r in c)
+    ids = []
+    for cursor in _map_box_cursors(('osm_node', 'osm_way_node'), ('DISTINCT nid',),
+                                   ('osm_node.id = osm_way_node.nid',)):
+        ids.extend(r[0] for r in cursor)
+    ids.sort()
+    return iter(ids)
 
 def map_node_count():
     """
     Return the number of nodes that are inside a map bounding box.
     """
-    cursor = _connection.execute(_select_sql(('osm_node', 'osm_map'), 'COUNT(osm_node.id)', 
-                                    ('lat >= minlat', 'lat <= maxlat',
-                                     'lon >= minlon', 'lon <= maxlon')))
-    res = cursor.fetchone()
-    return res[0]
+    return sum(cursor.fetchone()[0]
+               for cursor in _map_box_cursors('osm_node', 'COUNT(*)'))
 
 def map_node_exists(id):
     """
     Return true if the given node is inside of a map bounding box.
     """
-    select_sql = """SELECT COUNT(osm_node.id) FROM osm_node, osm_map WHERE 
-                    lat >= minlat AND lat <= maxlat AND lon >= minlon AND lon <= maxlon AND osm_node.id = ?;"""
-    cursor = _connection.execute(select_sql, (id,))
-    res = cursor.fetchone()
-    return res[0] > 0
+    position = _node_position(id)
+    return position is not None and check_in_map(*position)
 
 def map_node_close(id, threshold):
-    select_sql = """SELECT COUNT(osm_node.id) FROM osm_node, osm_map WHERE osm_node.id = ? AND 
-                    lat - minlat >= %f AND 
-                    lat - maxlat <= %f AND 
-                    lon - minlon >= %f AND 
-                    lon - maxlon <= %f;""" % (threshold, threshold, threshold, threshold)
-    cursor = _connection.execute(select_sql, (id,))
-    res = cursor.fetchone()
-    return res[0] > 0
+    """
+    Return true if everything within threshold of the given node has been
+    fetched, i.e. it is at least threshold away from the edge of the fetched
+    area.
+    """
+    position = _node_position(id)
+    if position is None:
+        return False
+    lat, lon = position
+    return map_covered(lat - threshold, lat + threshold,
+                       lon - threshold, lon + threshold)
 
 def data_store(dataList):
     """
     Store all Node, Way and Relation objects in dataList in the database.
+    dataList can be any iterable (e.g. the generator from osm.fetch.iter_data).
+    Objects are written BATCH_SIZE at a time, each batch being committed
+    (possibly along with other threads' writes) before the next is written.
     """
-    with _trans(_connection) as c: 
-        for item in dataList:
-            if isinstance(item, osm.node.Node):
-                node_store(item, c)
-            elif isinstance(item, osm.way.Way):
-                way_store(item, c)
-            elif isinstance(item, osm.relation.Relation):
-                relation_store(item, c)
+    for batch in _batches(dataList, BATCH_SIZE):
+        _write(_batch_store, batch)
+        _stored(batch)
 
+def bulk_load(dataList, batch_size = BULK_BATCH_SIZE, progress = None):
+    """
+    Store all Node, Way and Relation objects in dataList, a large iterable
+    (e.g. a whole extract being read with osm.fetch.iter_data), as quickly as
+    possible. The indexes only used for reading are dropped while it runs and
+    rebuilt at the end, and objects are committed batch_size at a time.
+    progress, if given, is called with the number of objects stored so far
+    after each batch.
+    Returns the number of objects stored.
+    """
+    count = 0
+    _write(drop_indexes)
+    try:
+        for batch in _batches(dataList, batch_size):
+            _write(_batch_store, batch)
+            _stored(batch)
+            count += len(batch)
+            if progress:
+                progress(count)
+    finally:
+        _write(create_indexes)
+    return count
@@ -16,8 +16,25 @@
 ## along with this program.  If not, see <http://www.gnu.org/licenses/>. ##
 
 import unittest
+import bz2
+import math
+import os
+import re
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+import gzip
+from StringIO import StringIO
 import osm
 import osm.fetch
+import osm.aio
+import osm.importer
+import osm.pbf
 
 state = dict()
 
@@ -117,3 +134,933 @@ def testStoreCheckInMap():
     assert osm.store.map_node_exists(42444081)
     assert not osm.store.map_node_exists(42431626)
 
+
+def testExtractData():
+    xml = """<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+ <bounds minlat="40.85" minlon="-73.937" maxlat="40.851" maxlon="-73.936"/>
+ <node id="1" lat="40.8501" lon="-73.9369" version="1" timestamp="2010-01-01T00:00:00Z" changeset="2" uid="3" user="a">
+  <tag k="highway" v="traffic_signals"/>
+ </node>
+ <node id="2" lat="40.8502" lon="-73.9368" version="1" timestamp="2010-01-01T00:00:00Z" changeset="2" uid="3" user="a"/>
+ <way id="10" version="2" timestamp="2010-01-01T00:00:00Z" changeset="2" uid="3" user="a">
+  <nd ref="1"/>
+  <nd ref="2"/>
+  <tag k="highway" v="residential"/>
+ </way>
+ <relation id="20" version="3" timestamp="2010-01-01T00:00:00Z" changeset="2" uid="3" user="a">
+  <member type="way" ref="10" role="outer"/>
+  <tag k="type" v="multipolygon"/>
+ </relation>
+</osm>"""
+    data = osm.fetch.extract_data(StringIO(xml))
+    assert [d.__class__ for d in data] == [osm.node.Node, osm.node.Node,
+                                           osm.way.Way, osm.relation.Relation]
+    node, way, relation = data[0], data[2], data[3]
+    assert node.id == 1 and node.lat == 40.8501 and node.tags == {'highway':'traffic_signals'}
+    assert data[1].tags == {}
+    assert list(way.nodes) == [1, 2] and way.tags == {'highway':'residential'}
+    assert relation.members[0].ref == 10 and relation.members[0].role == 'outer'
+
+class CountingCursor:
+    """
+    Wraps a sqlite3 cursor, counting the statements executed through it.
+    """
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.statements = 0
+
+    def execute(self, *args):
+        self.statements += 1
+        return self.cursor.execute(*args)
+
+    def executemany(self, *args):
+        self.statements += 1
+        return self.cursor.executemany(*args)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+def testStoreStatementCount():
+    fields = (40.8505, -73.9365, 1, '2010-01-01T00:00:00Z', 1, 1, 'a')
+    nodes = [osm.node.Node(-i, fields, {'test':str(i % 3)}) for i in xrange(1, 101)]
+    way = osm.way.Way(-1, fields[2:], {'test':'way'}, [n.id for n in nodes])
+    class Rollback(Exception):
+        pass
+    def count(cursor):
+        single = CountingCursor(cursor)
+        osm.store.node_store(nodes[0], single)
+        nodeStatements = single.statements
+        assert nodeStatements <= 9
+        osm.store.way_store(way, single)
+        assert single.statements - nodeStatements <= 11
+        # A whole batch costs no more statements than one node and one way.
+        batch = CountingCursor(cursor)
+        osm.store._batch_store(batch, nodes + [way])
+        assert batch.statements <= single.statements
+        raise Rollback
+    try:
+        osm.store._write(count)
+    except Rollback:
+        pass
+
+def testStoreMigrate():
+    handle, filename = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+    try:
+        conn = sqlite3.connect(filename)
+        conn.execute(osm.store._create_osm_node_sql)
+        conn.execute(osm.store._insert_sql('osm_node', osm.node.node_fields),
+                     (1, 40.85, -73.93, 1, '2010-01-01T00:00:00Z', 1, 1, 'a'))
+        conn.commit()
+        osm.store._migrate(conn)
+        version = conn.execute('PRAGMA user_version;').fetchone()[0]
+        assert version == len(osm.store._migrations)
+        names = set(r[0] for r in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index';"))
+        for name, table, columns in osm.store._indexes:
+            assert name in names
+        assert conn.execute('SELECT COUNT(id) FROM osm_node;').fetchone()[0] == 1
+        osm.store._migrate(conn)
+        conn.close()
+    finally:
+        os.remove(filename)
+
+def testStoreMapGrid():
+    grid = osm.store._MapGrid()
+    boxes = [(1, 40.850, 40.851, -73.937, -73.936),
+             (2, 40.851, 40.8585, -73.9375, -73.93),
+             (3, 30.0, 50.0, -80.0, -70.0)]
+    for box in boxes:
+        grid.add(box)
+    assert set(b[0] for b in grid.search(40.8505, 40.8505, -73.9365, -73.9365)) == set([1, 3])
+    assert set(b[0] for b in grid.search(40.851, 40.851, -73.937, -73.937)) == set([1, 2, 3])
+    assert set(b[0] for b in grid.search(45.0, 45.0, -75.0, -75.0)) == set([3])
+    assert grid.search(10.0, 60.0, 0.0, 10.0) == []
+
+def testCoverage():
+    box = (0.0, 2.0, 0.0, 2.0)
+    assert osm.coverage.subtract(box, []) == [box]
+    assert osm.coverage.subtract(box, [(-1.0, 3.0, -1.0, 3.0)]) == []
+    assert osm.coverage.subtract(box, [(2.0, 3.0, 0.0, 2.0)]) == [box]
+    pieces = osm.coverage.subtract(box, [(1.0, 3.0, 1.0, 3.0)])
+    assert sorted(pieces) == [(0.0, 1.0, 0.0, 2.0), (1.0, 2.0, 0.0, 1.0)]
+    area = sum((p[1] - p[0]) * (p[3] - p[2]) for p in
+               osm.coverage.subtract(box, [(0.5, 1.5, 0.5, 1.5)]))
+    assert area == 3.0
+    assert osm.coverage.merge([(0.0, 1.0, 0.0, 1.0), (0.0, 1.0, 1.0, 2.0),
+                               (1.0, 2.0, 0.0, 2.0)]) == [box]
+
+def testStoreMapCoverage():
+    osm.store.map_store(-50.0, -49.99, -150.0, -149.99)
+    osm.store.map_store(-50.0, -49.99, -149.99, -149.98)
+    osm.store.map_store(-49.995, -49.985, -149.995, -149.985)
+    boxes = osm.store.map_search(-50.0, -49.985, -150.0, -149.98)
+    assert len(boxes) == 2
+    assert not osm.coverage.intersects(boxes[0][1:], boxes[1][1:])
+    assert osm.store.map_covered(-49.999, -49.986, -149.99, -149.986)
+    assert not osm.store.map_covered(-49.999, -49.984, -149.99, -149.986)
+    assert sorted(osm.store.map_uncovered(-49.99, -49.98, -149.99, -149.98)) == \
+        [(-49.99, -49.985, -149.985, -149.98), (-49.985, -49.98, -149.99, -149.98)]
+
+def testLRUCache():
+    cache = osm.dict.LRUCache(2)
+    cache.put(1, 'a')
+    cache.put(2, 'b')
+    assert cache.get(1) == 'a'
+    cache.put(3, 'c')
+    assert len(cache) == 2
+    try:
+        cache.get(2)
+        assert False
+    except KeyError:
+        pass
+    assert cache.hits == 1 and cache.misses == 1
+    cache.invalidate(1)
+    assert 1 not in cache.entries and 3 in cache.entries
+    cache.invalidate()
+    assert len(cache) == 0
+
+def testDictCacheInvalidation():
+    fields = (-50.0, -150.0, 1, '2010-01-01T00:00:00Z', 1, 1, 'a')
+    osm.store.data_store([osm.node.Node(-7, fields, {})])
+    cached = osm.nodes[-7]
+    assert osm.nodes[-7] is cached
+    osm.store.data_store([osm.node.Node(-7, fields[:2] + (2,) + fields[3:], {})])
+    assert osm.nodes[-7].version == 2
+
+def testStoreRetrieveMany():
+    fields = (-50.0, -150.0, 1, '2010-01-01T00:00:00Z', 1, 1, 'a')
+    nodes = [osm.node.Node(-i, fields, {'test':str(i)}) for i in xrange(10, 20)]
+    way = osm.way.Way(-10, fields[2:], {'test':'way'}, [n.id for n in nodes])
+    osm.store.data_store(nodes + [way])
+    found = osm.store.node_retrieve_many([n.id for n in nodes] + [-9])
+    assert sorted(found) == sorted(n.id for n in nodes)
+    for n in nodes:
+        assert found[n.id] == osm.store.node_retrieve(n.id)
+    ways = osm.store.way_retrieve_many([-10])
+    assert ways[-10] == way
+    many = osm.nodes.get_many([n.id for n in nodes[:5]])
+    assert sorted(many) == sorted(n.id for n in nodes[:5])
+
+class StubAPIHandler(BaseHTTPRequestHandler):
+    """
+    Serves node/way xml for the ids asked for, gzipped if the client accepts
+    it, over keep-alive connections. Every request is recorded on the server
+    as (path, client address), and the server's fail count makes that many
+    requests get a 503 first. If the server has a network, the answers come
+    from it instead (see network_body).
+    """
+    protocol_version = 'HTTP/1.1'
+
+    node = '<node id="%d" lat="-50.0" lon="-150.0" version="1" \
+timestamp="2010-01-01T00:00:00Z" changeset="1" uid="1" user="a"/>'
+    way = '<way id="%d" version="1" timestamp="2010-01-01T00:00:00Z" \
+changeset="1" uid="1" user="a"><nd ref="-31"/><nd ref="-32"/></way>'
+    node_way = '<way id="%d" version="1" timestamp="2010-01-01T00:00:00Z" \
+changeset="1" uid="1" user="a"><nd ref="%d"/></way>'
+
+    placed_node = '<node id="%d" lat="%r" lon="%r" version="1" \
+timestamp="2010-01-01T00:00:00Z" changeset="1" uid="1" user="a"/>'
+    nodes_way = '<way id="%d" version="1" timestamp="2010-01-01T00:00:00Z" \
+changeset="1" uid="1" user="a">%s</way>'
+
+    def network_body(self):
+        """
+        Answers the request from the server's network, ({node id: (lat, lon)},
+        {way id: [node ids]}), as the API would: a map request gets the ways
+        with a node inside the box along with all of their nodes.
+        """
+        positions, ways = self.server.network
+        match = re.match(r'/api/0.6/(map\?bbox=(.*)|nodes\?nodes=([-\d,]+)|'
+                         r'node/(-?\d+)(/ways)?)$', self.path)
+        nids, wids = [], []
+        if match.group(2):
+            minlon, minlat, maxlon, maxlat = [float(x) for x in match.group(2).split(',')]
+            inside = set(id for id, (lat, lon) in positions.iteritems()
+                         if minlat <= lat <= maxlat and minlon <= lon <= maxlon)
+            wids = [wid for wid, way in ways.iteritems() if inside.intersection(way)]
+            nids = inside.union(*[ways[wid] for wid in wids])
+        elif match.group(3):
+            nids = [int(id) for id in match.group(3).split(',')]
+        elif match.group(5):
+            wids = [wid for wid, way in ways.iteritems() if int(match.group(4)) in way]
+        else:
+            nids = [int(match.group(4))]
+        return (''.join(self.placed_node % ((id,) + positions[id]) for id in nids) +
+                ''.join(self.nodes_way % (wid, ''.join('<nd ref="%d"/>' % id for id in ways[wid]))
+                        for wid in wids))
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        self.server.clients.append(self.client_address)
+        if self.server.fail > 0:
+            self.server.fail -= 1
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        match = re.match(r'/api/0.6/(nodes\?nodes=([-\d,]+)|way/(-?\d+)/full|'
+                         r'node/(-?\d+)/ways|map\?bbox=.*)$', self.path)
+        if self.server.network:
+            body = self.network_body()
+        elif match.group(1).startswith('map'):
+            body = self.node % -(50 + len(self.server.paths))
+        elif match.group(4):
+            body = self.node_way % (int(match.group(4)), int(match.group(4)))
+        elif match.group(2):
+            body = ''.join(self.node % int(id) for id in match.group(2).split(','))
+        else:
+            body = self.node % -31 + self.node % -32 + self.way % int(match.group(3))
+        body = '<osm version="0.6">%s</osm>' % body
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            compressed = StringIO()
+            f = gzip.GzipFile(fileobj = compressed, mode = 'wb')
+            f.write(body)
+            f.close()
+            body = compressed.getvalue()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def stub_server():
+    """
+    Starts a StubAPIHandler server in the background.
+    Returns the server and its "host:port".
+    """
+    server = StubServer(('127.0.0.1', 0), StubAPIHandler)
+    server.paths = []
+    server.clients = []
+    server.fail = 0
+    server.network = None
+    thread = threading.Thread(target = server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    return server, '%s:%d' % server.server_address
+
+def testNodeWayFetch():
+    server, address = stub_server()
+    fetch = osm.fetch.fetch
+    osm.fetch.fetch = lambda method, server = None, api = osm.fetch.DEFAULT_API: \
+        fetch(method, address, api)
+    try:
+        fields = (-85.0, -150.0, 1, '2010-01-01T00:00:00Z', 1, 1, 'a')
+        osm.store.data_store([osm.node.Node(-151, fields, {})])
+        osm.store.map_store(-86.0, -84.0, -151.0, -149.0)
+        # The first lookup fetches the ways (unless an earlier run stored
+        # them); the second is answered from the cache.
+        assert list(osm.nodeWays[-151]) == [-151]
+        assert list(osm.nodeWays[-151]) == [-151]
+        assert [w.id for w in osm.nodes[-151].ways] == [-151]
+        assert osm.dict.node_way_fetch(-151) == [-151]
+    finally:
+        osm.fetch.fetch = fetch
+        osm.fetch.close_connections()
+        server.shutdown()
+
+def testFetchCoalescing():
+    server, address = stub_server()
+    try:
+        gate = threading.Event()
+        def nodes(ids):
+            if -21 in ids:
+                gate.wait(5)
+            data = osm.fetch.nodes_get(ids, address)
+            return dict((n.id, n) for n in data)
+        coalescer = osm.fetch.Coalescer(nodes, 0.2)
+        results = dict()
+        def get(id):
+            results[id] = coalescer.get(id)
+        # With nothing else in flight, -21 is fetched straight away (and held
+        # up by the gate); the lookups made meanwhile are merged.
+        threads = [threading.Thread(target = get, args = (-21,))]
+        threads[0].start()
+        while not coalescer.inflight:
+            time.sleep(0.01)
+        threads += [threading.Thread(target = get, args = (-i,)) for i in xrange(21, 26)]
+        for t in threads[1:]:
+            t.start()
+        for t in threads[2:]:
+            t.join()
+        gate.set()
+        for t in threads[:2]:
+            t.join()
+        assert sorted(results) == range(-25, -20)
+        assert results[-23].id == -23
+        assert server.paths == ['/api/0.6/nodes?nodes=-25,-24,-23,-22',
+                                '/api/0.6/nodes?nodes=-21']
+        start = time.time()
+        assert osm.fetch.Coalescer(nodes, 5).get(-26).id == -26
+        assert time.time() - start < 1
+        data = osm.fetch.way_full_get(-30, address)
+        assert server.paths[-1] == '/api/0.6/way/-30/full'
+        assert [d.id for d in data] == [-31, -32, -30]
+    finally:
+        osm.fetch.close_connections()
+        server.shutdown()
+
+def testFetchPooling():
+    server, address = stub_server()
+    backoff = osm.fetch.HTTP_BACKOFF
+    osm.fetch.HTTP_BACKOFF = 0.01
+    try:
+        for i in xrange(3):
+            data = osm.fetch.extract_data(osm.fetch.fetch('nodes?nodes=-41,-42', address))
+            assert [d.id for d in data] == [-41, -42]
+        assert len(set(server.clients)) == 1
+        server.fail = 2
+        data = osm.fetch.way_full_get(-40, address)
+        assert [d.id for d in data] == [-31, -32, -40]
+        assert len(server.paths) == 6
+    finally:
+        osm.fetch.HTTP_BACKOFF = backoff
+        osm.fetch.close_connections()
+        server.shutdown()
+
+def testPrefetchTiles():
+    size = osm.dict.MAP_SIZE
+    assert osm.prefetch.tiles(0.001, 0.002, 0.001, 0.002) == [(0.0, size, 0.0, size)]
+    assert len(osm.prefetch.tiles(0.001, size + 0.001, 0.001, 2 * size + 0.001)) == 6
+    class Point:
+        def __init__(self, lat, lon):
+            self.lat, self.lon = lat, lon
+    src, dst = Point(40.85, -73.94), Point(40.72, -74.01)
+    corridor = osm.prefetch.ellipse_tiles(src, dst, 0)
+    ellipse = osm.prefetch.ellipse_tiles(src, dst, 0.25)
+    everything = osm.prefetch.tiles(40.65, 40.92, -74.1, -73.85)
+    assert set(corridor) < set(ellipse) < set(everything)
+    for point in (src, dst):
+        assert [t for t in corridor if t[0] <= point.lat <= t[1] and t[2] <= point.lon <= t[3]]
+
+def testPrefetch():
+    server, address = stub_server()
+    try:
+        boxes = osm.prefetch.tiles(-60.01, -59.99, -150.01, -149.99)
+        pieces = sum([osm.store.map_uncovered(*box) for box in boxes], [])
+        reports = []
+        def progress(done, total, box, error):
+            reports.append((done, total, error))
+        failed = osm.prefetch.prefetch(boxes, 3, progress, address)
+        assert failed == []
+        assert [r[0] for r in reports] == range(1, len(pieces) + 1)
+        assert len(server.paths) == len(pieces)
+        assert osm.store.map_covered(-60.01, -59.99, -150.01, -149.99)
+        assert osm.prefetch.prefetch(boxes, 3, None, address) == []
+        assert len(server.paths) == len(pieces)
+        # No workers still means one, rather than waiting for ever.
+        box = (-60.03, -60.02, -150.01, -150.0)
+        assert osm.prefetch.prefetch([box], 0, None, address) == []
+        assert osm.store.map_covered(*box)
+    finally:
+        osm.fetch.close_connections()
+        server.shutdown()
+
+def testAio():
+    server, address = stub_server()
+    try:
+        first = osm.aio.nodes.get(-71, address)
+        second = osm.aio.nodes.get(-71, address)
+        assert second is first or first.done()
+        assert first.result(10).id == -71
+        assert osm.aio.nodes.get(-71, address).result(10).id == -71
+        assert len([p for p in server.paths if '-71' in p]) <= 1
+        box = (-70.02, -70.0, -150.02, -150.0)
+        futures = [osm.aio.map_get(*box, server = address) for i in xrange(3)]
+        futures.append(osm.aio.map_get(-70.01, -70.0, -150.01, -150.0, address))
+        for future in futures:
+            assert future.result(10) is None
+        assert len([p for p in server.paths if 'map' in p]) <= 1
+        assert osm.store.map_covered(*box)
+    finally:
+        osm.fetch.close_connections()
+        server.shutdown()
+
+def testStoreThreads():
+    fields = (-50.0, -150.0, 1, '2010-01-01T00:00:00Z', 1, 1, 'a')
+    errors = []
+    connections = set()
+    def write(start):
+        try:
+            for i in xrange(start, start + 100, 10):
+                osm.store.data_store(osm.node.Node(-i - j, fields, {}) for j in xrange(10))
+        except Exception, e:
+            errors.append(e)
+    def read():
+        try:
+            connections.add(id(osm.store._reader()))
+            for i in xrange(50):
+                osm.store.node_retrieve_many(xrange(-1399, -999))
+                osm.store.map_covered(-50.01, -50.0, -150.01, -150.0)
+        except Exception, e:
+            errors.append(e)
+    threads = [threading.Thread(target = write, args = (1000 + 100 * i,)) for i in xrange(4)]
+    threads += [threading.Thread(target = read) for i in xrange(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert len(osm.store.node_retrieve_many(xrange(-1399, -999))) == 400
+    assert len(connections) == 4 or osm.store._shared
+
+def testStoreShared():
+    # As if every thread had to share the writer's connection: a read waits
+    # for the group of writes in progress rather than seeing its rows early.
+    shared = osm.store._shared
+    osm.store._shared = True
+    try:
+        assert isinstance(osm.store._reader(), osm.store._SharedCursor)
+        started, release = threading.Event(), threading.Event()
+        def write(cursor):
+            cursor.execute("INSERT OR REPLACE INTO osm_node (id, lat, lon) \
+                            VALUES (-95, -50.0, -150.0);")
+            started.set()
+            release.wait(5)
+        writer = threading.Thread(target = osm.store._write, args = (write,))
+        writer.start()
+        started.wait(5)
+        seen = []
+        reader = threading.Thread(target = lambda: seen.append(osm.store.node_exists(-95)))
+        reader.start()
+        reader.join(0.2)
+        assert reader.isAlive() and seen == []
+        release.set()
+        writer.join()
+        reader.join()
+        assert seen == [True]
+        assert [row[0] for row in osm.store._reader().execute(
+            'SELECT id FROM osm_node WHERE id = ?', (-95,))] == [-95]
+    finally:
+        osm.store._shared = shared
+
+def testStoreSettings():
+    assert osm.store.settings('bulk-import')['synchronous'] == 'OFF'
+    try:
+        osm.store.settings('no-such-profile')
+        assert False
+    except ValueError:
+        pass
+    osm.config.set('osm', 'db-synchronous', 'NORMAL')
+    try:
+        assert osm.store.settings('bulk-import')['synchronous'] == 'NORMAL'
+    finally:
+        osm.config.set('osm', 'db-synchronous', '')
+    conn = sqlite3.connect(':memory:')
+    osm.store.configure(conn, osm.store.settings('bulk-import'))
+    assert conn.execute('PRAGMA synchronous;').fetchone()[0] == 0
+    assert conn.execute('PRAGMA temp_store;').fetchone()[0] == 2
+    try:
+        osm.store.configure(conn, {'cache_size':'1; DROP TABLE osm_node'})
+        assert False
+    except ValueError:
+        pass
+
+def testImporter():
+    handle, filename = tempfile.mkstemp(suffix='.osm.gz')
+    os.close(handle)
+    node = '<node id="%d" lat="-80.005" lon="-150.005" version="1" \
+timestamp="2010-01-01T00:00:00Z" changeset="1" uid="1" user="a"/>'
+    f = gzip.open(filename, 'wb')
+    f.write('<osm version="0.6"><bounds minlat="-80.01" minlon="-150.01" \
+maxlat="-80.0" maxlon="-150.0"/>%s%s<way id="-81" version="1" \
+timestamp="2010-01-01T00:00:00Z" changeset="1" uid="1" user="a">\
+<nd ref="-81"/><nd ref="-82"/></way></osm>' % (node % -81, node % -82))
+    f.close()
+    try:
+        counts = []
+        count, bounds = osm.importer.load(filename, 2, counts.append)
+        assert count == 3 and counts == [2, 3]
+        assert bounds == [(-80.01, -80.0, -150.01, -150.0)]
+        assert osm.store.map_covered(*bounds[0])
+        assert osm.store.node_way_retrieve(-82) == [-81]
+        indexes = [row[0] for row in osm.store._reader().execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index';")]
+        assert [name for name, table, columns in osm.store._indexes if name not in indexes] == []
+    finally:
+        os.remove(filename)
+
+def testImporterBZ2Streams():
+    handle, filename = tempfile.mkstemp(suffix='.osm.bz2')
+    os.close(handle)
+    node = '<node id="%d" lat="-80.015" lon="-150.015" version="1" \
+timestamp="2010-01-01T00:00:00Z" changeset="1" uid="1" user="a"/>'
+    # Two bzip2 streams one after the other, as pbzip2 writes them.
+    f = open(filename, 'wb')
+    f.write(bz2.compress('<osm version="0.6">%s' % (node % -86)))
+    f.write(bz2.compress('%s</osm>' % (node % -87)))
+    f.close()
+    try:
+        extract = osm.importer.open_extract(filename)
+        assert extract.read(5) == '<osm ' and extract.read().endswith('</osm>')
+        extract.close()
+        count, bounds = osm.importer.load(filename)
+        assert count == 2 and osm.store.node_retrieve(-87).lat == -80.015
+    finally:
+        os.remove(filename)
+
+def pb_varint(value):
+    """
+    Encode value as a protocol buffer varint.
+    """
+    value &= (1 << 64) - 1
+    data = ''
+    while value > 0x7f:
+        data += chr(value & 0x7f | 0x80)
+        value >>= 7
+    return data + chr(value)
+
+def pb_field(number, value):
+    """
+    Encode a protocol buffer field (a varint if value is an int).
+    """
+    if isinstance(value, (int, long)):
+        return pb_varint(number << 3) + pb_varint(value)
+    return pb_varint(number << 3 | 2) + pb_varint(len(value)) + value
+
+def pb_packed(number, values, zigzag = False, delta = False):
+    """
+    Encode a packed repeated varint field.
+    """
+    previous, data = 0, ''
+    for value in values:
+        if delta:
+            value, previous = value - previous, value
+        data += pb_varint((value << 1) ^ (value >> 63) if zigzag else value)
+    return pb_field(number, data)
+
+def pb_blob(kind, data, compress = True):
+    """
+    Encode a BlobHeader and Blob, as they appear in a PBF file.
+    """
+    if compress:
+        blob = pb_field(2, len(data)) + pb_field(3, zlib.compress(data))
+    else:
+        blob = pb_field(1, data)
+    header = pb_field(1, kind) + pb_field(3, len(blob))
+    return struct.pack('>I', len(header)) + header + blob
+
+def testPBF():
+    zig = lambda v: (v << 1) ^ (v >> 63)
+    bbox = ''.join(pb_field(i, zig(int(v * 1e9))) for i, v in
+                   ((1, -150.01), (2, -150.0), (3, -85.0), (4, -85.01)))
+    header = pb_field(1, bbox) + pb_field(4, 'OsmSchema-V0.6') + pb_field(4, 'DenseNodes')
+    strings = pb_field(1, ''.join(pb_field(1, s) for s in
+                                  ('', 'highway', 'traffic_signals', 'a', 'outer')))
+    dense_info = (pb_packed(1, [1, 2]) + pb_packed(2, [1262304000] * 2, True, True) +
+                  pb_packed(3, [1, 1], True, True) + pb_packed(4, [1, 1], True, True) +
+                  pb_packed(5, [3, 3], True, True))
+    dense = (pb_packed(1, [-91, -92], True, True) + pb_field(5, dense_info) +
+             pb_packed(8, [-850050000, -850060000], True, True) +
+             pb_packed(9, [-1500050000, -1500060000], True, True) +
+             pb_packed(10, [1, 2, 0, 0]))
+    info = pb_field(1, 1) + pb_field(2, 1262304000) + pb_field(3, 1) + pb_field(5, 3)
+    way = (pb_field(1, -91) + pb_packed(2, [1]) + pb_packed(3, [2]) + pb_field(4, info) +
+           pb_packed(8, [-91, -92], True, True))
+    relation = (pb_field(1, -91) + pb_field(4, info) + pb_packed(8, [4]) +
+                pb_packed(9, [-91], True, True) + pb_packed(10, [1]))
+    handle, filename = tempfile.mkstemp(suffix='.osm.pbf')
+    f = os.fdopen(handle, 'wb')
+    f.write(pb_blob('OSMHeader', header))
+    f.write(pb_blob('OSMData', strings + pb_field(2, pb_field(2, dense))))
+    f.write(pb_blob('OSMData', strings + pb_field(2, pb_field(3, way) + pb_field(4, relation)),
+                    False))
+    f.close()
+    try:
+        for processes in (0, 2):
+            bounds = []
+            blocks = list(osm.pbf.iter_blocks(filename, bounds, processes))
+            assert [len(block) for block in blocks] == [2, 2]
+            assert list(blocks[0].node_id) == [-91, -92]
+            assert [round(x, 7) for x in blocks[0].node_lat] == [-85.005, -85.006]
+            [(minlat, maxlat, minlon, maxlon)] = bounds
+            assert (round(minlat, 7), round(maxlon, 7)) == (-85.01, -150.0)
+            data = list(osm.pbf.iter_data(filename, None, processes))
+            assert [d.id for d in data] == [-91, -92, -91, -91]
+            node, way, relation = data[0], data[2], data[3]
+            assert node.tags == {'highway':'traffic_signals'} and data[1].tags == {}
+            assert node.timestamp == '2010-01-01T00:00:00Z' and node.user == 'a'
+            assert data[1].version == 2 and round(data[1].lon, 7) == -150.006
+            assert list(way.nodes) == [-91, -92] and way.tags == {'highway':'traffic_signals'}
+            assert [(m.role, m.type, m.ref) for m in relation.members] == [('outer', 'way', -91)]
+        count, bounds = osm.importer.load(filename, processes = 0)
+        assert count == 4
+        assert osm.store.node_way_retrieve(-92) == [-91]
+    finally:
+        os.remove(filename)
+
+def testCompactObjects():
+    fields = (-50.0, -150.0, 1, '2010-01-01T00:00:00Z', 1, 1, 'a')
+    key, value = ''.join(['high', 'way']), ''.join(['traffic_', 'signals'])
+    a = osm.node.Node(-101, fields, {'highway':'traffic_signals'})
+    b = osm.node.Node(-102, fields, {key:unicode(value)})
+    assert not hasattr(a, '__dict__')
+    assert a.tags.keys()[0] is b.tags.keys()[0]
+    assert a.tags.values()[0] is b.tags.values()[0]
+    name = u'caf\xe9'
+    assert osm.intern_string(name) is osm.intern_string(u'caf' + u'\xe9')
+    for i in xrange(osm._MAX_STRINGS + 1):
+        osm.intern_string(u'\xe9%d' % i)
+        osm.intern_string('%d' % i)
+    assert len(osm._strings) <= osm._MAX_STRINGS
+    way = osm.way.Way(-101, fields[2:], {'highway':'residential'}, [-101, -102])
+    assert way.nodes.typecode == osm.way.ID_TYPECODE and list(way.nodes) == [-101, -102]
+    osm.store.data_store([a, b, way])
+    lazy = osm.store.LAZY_TAGS
+    osm.store.LAZY_TAGS = True
+    try:
+        node = osm.store.node_retrieve_many([-101])[-101]
+        assert node._tags is None
+        assert node.tags == {'highway':'traffic_signals'}
+        way = osm.store.way_retrieve_many([-101])[-101]
+        assert way.tags == {'highway':'residential'} and list(way.nodes) == [-101, -102]
+    finally:
+        osm.store.LAZY_TAGS = lazy
+
+def testColumnar():
+    import osm.columnar
+    table = osm.columnar.NodeTable([5, 1, 3], [40.0, 41.0, 42.0], [-73.0, -74.0, -75.0])
+    assert list(table.ids) == [1, 3, 5] and list(table.lat) == [41.0, 42.0, 40.0]
+    assert list(table.index([3, 4, 5, 0, 9])) == [1, -1, 2, -1, -1]
+    assert 5 in table and 4 not in table
+    assert table[5] == (40.0, -73.0)
+    assert list(table.bbox(40.5, 42.5, -76.0, -73.5)) == [1, 3]
+    # One degree of latitude is about 111.2 km.
+    assert abs(table.distances(41.0, -74.0, [1])[0]) < 1e-9
+    assert abs(osm.columnar.distances(0.0, 0.0, 1.0, 0.0) - 111.195) < 1e-3
+    assert table.nearest(40.1, -73.1) == 5
+    try:
+        table.positions([1, 2])
+        assert False
+    except KeyError:
+        pass
+    fields = (-50.0, -150.0, 1, '2010-01-01T00:00:00Z', 1, 1, 'a')
+    osm.store.data_store([osm.node.Node(-111, fields, {})])
+    snapshot = osm.columnar.snapshot()
+    assert len(snapshot) == osm.store.node_count()
+    assert snapshot[-111] == (-50.0, -150.0)
+
+def testGraph():
+    import osm.graph
+    fields = (1, '2010-01-01T00:00:00Z', 1, 1, 'a')
+    nodes = [osm.node.Node(-121 - i, (-60.0 + i * 0.01, -150.0) + fields, {}) for i in xrange(3)]
+    osm.store.data_store(nodes + [osm.way.Way(-121, fields, {}, [-121, -122, -123])])
+    handle, filename = tempfile.mkstemp(suffix = '.graph')
+    os.close(handle)
+    try:
+        graph = osm.graph.load(osm.graph.build(filename))
+        assert not graph.stale()
+        assert list(graph.ids) == sorted(graph.ids)
+        assert len(graph.offsets) == len(graph) + 1 and graph.offsets[-1] == len(graph.targets)
+        neighbours = sorted(graph.neighbours(-122))
+        assert [(n, w) for n, w, length in neighbours] == [(-123, -121), (-121, -121)]
+        assert abs(neighbours[0][2] - 1.11195) < 1e-4
+        assert graph.neighbours(-121)[0][:2] == (-122, -121)
+        assert -124 not in graph
+        osm.store.data_store([osm.node.Node(-124, (-60.0, -150.5) + fields, {})])
+        assert graph.stale()
+        graph.close()
+    finally:
+        os.remove(filename)
+
+def testRoutingGraph():
+    import osm.routing
+    fields = (1, '2010-01-01T00:00:00Z', 1, 1, 'a')
+    nodes = [osm.node.Node(-131 - i, (-70.0 + i * 0.01, -150.0) + fields, {}) for i in xrange(4)]
+    osm.store.data_store(nodes + [osm.way.Way(-131, fields, {}, [-131, -132, -133])])
+    osm.store.map_store(-70.0, -69.97, -150.001, -149.999)
+    graph = osm.routing.RoutingGraph()
+    assert [e[0] for e in graph.neighbours(-132) if e[1] == -131] == [-131, -133]
+    assert abs(graph.neighbours(-131)[0][2] - 1.11195) < 1e-4
+    assert graph.neighbours(-135) == [] and -135 not in graph
+    # Updates from the store: a changed way, a new way and a moved node.
+    osm.store.data_store([osm.way.Way(-131, fields, {}, [-131, -132]),
+                          osm.way.Way(-132, fields, {}, [-132, -134])])
+    osm.store.data_store([osm.node.Node(-134, (-70.0, -150.0) + fields, {})])
+    for g in (graph, osm.routing.RoutingGraph(), osm.routingGraph):
+        assert sorted(e[:2] for e in g.neighbours(-132)) == [(-134, -132), (-131, -131)]
+        assert -133 not in g
+        assert g.neighbours(-134)[0][2] == g.neighbours(-131)[0][2]
+    assert sorted(n.id for n in osm.nodes[-132].adjacent()) == [-134, -131]
+    assert osm.routing.distance(0.0, 0.0, 0.0, 180.0) == osm.routing.EARTH_RADIUS * math.pi
+
+def routeGrid(side = 5, first = -2001):
+    """
+    Stores a side x side grid of nodes near (-80, -150), joined by a way along
+    each row and column, with ids counting down from first, and records its
+    area as fetched.
+    Returns a function giving the id of the node at (row, column).
+    """
+    fields = (1, '2010-01-01T00:00:00Z', 1, 1, 'a')
+    id = lambda i, j: first - i * side - j
+    data = [osm.node.Node(id(i, j), (-80.0 - i * 0.001, -150.0 + j * 0.001) + fields, {})
+            for i in xrange(side) for j in xrange(side)]
+    for i in xrange(side):
+        data.append(osm.way.Way(first - i, fields, {}, [id(i, j) for j in xrange(side)]))
+        data.append(osm.way.Way(first - side - i, fields, {}, [id(j, i) for j in xrange(side)]))
+    osm.store.data_store(data)
+    osm.store.map_store(-80.0 - (side - 1) * 0.001, -80.0, -150.0, -150.0 + (side - 1) * 0.001)
+    return id
+
+def testRouteSearch():
+    import route
+    id = routeGrid()
+    stats = route.Stats()
+    path, dist = route.search(id(0, 0), id(4, 4), stats = stats)
+    assert path[0] == id(0, 0) and path[-1] == id(4, 4) and len(path) == 9
+    lengths = [[e[2] for e in osm.routingGraph.neighbours(a) if e[0] == b][0]
+               for a, b in zip(path, path[1:])]
+    assert abs(sum(lengths) - dist) < 1e-9
+    # The shortest way crosses over on the row nearest the pole.
+    expected = (osm.routing.distance(-80.0, -150.0, -80.004, -150.0) +
+                osm.routing.distance(-80.004, -150.0, -80.004, -149.996))
+    assert abs(dist - expected) < 1e-9
+    assert stats.expansions <= stats.iterations and stats.peak_frontier > 0
+    assert route.search(id(0, 0), id(4, 4), max_iter = 3) == (None, -1)
+    assert route.search(id(0, 0), id(4, 4), max_iter = 0) == (None, -1)
+    # An empty graph is searched, rather than taken for no graph at all.
+    assert route.search(id(0, 0), id(4, 4), graph = SubGraph([]), fetch = False) == (None, -1)
+    assert route.search(id(2, 2), id(2, 2)) == ([id(2, 2)], 0.0)
+    nodes, dist2 = route.routeFind(osm.nodes[id(0, 0)], osm.nodes[id(4, 4)])
+    assert [n.id for n in nodes] == path[1:] and dist2 == dist
+    assert abs(route.distance(osm.nodes[id(0, 0)], osm.nodes[id(4, 0)]) -
+               osm.routing.distance(-80.0, -150.0, -80.004, -150.0)) < 1e-12
+    assert abs(route.bearing(osm.nodes[id(0, 0)], osm.nodes[id(0, 1)]) - math.pi / 2) < 1e-3
+
+def testRouteBidirectional():
+    import route
+    id = routeGrid(9, -2101)
+    one, both = route.Stats(), route.Stats()
+    path, dist = route.search(id(0, 0), id(8, 8), stats = one)
+    path2, dist2 = route.search(id(0, 0), id(8, 8), stats = both, bidirectional = True)
+    assert abs(dist - dist2) < 1e-9 and path2[0] == id(0, 0) and path2[-1] == id(8, 8)
+    assert len(path2) == len(set(path2)) == 17
+    for a, b in zip(path2, path2[1:]):
+        assert b in [e[0] for e in osm.routingGraph.neighbours(a)]
+    for src, dst in ((id(3, 1), id(5, 7)), (id(8, 0), id(0, 8)), (id(4, 4), id(4, 5))):
+        assert abs(route.search(src, dst)[1] - route.search(src, dst, bidirectional = True)[1]) < 1e-9
+    assert route.search(id(0, 0), id(8, 8), max_iter = 3, bidirectional = True) == (None, -1)
+    nodes, dist3 = route.routeFind(osm.nodes[id(0, 0)], osm.nodes[id(8, 8)], bidirectional = True)
+    assert [n.id for n in nodes] == path2[1:] and dist3 == dist2
+
+def testRouteFetch():
+    import route
+    # A road east along three ways, from src at one end to dst two map tiles
+    # away at the other. The middle way only touches the tiles around src
+    # and dst at its ends, so it is found by fetching around them.
+    positions = dict((-3001 - i, (-85.5, -140.0 + i * 0.002)) for i in xrange(7))
+    ways = {-3001:[-3001, -3002, -3003], -3002:[-3003, -3004, -3005],
+            -3003:[-3005, -3006, -3007]}
+    server, address = stub_server()
+    server.network = (positions, ways)
+    fetch = osm.fetch.fetch
+    osm.fetch.fetch = lambda method, server = None, api = osm.fetch.DEFAULT_API: \
+        fetch(method, address, api)
+    try:
+        path, dist = route.search(-3001, -3007)
+        assert path == range(-3001, -3008, -1)
+        expected = sum(osm.routing.distance(*(positions[a] + positions[a - 1]))
+                       for a in path[:-1])
+        assert abs(dist - expected) < 1e-9
+        path2, dist2 = route.search(-3007, -3001, bidirectional = True)
+        assert path2 == path[::-1] and abs(dist2 - dist) < 1e-9
+    finally:
+        osm.fetch.fetch = fetch
+        osm.fetch.close_connections()
+        server.shutdown()
+
+class SubGraph:
+    """
+    The part of osm.routingGraph between the given node ids.
+    """
+    def __init__(self, ids):
+        self.ids = set(ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def neighbours(self, id, fetch = False):
+        return [e for e in osm.routingGraph.neighbours(id) if e[0] in self.ids]
+
+    def position(self, id):
+        return osm.routingGraph.position(id)
+
+def testHierarchy():
+    import route
+    import osm.hierarchy
+    id = routeGrid(7, -2201)
+    grid = SubGraph(id(i, j) for i in xrange(7) for j in xrange(7))
+    handle, filename = tempfile.mkstemp(suffix = '.ch')
+    os.close(handle)
+    try:
+        hierarchy = osm.hierarchy.load(osm.hierarchy.build(filename, grid))
+        assert len(hierarchy) == 49 and sorted(hierarchy.rank) == range(49)
+        assert not hierarchy.stale()
+        for src, dst in ((id(0, 0), id(6, 6)), (id(6, 0), id(0, 6)), (id(3, 2), id(3, 3)),
+                         (id(1, 5), id(5, 1))):
+            path, dist = route.search(src, dst, graph = grid)
+            stats = route.Stats()
+            path2, dist2 = hierarchy.search(src, dst, stats)
+            assert abs(dist - dist2) < 1e-9 and stats.expansions > 0
+            assert path2[0] == src and path2[-1] == dst and len(path2) == len(path)
+            for a, b in zip(path2, path2[1:]):
+                assert b in [e[0] for e in grid.neighbours(a)]
+        assert hierarchy.search(id(2, 2), id(2, 2)) == ([id(2, 2)], 0.0)
+        assert hierarchy.search(id(2, 2), -1) == (None, -1)
+        nodes, dist = hierarchy.routeFind(osm.nodes[id(0, 0)], osm.nodes[id(6, 6)])
+        assert nodes[-1].id == id(6, 6) and len(nodes) == 12
+        # An empty graph gives an empty hierarchy, not one of osm.routingGraph.
+        assert len(osm.hierarchy.load(osm.hierarchy.build(filename, SubGraph([])))) == 0
+    finally:
+        os.remove(filename)
+
+def testLandmarks():
+    import route
+    import osm.landmarks
+    id = routeGrid(7, -2201)
+    grid = SubGraph(id(i, j) for i in xrange(7) for j in xrange(7))
+    handle, filename = tempfile.mkstemp(suffix = '.alt')
+    os.close(handle)
+    try:
+        landmarks = osm.landmarks.load(osm.landmarks.build(filename, grid, 4))
+        assert len(landmarks) == 4 and len(set(landmarks.landmarks)) == 4
+        assert not landmarks.stale()
+        # The first landmarks are opposite corners.
+        assert set(landmarks.landmarks[:2]) in (set([id(0, 0), id(6, 6)]),
+                                                set([id(0, 6), id(6, 0)]))
+        for src, dst in ((id(0, 0), id(6, 6)), (id(6, 0), id(0, 6)), (id(3, 2), id(3, 3))):
+            plain, tight = route.Stats(), route.Stats()
+            path, dist = route.search(src, dst, graph = grid, stats = plain)
+            assert landmarks.bound(src, dst) <= dist + 1e-9
+            assert abs(landmarks.bound(src, dst) - landmarks.bound(dst, src)) < 1e-12
+            path2, dist2 = route.search(src, dst, graph = grid, stats = tight,
+                                        landmarks = landmarks)
+            assert abs(dist - dist2) < 1e-9 and tight.expansions <= plain.expansions
+            path3, dist3 = route.search(src, dst, graph = grid, landmarks = landmarks,
+                                        bidirectional = True)
+            assert abs(dist - dist3) < 1e-9
+        assert landmarks.bound(id(0, 0), -1) == 0.0
+        assert len(osm.landmarks.load(osm.landmarks.build(filename, SubGraph([]))).ids) == 0
+    finally:
+        os.remove(filename)
+
+def testLandmarksStale():
+    import route
+    import osm.landmarks
+    id = routeGrid(5, -2301)
+    grid = SubGraph(id(i, j) for i in xrange(5) for j in xrange(5))
+    handle, filename = tempfile.mkstemp(suffix = '.alt')
+    os.close(handle)
+    try:
+        landmarks = osm.landmarks.load(osm.landmarks.build(filename, grid, 4))
+        assert landmarks.covers(grid)
+        assert not landmarks.covers(SubGraph(list(grid) + [id(0, 0) - 100]))
+        # A way stored afterwards makes a shortcut the tables don't know about,
+        # so their bounds would overestimate the distance across it.
+        fields = (1, '2010-01-01T00:00:00Z', 1, 1, 'a')
+        osm.store.data_store([osm.way.Way(-2399, fields, {}, [id(0, 1), id(4, 3)])])
+        assert landmarks.stale() and not landmarks.covers(grid)
+        path, dist = route.search(id(0, 0), id(4, 4), graph = grid)
+        assert id(4, 3) in path
+        for bidirectional in (False, True):
+            path2, dist2 = route.search(id(0, 0), id(4, 4), graph = grid, landmarks = landmarks,
+                                        bidirectional = bidirectional)
+            assert abs(dist - dist2) < 1e-9
+    finally:
+        os.remove(filename)
+
+def testRouteMatrix():
+    import route
+    id = routeGrid(7, -2201)
+    handle, filename = tempfile.mkstemp(suffix = '.graph')
+    os.close(handle)
+    os.remove(filename)
+    try:
+        sources = [id(0, 0), id(3, 3), -1, id(6, 1)]
+        targets = [id(6, 6), id(0, 0), id(3, 3), -1]
+        result = route.matrix(sources, targets, filename, processes = 0)
+        assert result.shape == (4, 4) and str(result.dtype) == 'float32'
+        for i, src in enumerate(sources):
+            for j, dst in enumerate(targets):
+                expected = route.search(src, dst, fetch = False)[1] if -1 not in (src, dst) else -1
+                if expected < 0:
+                    assert result[i, j] == float('inf')
+                else:
+                    assert abs(result[i, j] - expected) < 1e-5
+        assert result[0, 1] == 0.0
+        assert (route.matrix(sources, targets, filename, processes = 2) == result).all()
+        assert route.matrix([], targets, filename).shape == (0, 4)
+    finally:
+        if os.path.exists(filename):
+            os.remove(filename)
@@ -17,12 +17,24 @@
 """
 This module contains the Way class and associated functions and data.
 """
+from array import array
+import osm
 
-class Way:
+# The array typecode used for lists of ids: a 64 bit integer where there is
+# one ('q' is missing from Python 2's array module), otherwise a double, which
+# holds ids exactly up to 2**53.
+ID_TYPECODE = 'l' if array('l').itemsize == 8 else 'd'
+
+class Way(object):
     """
     This class represents a way object in openstreetmap.org data.
     A Way represents either a path or an area.
+    nodes is an array of the ids of its nodes, in order. If a Way is created
+    with tags of None, they are loaded from osm.store when first used.
     """
+    __slots__ = ('id', 'version', 'timestamp', 'changeset', 'uid', 'user',
+                 '_tags', 'nodes')
+
     def __init__(self, *args):
         """
         If called with one argument, calls __from_element.
@@ -35,21 +47,19 @@ class Way:
 
     def __from_element(self, element):
         """
-        Constructs a Way from a xml.minidom element object.
+        Constructs a Way from an ElementTree element object.
         """
-        attr = element.attributes
-        self.id = int(attr['id'].nodeValue)
-        self.version = int(attr['version'].nodeValue)
-        self.timestamp = attr['timestamp'].nodeValue
-        self.changeset = int(attr['changeset'].nodeValue)
-        self.uid = int(attr['uid'].nodeValue)
-        self.user = attr['user'].nodeValue
-        tagElements = element.getElementsByTagName("tag")
+        attr = element.attrib
+        self.id = int(attr['id'])
+        self.version = int(attr['version'])
+        self.timestamp = attr['timestamp']
+        self.changeset = int(attr['changeset'])
+        self.uid = int(attr['uid'])
+        self.user = osm.intern_string(attr['user'])
         self.tags = dict()
-        for e in tagElements:
-            self.tags[e.attributes['k'].nodeValue] = e.attributes['v'].nodeValue
-        self.nodes = [int(nd.attributes['ref'].nodeValue) for nd in 
-                       element.getElementsByTagName("nd")]
+        for e in element.findall("tag"):
+            self.tags[osm.intern_string(e.get('k'))] = osm.intern_string(e.get('v'))
+        self.nodes = array(ID_TYPECODE, [int(nd.get('ref')) for nd in element.findall("nd")])
 
     def __from_data(self, id, fields, tags, nodes):
         """
@@ -59,8 +69,20 @@ class Way:
         """
         self.id = id
         self.version, self.timestamp, self.changeset, self.uid, self.user = fields
-        self.tags = tags
-        self.nodes = nodes
+        if self.user is not None:
+            self.user = osm.intern_string(self.user)
+        self.tags = osm.intern_tags(tags)
+        self.nodes = array(ID_TYPECODE, nodes)
+
+    def _get_tags(self):
+        if self._tags is None:
+            self._tags = osm.intern_tags(osm.store.way_tags(self.id))
+        return self._tags
+
+    def _set_tags(self, tags):
+        self._tags = tags
+
+    tags = property(_get_tags, _set_tags, doc = "The Way's tags, as {k1:v1, k2:v2, ...}.")
 
     def insert_tuple(self):
         """
@@ -14,55 +14,305 @@
 ##                                                                       ##
 ## You should have received a copy of the GNU General Public License     ##
 ## along with this program.  If not, see <http://www.gnu.org/licenses/>. ##
+"""
+Shortest paths over the cached ways (osm.routingGraph).
+
+routeFind(src, dst) finds the shortest path between two Nodes by A* search,
+with the great circle distance to dst as its heuristic, or by bidirectional
+A* search when called with bidirectional = True. Passing landmarks (see
+osm.landmarks) makes the heuristic tighter. search does the same with node
+ids. A search gives up after MAX_ITER iterations, which is set by
+the route-max-iter option in osm.cfg.
+
+matrix(sources, targets) finds the distances between many pairs of nodes at
+once, over the graph file of osm.graph (which needs NumPy).
+"""
 
 import osm
+import osm.prefetch
+import osm.routing
 import sys
 import math
-import Queue
+from heapq import heappush, heappop
 
 DEBUG = True
-MAX_ITER = 10000
-
-def routeFind(src, dst, queue_max_size = 0):
-    toAnalyze = Queue.PriorityQueue(queue_max_size)
-    analyzed = dict()
-
-    toAnalyze.put((0 + distance(src, dst), src, 0, []))
-
-    i = 0
-    while (not toAnalyze.empty()) and (i < MAX_ITER):
-        i += 1
-        estDist, curr, currPathDist, path = toAnalyze.get()
-        if DEBUG:
-            print "i:%d  qsize:%d  est:%f  curr:%d  distance:%f" % (i, toAnalyze.qsize(), estDist, curr.id, currPathDist),
-        if curr == dst: return (path, currPathDist)
-        if curr in analyzed and currPathDist >= analyzed[curr]:
-            print "analyzed[curr]:%f currPathDist:%f DROPPING" % (analyzed[curr], currPathDist)
+MAX_ITER = osm.config.getint('osm', 'route-max-iter')
+
+class Stats:
+    """
+    Counts of the work done by a search: iterations (entries taken from the
+    frontier, including stale ones), expansions (nodes settled and their
+    edges followed) and peak_frontier (the most entries the frontier held).
+    """
+    def __init__(self):
+        self.iterations = 0
+        self.expansions = 0
+        self.peak_frontier = 0
+
+    def __repr__(self):
+        return "<Stats iterations:%d expansions:%d peak_frontier:%d>" % (
+            self.iterations, self.expansions, self.peak_frontier)
+
+def search(src, dst, graph = None, max_iter = None, stats = None, fetch = True,
+           bidirectional = False, landmarks = None):
+    """
+    Find the shortest path from node id src to node id dst in graph (by
+    default osm.routingGraph) by A* search, giving up after max_iter
+    iterations (by default MAX_ITER). If bidirectional is true, the search
+    grows from both ends at once and stops when they meet (see
+    _search_bidirectional). If fetch is true, the ways and neighbours of each
+    node are looked up before it is expanded where they may be missing, so
+    the search can leave the area already cached (see
+    osm.routing.RoutingGraph.neighbours). If stats is given it should be a
+    Stats, which is filled in. If landmarks (an osm.landmarks.Landmarks) is
+    given, its bounds tighten the heuristic, provided the tables cover the
+    graph (see osm.landmarks.Landmarks.covers); the search then doesn't
+    fetch, as the nodes it fetched wouldn't be in them. Otherwise they are
+    ignored.
+    Returns (list of node ids from src to dst, distance in km), or
+    (None, -1) if no path was found.
+    """
+    if graph is None:
+        graph = osm.routingGraph
+    if max_iter is None:
+        max_iter = MAX_ITER
+    stats = stats or Stats()
+    if landmarks is not None:
+        if landmarks.covers(graph):
+            fetch = False
+        else:
+            landmarks = None
+    positions = []
+    for id in (src, dst):
+        if graph.position(id) is None:
+            graph.neighbours(id, fetch)
+        positions.append(graph.position(id))
+    if src == dst:
+        return [src], 0.0
+    if None in positions:
+        return None, -1
+    if bidirectional:
+        return _search_bidirectional(graph, src, dst, positions, max_iter, stats, fetch,
+                                     landmarks)
+    estimate = _heuristic(graph, dst, positions[1], landmarks)
+
+    best = {src: 0.0}
+    parents = {src: None}
+    closed = set()
+    frontier = [(0.0, 0.0, src)]
+    while frontier and stats.iterations < max_iter:
+        stats.iterations += 1
+        est, dist, curr = heappop(frontier)
+        if curr in closed or dist > best[curr]:
+            continue
+        if curr == dst:
+            return _path(parents, dst), dist
+        closed.add(curr)
+        stats.expansions += 1
+        for n, wid, length in graph.neighbours(curr, fetch):
+            if length is None or n in closed:
+                continue
+            nextDist = dist + length
+            if nextDist < best.get(n, nextDist + 1):
+                best[n] = nextDist
+                parents[n] = curr
+                heappush(frontier, (nextDist + estimate(n), nextDist, n))
+        stats.peak_frontier = max(stats.peak_frontier, len(frontier))
+    return None, -1
+
+def _heuristic(graph, target, position, landmarks = None):
+    """
+    Returns a function giving a lower bound on the distance from a node id to
+    target (at position), from the straight-line distance and landmarks if
+    given.
+    """
+    # Neither bound exceeds the length of a path, and an edge is never shorter
+    # than the difference in the bounds at its ends, so A* settles nodes with
+    # their final distances.
+    def straight(id):
+        lat, lon = graph.position(id)
+        return osm.routing.distance(lat, lon, position[0], position[1])
+    if landmarks is None:
+        return straight
+    bound = landmarks.heuristic(target)
+    return lambda id: max(straight(id), bound(id))
+
+def _search_bidirectional(graph, src, dst, positions, max_iter, stats, fetch,
+                          landmarks = None):
+    """
+    Bidirectional A* between node ids src and dst, whose positions are given.
+    Each side orders its frontier by distance plus a potential: half the
+    difference of the lower bounds (see _heuristic) to dst and to src, added for
+    the forward search and subtracted for the backward one. These keep the
+    two searches consistent with each other, so the shortest path found so
+    far is the shortest of all once the smallest keys of the two frontiers
+    add up to at least its length. The side with the smaller frontier is
+    expanded each iteration. Returns as search does.
+    """
+    to_dst = _heuristic(graph, dst, positions[1], landmarks)
+    to_src = _heuristic(graph, src, positions[0], landmarks)
+
+    def potential(id):
+        return (to_dst(id) - to_src(id)) / 2
+
+    # (best distances, parents, closed set, frontier, sign of the potential)
+    forward = ({src: 0.0}, {src: None}, set(), [(potential(src), 0.0, src)], 1)
+    backward = ({dst: 0.0}, {dst: None}, set(), [(-potential(dst), 0.0, dst)], -1)
+    shortest, meeting = float('inf'), None
+    while forward[3] and backward[3]:
+        if forward[3][0][0] + backward[3][0][0] >= shortest:
+            break
+        if stats.iterations >= max_iter:
+            return None, -1
+        stats.iterations += 1
+        if len(forward[3]) <= len(backward[3]):
+            side, other = forward, backward
+        else:
+            side, other = backward, forward
+        best, parents, closed, frontier, sign = side
+        key, dist, curr = heappop(frontier)
+        if curr in closed or dist > best[curr]:
             continue
-        currBearing = bearing(curr, dst)
-        print [n.id for n in curr.adjacent()]
-        for n in curr.adjacent():
-            nextDist = distance(curr, n)
-            nextPathDist = currPathDist + nextDist
-            deltaBearing = diff_bearing(bearing(curr, n), currBearing)
-            nextEstDist = nextPathDist + (distance(n, dst) * (1 + (deltaBearing / (math.pi * 2))))
-            nextPath = path + [n]
-            if DEBUG:
-                print "id:%d  est:%f  path:%f" % (n.id, nextEstDist, nextPathDist) 
-            toAnalyze.put((nextEstDist, n, nextPathDist, nextPath))
-        analyzed[curr] = currPathDist
-    return ([], -1)
+        closed.add(curr)
+        stats.expansions += 1
+        for n, wid, length in graph.neighbours(curr, fetch):
+            if length is None or n in closed:
+                continue
+            nextDist = dist + length
+            if nextDist < best.get(n, nextDist + 1):
+                best[n] = nextDist
+                parents[n] = curr
+                heappush(frontier, (nextDist + sign * potential(n), nextDist, n))
+                if n in other[0] and nextDist + other[0][n] < shortest:
+                    shortest, meeting = nextDist + other[0][n], n
+        stats.peak_frontier = max(stats.peak_frontier, len(forward[3]) + len(backward[3]))
+    if meeting is None:
+        return None, -1
+    path = _path(forward[1], meeting)
+    id = backward[1][meeting]
+    while id is not None:
+        path.append(id)
+        id = backward[1][id]
+    return path, shortest
+
+def _path(parents, id):
+    """
+    Returns the list of node ids leading to id, following parents back to the
+    node whose parent is None.
+    """
+    path = []
+    while id is not None:
+        path.append(id)
+        id = parents[id]
+    path.reverse()
+    return path
+
+def routeFind(src, dst, queue_max_size = 0, prefetch = False, max_iter = None,
+              stats = None, bidirectional = False, landmarks = None):
+    """
+    Find the shortest path between the Nodes src and dst (see search for
+    max_iter, stats, bidirectional and landmarks). If prefetch is true, the area around the two is
+    downloaded first. queue_max_size is no longer used.
+    Returns (list of the Nodes after src up to dst, distance in km), or
+    ([], -1) if no path was found.
+    """
+    if prefetch:
+        osm.prefetch.prefetch(osm.prefetch.ellipse_tiles(src, dst))
+    stats = stats or Stats()
+    ids, dist = search(src.id, dst.id, max_iter = max_iter, stats = stats,
+                       bidirectional = bidirectional, landmarks = landmarks)
+    if DEBUG:
+        print "route %d -> %d: %f km, %r" % (src.id, dst.id, dist, stats)
+    if ids is None:
+        return ([], -1)
+    nodes = osm.nodes.get_many(ids[1:])
+    return ([nodes[id] for id in ids[1:]], dist)
+
+# The graph file and target indexes of a matrix worker process.
+_matrix_graph = None
+_matrix_targets = None
+
+def _matrix_init(filename, targets):
+    global _matrix_graph, _matrix_targets
+    import osm.graph
+    _matrix_graph = osm.graph.load(filename)
+    _matrix_targets = targets
+
+def _matrix_row(source):
+    import numpy
+    return numpy.array(_matrix_graph.distances_from(source, _matrix_targets), numpy.float64)
+
+def matrix(sources, targets, filename = None, processes = None, dtype = None):
+    """
+    Find the distances in km along the ways from each of the node ids sources
+    to each of the node ids targets, with a search from each source that
+    stops once all the targets are reached. The searches use the graph file
+    filename (by default osm.graph.default_filename(), which is built first
+    if it is missing or out of date), and are spread over a pool of processes
+    processes (by default one per CPU), or run in this process if processes
+    is 0. The processes map the file, so they share one copy of the graph.
+    Returns a NumPy array of dtype (by default float32) with a row for each
+    source and a column for each target, holding inf where there is no path.
+    """
+    import multiprocessing
+    import os
+    import numpy
+    import osm.graph
+    filename = filename or osm.graph.default_filename()
+    if os.path.exists(filename):
+        graph = osm.graph.load(filename)
+        if graph.stale():
+            graph.close()
+            graph = osm.graph.load(osm.graph.build(filename))
+    else:
+        graph = osm.graph.load(osm.graph.build(filename))
+    try:
+        rows, columns = graph.indexes(list(sources)), graph.indexes(list(targets))
+    finally:
+        graph.close()
+    wanted = sorted(set(columns[columns >= 0].tolist()))
+    starts = sorted(set(rows[rows >= 0].tolist()))
+
+    # Each source's distances, with an extra row and column of inf for ids
+    # that aren't in the graph.
+    table = numpy.empty((len(starts) + 1, len(wanted) + 1), numpy.float64)
+    table.fill(numpy.inf)
+    if starts and wanted:
+        if processes == 0 or len(starts) == 1:
+            _matrix_init(filename, wanted)
+            try:
+                found = [_matrix_row(start) for start in starts]
+            finally:
+                _matrix_graph.close()
+        else:
+            pool = multiprocessing.Pool(processes, _matrix_init, (filename, wanted))
+            try:
+                chunk = max(1, len(starts) // (4 * (processes or multiprocessing.cpu_count())))
+                found = pool.map(_matrix_row, starts, chunk)
+            finally:
+                pool.terminate()
+        table[:-1, :-1] = found
+    row = numpy.searchsorted(starts, rows)
+    row[rows < 0] = len(starts)
+    column = numpy.searchsorted(wanted, columns)
+    column[columns < 0] = len(wanted)
+    return table[row][:, column].astype(dtype or numpy.float32)
 
 def distance(src, dst):
-    from math import acos, cos, sin
-    term1 = sin(src.lat) * sin(dst.lat)
-    term2 = cos(src.lat) * cos(dst.lat) * cos(dst.lon - src.lon)
-    return 6371.0 * acos(term1 + term2)
+    """
+    Returns the great circle distance in km between the Nodes src and dst.
+    """
+    return osm.routing.distance(src.lat, src.lon, dst.lat, dst.lon)
 
 def bearing(src, dst):
-    from math import atan2, cos, sin
-    y = sin(dst.lon - src.lon) * cos(dst.lat)
-    x = cos(src.lat) * sin (dst.lat) - sin(src.lat) * cos(dst.lat) * cos(dst.lon - src.lon)
+    """
+    Returns the initial bearing from Node src to Node dst, in radians
+    clockwise from north (between -pi and pi).
+    """
+    from math import atan2, cos, radians, sin
+    lat1, lat2, dlon = radians(src.lat), radians(dst.lat), radians(dst.lon - src.lon)
+    y = sin(dlon) * cos(lat2)
+    x = cos(lat1) * sin(lat2) - sin(lat1) * cos(lat2) * cos(dlon)
     return atan2(y, x)
 
 def diff_bearing(t1, t2):
@@ -80,4 +330,3 @@ if __name__ == '__main__':
         print usage
     else:
         print routeFind(osm.nodes[int(sys.argv[1])], osm.nodes[int(sys.argv[2])])
-